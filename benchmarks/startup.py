@@ -0,0 +1,100 @@
+"""
+Benchmarks CLI startup, failing if registry-only commands exceed their time budget or import the
+embeddings and vector search stacks.
+
+Run from the repository root:
+
+    python benchmarks/startup.py [--budget-ms 150] [--runs 10]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which commands that only read the registry should never import
+HEAVY_MODULES = ["openai", "sqlite_vss", "frontmatter", "rich", "utils.store"]
+
+COMMANDS = [["stores", "get"], ["--help"]]
+
+IMPORT_CHECK = """
+import runpy, sys
+sys.argv = ["main.py", *sys.argv[1:]]
+try:
+    runpy.run_path("main.py", run_name="__main__")
+except SystemExit:
+    pass
+print(",".join(m for m in {heavy!r} if m in sys.modules), file=sys.stderr)
+"""
+
+
+def time_command(args: list[str], runs: int) -> list[float]:
+    """
+    Runs a CLI command several times, returning the wall time of each run in milliseconds.
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "main.py", *args],
+            cwd=ROOT,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def get_heavy_imports(args: list[str]) -> list[str]:
+    """
+    Runs a CLI command in-process, returning the heavy modules it imported.
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_CHECK.format(heavy=HEAVY_MODULES), *args],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    last_line = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ""
+    return [m for m in last_line.split(",") if m != ""]
+
+
+@click.command()
+@click.option(
+    "--budget-ms", help="The maximum median startup time allowed.", default=150.0
+)
+@click.option("--runs", help="The number of times to run each command.", default=10)
+def main(budget_ms: float, runs: int):
+    """
+    Benchmarks CLI startup against a time budget.
+    """
+    failed = False
+    for args in COMMANDS:
+        command = " ".join(args)
+        timings = time_command(args, runs)
+        median = statistics.median(timings)
+        heavy = get_heavy_imports(args)
+
+        status = "ok"
+        if median > budget_ms:
+            status = f"over budget of {budget_ms}ms"
+            failed = True
+        if heavy:
+            status = f"imported {', '.join(heavy)}"
+            failed = True
+
+        print(
+            f"{command}: median {median:.1f}ms, min {min(timings):.1f}ms, max {max(timings):.1f}ms ({status})"
+        )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,24 @@ The entrypoint for the CLI.
 """
 import os
 import sys
+from functools import lru_cache
 from typing import Optional
 import click
 from dotenv import load_dotenv
-from utils.datastore import Datastore
-from utils.processing import Processor
-from utils.store import Store
 
 load_dotenv()
 
-datastore = Datastore("datastore")
+
+# Subsystems are imported inside the commands which use them, so that commands which only read
+# the registry never pay for importing the embeddings or vector search stacks.
+@lru_cache(maxsize=None)
+def get_datastore():
+    """
+    Gets the global datastore, opening it on first use.
+    """
+    from utils.datastore import Datastore
+
+    return Datastore("datastore")
 
 
 def get_absolute_path(path: str):
@@ -33,13 +41,22 @@ def cli():
 @click.command()
 @click.argument("name")
 @click.argument("path")
-def add(name: str, path: str):
+@click.option(
+    "--shards",
+    help="The number of database files to spread the store across.",
+    default=1,
+)
+def add(name: str, path: str, shards: int):
     """
     Add a
     """
+    datastore = get_datastore()
     abs_path = get_absolute_path(path)
     print(f'Adding "{name}" to store with location {abs_path}')
-    datastore.add_new_store(name, abs_path)
+    try:
+        datastore.add_new_store(name, abs_path, shards=shards)
+    except ValueError as e:
+        print("Error adding store: ", e, file=sys.stderr)
 
 
 @click.command()
@@ -48,12 +65,13 @@ def get(name: Optional[str]):
     """
     Gets a store by name, or all the stores if no name is provided.
     """
+    datastore = get_datastore()
     print("\n\n")
     if name is None:
         ss = datastore.get_all_db_stores()
         print("All stores:\n")
         for s in ss:
-            print(f"- {s[0]} {s[1]}\n")
+            print(f"- {s[0]} {s[1]}{f' ({s[2]} shards)' if s[2] > 1 else ''}\n")
     else:
         s = datastore.get_db_store(name)
         print(f"Store {s[0]}:\n")
@@ -64,6 +82,7 @@ def reset():
     """
     Resets the datastore.
     """
+    datastore = get_datastore()
     answer = input(
         "Are you sure you want to reset the datastore, all data will be lost and this cannot be undone?\nIf you are sure please type 'RESET': "
     )
@@ -79,6 +98,84 @@ def reset():
             )
 
 
+@click.command(name="search")
+@click.argument("query")
+@click.option(
+    "--stores",
+    "names",
+    help="Comma separated names of the stores to search, all stores by default.",
+    default=None,
+)
+@click.option(
+    "--column",
+    help="The column to search in (title, content or both).",
+    default="content",
+)
+@click.option("--limit", help="The number of results to return.", default=10)
+@click.option(
+    "--timeout", help="The number of seconds to wait for each store.", default=10.0
+)
+@click.option(
+    "--collapse-duplicates",
+    is_flag=True,
+    help="Only show one result for files with identical content.",
+)
+@click.option(
+    "--title-weight",
+    type=float,
+    help="When searching both columns, how much the title counts, from 0 to 1.",
+    default=None,
+)
+def search_all(
+    query: str,
+    names: Optional[str],
+    column: str,
+    limit: int,
+    timeout: float,
+    collapse_duplicates: bool,
+    title_weight: Optional[float],
+):
+    """
+    Searches multiple stores at once, merging the results by distance.
+    """
+    from utils.store import Store
+
+    datastore = get_datastore()
+    try:
+        if column not in ["title", "content", "both"]:
+            raise Exception(
+                "Invalid column, must be either 'title', 'content' or 'both'"
+            )
+        if title_weight is not None and not 0 <= title_weight <= 1:
+            raise Exception("Invalid title weight, must be between 0 and 1")
+        if names is None:
+            store_names = [s[0] for s in datastore.get_all_db_stores()]
+        else:
+            store_names = [n.strip() for n in names.split(",") if n.strip() != ""]
+        print(
+            f"Searching stores {', '.join(store_names)} for query '{query}' in column {column}"
+        )
+        results, errors = datastore.search_stores(
+            store_names,
+            query,
+            search_in=column,
+            limit=limit,
+            timeout=timeout,
+            collapse_duplicates=collapse_duplicates,
+            title_weight=title_weight,
+        )
+
+        for store_name, error in errors.items():
+            print(f"Skipped store {store_name}: {error}", file=sys.stderr)
+
+        for result in results:
+            print(
+                f"[{result[0]}] ({result[1]}) {result[2]}:\n\n {Store.get_content_summary(result[3], 256)}\n\n\n"
+            )
+    except Exception as e:
+        print("Error searching stores: ", e)
+
+
 @click.group()
 def stores():
     """
@@ -89,6 +186,7 @@ def stores():
 stores.add_command(add)
 stores.add_command(get)
 stores.add_command(reset)
+stores.add_command(search_all)
 
 
 @click.group()
@@ -100,10 +198,32 @@ def store():
 
 @click.command()
 @click.argument("name")
-def build(name):
+@click.option(
+    "--estimate",
+    is_flag=True,
+    help="Report the tokens, requests, cost and duration of the build without running it.",
+)
+@click.option(
+    "--chunk-size",
+    type=int,
+    help="Embed files in chunks of up to this many tokens, or 0 to embed them whole. Saved with the store.",
+    default=None,
+)
+@click.option(
+    "--chunk-overlap",
+    type=int,
+    help="How many tokens of each chunk to repeat at the start of the next.",
+    default=None,
+)
+def build(name, estimate, chunk_size, chunk_overlap):
     """
     Build a store.
     """
+    from utils.chunking import get_default_overlap
+    from utils.processing import Processor
+    from utils.store import Store
+
+    datastore = get_datastore()
     print(f"Attempting to build store {name}")
     try:
         s = datastore.get_store(name)
@@ -111,8 +231,30 @@ def build(name):
         processor = Processor(
             directory=store_data[1],
             store=s,
-            file_types_to_process=[".md", ".txt", ".html"],
         )
+        chunking = s.get_chunking()
+        if chunk_size is None and chunk_overlap is not None:
+            if chunking is None:
+                raise ValueError("Store isn't chunked, pass a --chunk-size")
+            chunk_size = chunking[0]
+        if chunk_size is not None:
+            if chunk_overlap is None:
+                chunk_overlap = get_default_overlap(chunk_size)
+            Store.validate_chunking(chunk_size, chunk_overlap)
+            chunking = (chunk_size, chunk_overlap) if chunk_size > 0 else None
+        if estimate:
+            e = processor.estimate_build(chunking)
+            print(f"Files: {e['files']}")
+            print(f"Requests: {e['requests']}")
+            print(f"Inputs: {e['inputs']}")
+            print(f"Tokens: {e['tokens']}")
+            print(f"Inputs over the token limit: {e['over_limit']} ({e['policy']})")
+            print(f"Expected cost: ${e['cost']:.4f}")
+            print(f"Expected duration: {round(e['duration'] / 60, 1)} minutes")
+            return
+        # Only saved once the build is really going to run
+        if chunk_size is not None:
+            s.set_chunking(chunk_size, chunk_overlap)
         processor.run_build()
     except ValueError as e:
         print("Error building store: ", e)
@@ -122,20 +264,101 @@ def build(name):
 @click.argument("name")
 @click.argument("query")
 @click.option(
-    "--column", help="The column to search in (title or content).", default="content"
+    "--column",
+    help="The column to search in (title, content or both).",
+    default="content",
 )
-def search(name, query, column):
+@click.option(
+    "--collapse-duplicates",
+    is_flag=True,
+    help="Only show one result for files with identical content.",
+)
+@click.option(
+    "--title-weight",
+    type=float,
+    help="When searching both columns, how much the title counts, from 0 to 1.",
+    default=None,
+)
+def search(name, query, column, collapse_duplicates, title_weight):
     """
     Searches a given store based on a query.
     """
+    from utils.store import DEFAULT_TITLE_WEIGHT, Store
+
+    datastore = get_datastore()
     print(f"Searching store {name} for query '{query}' in column {column}")
     try:
-        if column not in ["title", "content"]:
-            raise Exception("Invalid column, must be either 'title' or 'content'")
+        if column not in ["title", "content", "both"]:
+            raise Exception(
+                "Invalid column, must be either 'title', 'content' or 'both'"
+            )
+        if title_weight is not None and not 0 <= title_weight <= 1:
+            raise Exception("Invalid title weight, must be between 0 and 1")
         if column is None:
             column = "content"
         s = datastore.get_store(name)
-        results = s.search_and_map_similar_items(query, column)
+        results = s.search_and_map_similar_items(
+            query,
+            column,
+            collapse_duplicates=collapse_duplicates,
+            title_weight=title_weight
+            if title_weight is not None
+            else DEFAULT_TITLE_WEIGHT,
+        )
+
+        for result in results:
+            print(
+                f"({result[0]}) {result[1]}:\n\n {Store.get_content_summary(result[2], 256)}\n\n\n"
+            )
+    except Exception as e:
+        print("Error searching store: ", e)
+
+
+@click.command()
+@click.argument("name")
+@click.argument("identifier", type=int)
+@click.option(
+    "--column",
+    help="The column to search in (title, content or both).",
+    default="content",
+)
+@click.option("--limit", help="The number of results to return.", default=10)
+@click.option(
+    "--collapse-duplicates",
+    is_flag=True,
+    help="Only show one result for files with identical content.",
+)
+@click.option(
+    "--title-weight",
+    type=float,
+    help="When searching both columns, how much the title counts, from 0 to 1.",
+    default=None,
+)
+def similar(name, identifier, column, limit, collapse_duplicates, title_weight):
+    """
+    Finds the items most similar to an item in a store, without generating any embeddings.
+    """
+    from utils.store import DEFAULT_TITLE_WEIGHT, Store
+
+    datastore = get_datastore()
+    print(f"Searching store {name} for items similar to item {identifier}")
+    try:
+        if column not in ["title", "content", "both"]:
+            raise Exception(
+                "Invalid column, must be either 'title', 'content' or 'both'"
+            )
+        if title_weight is not None and not 0 <= title_weight <= 1:
+            raise Exception("Invalid title weight, must be between 0 and 1")
+        s = datastore.get_store(name)
+        results = s.search_similar_to_item(
+            identifier,
+            column,
+            limit,
+            collapse_duplicates=collapse_duplicates,
+            title_weight=title_weight
+            if title_weight is not None
+            else DEFAULT_TITLE_WEIGHT,
+        )
 
         for result in results:
             print(
@@ -151,6 +374,9 @@ def sync(name):
     """
     Sync a store.
     """
+    from utils.processing import Processor
+
+    datastore = get_datastore()
     print(f"Attempting to sync store {name}")
     try:
         s = datastore.get_store(name)
@@ -158,13 +384,137 @@ def sync(name):
         processor = Processor(
             directory=store_data[1],
             store=s,
-            file_types_to_process=[".md", ".txt", ".html"],
         )
         processor.run_sync()
     except ValueError as e:
         print("Error syncing store: ", e)
 
 
+@click.command(name="retry-failed")
+@click.argument("name")
+@click.option(
+    "--list", "list_only", is_flag=True, help="List the failed files without retrying them."
+)
+def retry_failed(name, list_only):
+    """
+    Reprocess the files which failed during a build, sync or watch.
+    """
+    from utils.processing import Processor
+
+    datastore = get_datastore()
+    try:
+        s = datastore.get_store(name)
+        failures = s.get_failures()
+        if len(failures) == 0:
+            print(f"No failed files in store {name}")
+            return
+        if list_only:
+            for path, error, attempts, _ in failures:
+                print(f"{path} ({attempts} attempts): {error}")
+            return
+
+        store_data = datastore.get_db_store(name)
+        processor = Processor(
+            directory=store_data[1],
+            store=s,
+        )
+        print(f"Retrying {len(failures)} failed files in store {name}")
+        remaining = processor.retry_failed()
+        print(f"{len(failures) - remaining} files processed, {remaining} still failing")
+        processor.report_failures()
+    except ValueError as e:
+        print("Error retrying failed files: ", e)
+
+
+@click.command()
+@click.argument("name")
+@click.option(
+    "--debounce",
+    help="The number of quiet seconds to wait for before applying a burst of changes.",
+    default=1.0,
+)
+@click.option(
+    "--poll", is_flag=True, help="Poll for changes instead of using inotify."
+)
+@click.option(
+    "--poll-interval", help="The number of seconds between polls.", default=2.0
+)
+@click.option(
+    "--batch-size", help="The number of files to apply per transaction.", default=20
+)
+@click.option(
+    "--sync/--no-sync",
+    "initial_sync",
+    help="Whether to sync the store before watching.",
+    default=True,
+)
+@click.option(
+    "--compact",
+    is_flag=True,
+    help="Compact the store whenever its tombstones pass COMPACT_TOMBSTONE_RATIO.",
+)
+def watch(name, debounce, poll, poll_interval, batch_size, initial_sync, compact):
+    """
+    Watch a store's directory, keeping the store in sync as files change.
+    """
+    from utils.processing import Processor
+    from utils.store import get_compact_threshold
+    from utils.watcher import Watcher
+
+    datastore = get_datastore()
+    print(f"Attempting to watch store {name}")
+    try:
+        s = datastore.get_store(name)
+        store_data = datastore.get_db_store(name)
+        processor = Processor(
+            directory=store_data[1],
+            store=s,
+        )
+        if initial_sync:
+            processor.run_sync()
+        watcher = Watcher(
+            store_data[1],
+            debounce=debounce,
+            poll=poll,
+            poll_interval=poll_interval,
+        )
+        processor.run_watch(
+            watcher,
+            batch_size=batch_size,
+            compact_threshold=get_compact_threshold() if compact else None,
+        )
+    except ValueError as e:
+        print("Error watching store: ", e)
+    except KeyboardInterrupt:
+        print(f"Stopped watching store {name}")
+
+
+@click.command()
+@click.argument("name")
+@click.option(
+    "--threshold",
+    type=float,
+    help="Only compact if more than this fraction of the vectors are tombstoned.",
+    default=None,
+)
+def compact(name, threshold):
+    """
+    Rebuild a store's vector index without its deleted vectors.
+    """
+    datastore = get_datastore()
+    try:
+        s = datastore.get_store(name)
+        live, tombstoned = s.get_vector_counts()
+        print(f"Store {name} has {live} live vectors and {tombstoned} tombstoned vectors")
+        dropped = s.compact(threshold)
+        if dropped == 0:
+            print("Nothing to compact")
+            return
+        print(f"Compacted store {name}, dropping {dropped} vectors")
+    except ValueError as e:
+        print("Error compacting store: ", e)
+
+
 @click.command()
 @click.argument("name")
 @click.argument("new_name")
@@ -172,6 +522,7 @@ def rename(name, new_name):
     """
     Rename a store.
     """
+    datastore = get_datastore()
     print(f"Attempting to rename store {name} to {new_name}")
     try:
         datastore.rename_store(name, new_name)
@@ -186,6 +537,7 @@ def remove(name):
     """
     Remove a store.
     """
+    datastore = get_datastore()
     print(f"Attempting to remove store {name}")
     try:
         datastore.remove_store(name)
@@ -194,11 +546,170 @@ def remove(name):
         print("Error removing store: ", e)
 
 
+@click.command()
+@click.argument("name")
+@click.option(
+    "--disable", is_flag=True, help="Decompress the store's content and stop compressing it."
+)
+def compress(name, disable):
+    """
+    Compress a store's content with a dictionary trained on its own documents.
+    """
+    datastore = get_datastore()
+    try:
+        s = datastore.get_store(name)
+        size_before, size_after = s.set_compression(not disable)
+        print(
+            f"{'Decompressed' if disable else 'Compressed'} the content of store {name} "
+            f"from {size_before} to {size_after} bytes"
+        )
+    except ValueError as e:
+        print("Error compressing store: ", e)
+
+
+@click.command()
+@click.argument("name")
+@click.argument("log_file")
+@click.option(
+    "--rate",
+    help="The number of queries per second to replay, 0 replays them as fast as possible.",
+    default=0.0,
+)
+@click.option(
+    "--concurrency", help="The number of queries to run at once.", default=4
+)
+@click.option(
+    "--from-store",
+    help="Only replay the queries which were made against this store.",
+    default=None,
+)
+def replay(name, log_file, rate, concurrency, from_store):
+    """
+    Replay a captured query log against a store, reporting latency and result differences.
+    """
+    from utils.replay import load_query_log, replay_queries
+    from utils.sharding import open_store
+
+    datastore = get_datastore()
+    try:
+        if not datastore.check_store_exists(name):
+            raise ValueError(f"Store '{name}' does not exist.")
+        entries, skipped = load_query_log(log_file, from_store)
+        if len(entries) == 0:
+            print(f"No queries to replay in {log_file}")
+            return
+        print(f"Replaying {len(entries)} queries against store {name} ({skipped} skipped)")
+
+        paths = datastore.get_store_paths(name)
+        report = replay_queries(
+            lambda: open_store(paths, readonly=True),
+            entries,
+            rate=rate,
+            concurrency=concurrency,
+        )
+
+        print(
+            f"Replayed {report['queries']} queries in {report['duration']:.2f}s "
+            f"({report['throughput']:.1f}/s), {report['errors']} errors"
+        )
+        for label, key in [("Replayed", "latency_ms"), ("Logged", "logged_latency_ms")]:
+            latency = report[key]
+            print(
+                f"{label} latency: p50 {latency['p50']:.2f}ms, p90 {latency['p90']:.2f}ms, "
+                f"p99 {latency['p99']:.2f}ms, max {latency['max']:.2f}ms"
+            )
+        print(
+            f"Results differed for {report['diff_rate']:.1%} of queries, "
+            f"with a mean overlap of {report['mean_overlap']:.1%}"
+        )
+    except (ValueError, OSError) as e:
+        print("Error replaying queries: ", e)
+
+
+@click.command(name="export")
+@click.argument("name")
+@click.argument("file")
+@click.option(
+    "--quantize",
+    is_flag=True,
+    help="Store vectors as int8 rather than float32, roughly 4x smaller but lossy.",
+)
+def export_snapshot(name, file, quantize):
+    """
+    Export a store to a snapshot file.
+    """
+    from utils.snapshot import export_store
+
+    datastore = get_datastore()
+    print(f"Attempting to export store {name} to {file}")
+    try:
+        s = datastore.get_store(name)
+        store_data = datastore.get_db_store(name)
+        with open(file, "wb") as f:
+            items, vectors = export_store(
+                s,
+                f,
+                location=store_data[1],
+                vector_format="int8" if quantize else "float32",
+            )
+        print(f"Exported {items} items with {vectors} vectors to {file}")
+    except ValueError as e:
+        print("Error exporting store: ", e)
+
+
+@click.command(name="import")
+@click.argument("file")
+@click.argument("name")
+@click.option(
+    "--location",
+    help="The directory the store syncs with, defaults to the one it was exported from.",
+    default=None,
+)
+@click.option(
+    "--shards",
+    help="The number of database files to spread the store across.",
+    default=1,
+)
+def import_snapshot(file, name, location, shards):
+    """
+    Import a snapshot file as a new store, without generating any embeddings.
+    """
+    from utils.snapshot import import_store, read_head
+
+    datastore = get_datastore()
+    print(f"Attempting to import {file} as store {name}")
+    try:
+        with open(file, "rb") as f:
+            head = read_head(f)
+            abs_path = (
+                get_absolute_path(location) if location is not None else head["location"]
+            )
+            datastore.add_new_store(name, abs_path, shards=shards)
+            try:
+                s = datastore.get_store(name)
+                items, vectors = import_store(s, f, head)
+                s.close()
+            except Exception:
+                datastore.remove_store(name)
+                raise
+        print(f"Imported {items} items with {vectors} vectors as store {name}")
+    except ValueError as e:
+        print("Error importing store: ", e)
+
+
 store.add_command(build)
 store.add_command(search)
+store.add_command(similar)
 store.add_command(sync)
+store.add_command(retry_failed)
+store.add_command(watch)
+store.add_command(compact)
+store.add_command(compress)
+store.add_command(replay)
 store.add_command(rename)
 store.add_command(remove)
+store.add_command(export_snapshot)
+store.add_command(import_snapshot)
 
 
 if __name__ == "__main__":
@@ -6,22 +6,61 @@ import os
 import time
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
+from utils.cache import ResultCache, make_etag
 from utils.datastore import Datastore
+from utils.prefork import serve_prefork
+from utils.querylog import QueryLog
+from utils.store import DEFAULT_TITLE_WEIGHT, Store
 
 load_dotenv()
 
 PORT = os.environ["SERVER_PORT"] if "SERVER_PORT" in os.environ else 8000
+WORKERS = int(os.environ.get("SERVER_WORKERS", 0))
 
 app = Flask(__name__)
 
+# When serving from pre-forked workers, every worker shares this read-only datastore
+readonly_datastore = None
+
+# Results are keyed on the version of the stores searched, so writes invalidate them
+result_cache = ResultCache(int(os.environ.get("SERVER_CACHE_SIZE", 1024)))
+
+# Only set when QUERY_LOG_PATH is, so that captured traffic can be replayed with `store replay`
+query_log = QueryLog.from_env()
+
 
 def get_datastore():
     """
     Gets the global datastore for the given thread.
     """
+    if readonly_datastore is not None:
+        return readonly_datastore
     return Datastore("datastore")
 
 
+def elapsed_ms(start_time: float) -> float:
+    return round((time.time() - start_time) * 1000, 2)
+
+
+def log_query(entry: dict) -> None:
+    """
+    Records a search in the query log, if query logging is on.
+    """
+    if query_log is not None:
+        query_log.record({"time": time.time(), **entry})
+
+
+def not_modified(etag: str):
+    """
+    Gets a 304 response if the client already holds the results with the given ETag.
+    """
+    if not request.if_none_match.contains(etag):
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
 @app.route("/stores/<name>/search", methods=["GET"])
 def search_store(name: str):
     """
@@ -44,39 +83,379 @@ def search_store(name: str):
         column = request.args.get("column")
         if column is None:
             column = "content"
+        if column not in ["title", "content", "both"]:
+            return (
+                jsonify(
+                    {
+                        "message": "Invalid column, must be either 'title', 'content' or 'both'."
+                    }
+                ),
+                400,
+            )
+        title_weight = request.args.get("title_weight")
+        if title_weight is None:
+            title_weight = DEFAULT_TITLE_WEIGHT
+        else:
+            title_weight = float(title_weight)
         limit = request.args.get("limit")
         if limit is None:
             limit = 10
         else:
             limit = int(limit)
 
-        results = store.search_and_map_similar_items(
-            query=query, search_in=column, limit=limit
+        collapse_duplicates = request.args.get("collapse", "false").lower() == "true"
+
+        cache_key = (
+            "search",
+            name,
+            store.get_version(),
+            query,
+            column,
+            limit,
+            collapse_duplicates,
+            title_weight,
         )
-        results_list = []
-        for result in results:
-            results_list.append(
-                {
-                    "id": result[0],
-                    "title": result[1],
-                    "content": result[2],
-                    "distance": result[3],
-                }
+        etag = make_etag(cache_key)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+        timings = {}
+        results_list = result_cache.get(cache_key)
+        cached = results_list is not None
+        if results_list is None:
+            stage_start = time.time()
+            query_embedding = store.embed_query(query)
+            timings["embed"] = elapsed_ms(stage_start)
+
+            stage_start = time.time()
+            results = store.search_and_map_by_embedding(
+                query_embedding,
+                search_in=column,
+                limit=limit,
+                collapse_duplicates=collapse_duplicates,
+                title_weight=title_weight,
             )
+            timings["search"] = elapsed_ms(stage_start)
+            results_list = []
+            for result in results:
+                results_list.append(
+                    {
+                        "id": result[0],
+                        "title": result[1],
+                        "content": result[2],
+                        "distance": result[3],
+                    }
+                )
+            result_cache.put(cache_key, results_list)
 
         end_time = time.time()
         time_taken = end_time - start_time
         time_taken_ms = round(time_taken * 1000, 2)
 
-        return jsonify(
+        timings["total"] = time_taken_ms
+        log_query(
+            {
+                "endpoint": "search",
+                "store": name,
+                "query": query,
+                "column": column,
+                "limit": limit,
+                "collapse": collapse_duplicates,
+                "title_weight": title_weight,
+                "cached": cached,
+                "timings_ms": timings,
+                "result_ids": [result["id"] for result in results_list],
+            }
+        )
+
+        response = jsonify(
             {
                 "message": f"Successfully searched store '{name}' for query '{query}' in column '{column}', in {time_taken_ms}ms",
                 "data": results_list,
             }
         )
+        response.set_etag(etag)
+        return response
+    except Exception as e:
+        return jsonify({"message": f"Error searching store: {e}"}), 500
+
+
+@app.route("/stores/<name>/items/<int:identifier>/similar", methods=["GET"])
+def similar_items(name: str, identifier: int):
+    """
+    Finds the items most similar to an item in a store, using its stored vector.
+    """
+    try:
+        start_time = time.time()
+
+        datastore = get_datastore()
+        if not datastore.check_store_exists(name):
+            return jsonify({"message": f"Store '{name}' does not exist."}), 404
+
+        store = datastore.get_store(name)
+        column = request.args.get("column")
+        if column is None:
+            column = "content"
+        if column not in ["title", "content", "both"]:
+            return (
+                jsonify(
+                    {
+                        "message": "Invalid column, must be either 'title', 'content' or 'both'."
+                    }
+                ),
+                400,
+            )
+        title_weight = request.args.get("title_weight")
+        if title_weight is None:
+            title_weight = DEFAULT_TITLE_WEIGHT
+        else:
+            title_weight = float(title_weight)
+        limit = request.args.get("limit")
+        if limit is None:
+            limit = 10
+        else:
+            limit = int(limit)
+        collapse_duplicates = request.args.get("collapse", "false").lower() == "true"
+
+        cache_key = (
+            "similar",
+            name,
+            store.get_version(),
+            identifier,
+            column,
+            limit,
+            collapse_duplicates,
+            title_weight,
+        )
+        etag = make_etag(cache_key)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+        timings = {}
+        results_list = result_cache.get(cache_key)
+        cached = results_list is not None
+        if results_list is None:
+            stage_start = time.time()
+            try:
+                results = store.search_similar_to_item(
+                    identifier,
+                    search_in=column,
+                    limit=limit,
+                    collapse_duplicates=collapse_duplicates,
+                    title_weight=title_weight,
+                )
+            except ValueError as e:
+                return jsonify({"message": str(e)}), 404
+            timings["search"] = elapsed_ms(stage_start)
+
+            results_list = []
+            for result in results:
+                results_list.append(
+                    {
+                        "id": result[0],
+                        "title": result[1],
+                        "content": result[2],
+                        "distance": result[3],
+                    }
+                )
+            result_cache.put(cache_key, results_list)
+
+        end_time = time.time()
+        time_taken = end_time - start_time
+        time_taken_ms = round(time_taken * 1000, 2)
+
+        timings["total"] = time_taken_ms
+        log_query(
+            {
+                "endpoint": "similar",
+                "store": name,
+                "identifier": identifier,
+                "column": column,
+                "limit": limit,
+                "collapse": collapse_duplicates,
+                "title_weight": title_weight,
+                "cached": cached,
+                "timings_ms": timings,
+                "result_ids": [result["id"] for result in results_list],
+            }
+        )
+
+        response = jsonify(
+            {
+                "message": f"Successfully found items similar to item {identifier} in store '{name}' in column '{column}', in {time_taken_ms}ms",
+                "data": results_list,
+            }
+        )
+        response.set_etag(etag)
+        return response
     except Exception as e:
         return jsonify({"message": f"Error searching store: {e}"}), 500
 
 
+@app.route("/search", methods=["GET"])
+def search_stores():
+    """
+    Searches multiple stores at once, merging the results into a single top-k by distance.
+    """
+    try:
+        start_time = time.time()
+
+        datastore = get_datastore()
+        query = request.args.get("query")
+        if query is None:
+            return jsonify({"message": "No query provided."}), 400
+        names = request.args.get("stores")
+        if names is None:
+            store_names = [s[0] for s in datastore.get_all_db_stores()]
+        else:
+            store_names = [n.strip() for n in names.split(",") if n.strip() != ""]
+        if len(store_names) == 0:
+            return jsonify({"message": "No stores to search."}), 400
+        column = request.args.get("column")
+        if column is None:
+            column = "content"
+        if column not in ["title", "content", "both"]:
+            return (
+                jsonify(
+                    {
+                        "message": "Invalid column, must be either 'title', 'content' or 'both'."
+                    }
+                ),
+                400,
+            )
+        title_weight = request.args.get("title_weight")
+        if title_weight is None:
+            title_weight = DEFAULT_TITLE_WEIGHT
+        else:
+            title_weight = float(title_weight)
+        limit = request.args.get("limit")
+        if limit is None:
+            limit = 10
+        else:
+            limit = int(limit)
+        timeout = request.args.get("timeout")
+        if timeout is None:
+            timeout = 10.0
+        else:
+            timeout = float(timeout)
+
+        collapse_duplicates = request.args.get("collapse", "false").lower() == "true"
+
+        versions = tuple(
+            (
+                store_name,
+                datastore.get_store_version(store_name)
+                if datastore.check_store_exists(store_name)
+                else None,
+            )
+            for store_name in store_names
+        )
+        cache_key = (
+            "federated",
+            versions,
+            query,
+            column,
+            limit,
+            collapse_duplicates,
+            title_weight,
+        )
+        etag = make_etag(cache_key)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+        errors = {}
+        timings = {}
+        results_list = result_cache.get(cache_key)
+        cached = results_list is not None
+        if results_list is None:
+            stage_start = time.time()
+            query_embedding = Store.embed_query(query)
+            timings["embed"] = elapsed_ms(stage_start)
+
+            stage_start = time.time()
+            results, errors = datastore.search_stores(
+                store_names,
+                query,
+                search_in=column,
+                limit=limit,
+                timeout=timeout,
+                collapse_duplicates=collapse_duplicates,
+                title_weight=title_weight,
+                query_embedding=query_embedding,
+            )
+            timings["search"] = elapsed_ms(stage_start)
+            results_list = []
+            for result in results:
+                results_list.append(
+                    {
+                        "store": result[0],
+                        "id": result[1],
+                        "title": result[2],
+                        "content": result[3],
+                        "distance": result[4],
+                    }
+                )
+            # Partial results are only good for as long as the failing stores stay down
+            if len(errors) == 0:
+                result_cache.put(cache_key, results_list)
+
+        end_time = time.time()
+        time_taken = end_time - start_time
+        time_taken_ms = round(time_taken * 1000, 2)
+
+        timings["total"] = time_taken_ms
+        log_query(
+            {
+                "endpoint": "federated",
+                "stores": store_names,
+                "query": query,
+                "column": column,
+                "limit": limit,
+                "collapse": collapse_duplicates,
+                "title_weight": title_weight,
+                "cached": cached,
+                "timings_ms": timings,
+                "result_ids": [[result["store"], result["id"]] for result in results_list],
+                "errors": list(errors),
+            }
+        )
+
+        response = jsonify(
+            {
+                "message": f"Successfully searched stores '{', '.join(store_names)}' for query '{query}' in column '{column}', in {time_taken_ms}ms",
+                "data": results_list,
+                "errors": errors,
+            }
+        )
+        if len(errors) == 0:
+            response.set_etag(etag)
+        return response
+    except Exception as e:
+        return jsonify({"message": f"Error searching stores: {e}"}), 500
+
+
+def serve_readonly(workers: int):
+    """
+    Serves every store read-only from pre-forked workers. Stores are opened and warmed up before
+    forking, so the workers share their mapped pages and loaded indexes rather than each
+    holding a copy.
+    """
+    global readonly_datastore
+    readonly_datastore = Datastore("datastore", readonly=True)
+    readonly_datastore.warm_up()
+
+    # The stores are immutable so their connections can be inherited, but the stores table
+    # can change, so each worker opens its own connection to it
+    serve_prefork(
+        app, int(PORT), workers, after_fork=readonly_datastore.connect
+    )
+
+
 if __name__ == "__main__":
-    app.run(port=PORT, debug=True)
+    if WORKERS > 0:
+        serve_readonly(WORKERS)
+    else:
+        app.run(port=PORT, debug=True)
@@ -0,0 +1,71 @@
+import random
+import sqlite3
+from contextlib import contextmanager
+
+import pytest
+
+
+class FakeClient:
+    """
+    Embeds each text as a vector seeded by the text, so identical texts embed identically.
+    """
+
+    def __init__(self):
+        from utils.embeddings import CircuitBreaker
+
+        self.embedded = []
+        self.breaker = CircuitBreaker()
+
+    def embed(self, text: str) -> list[float]:
+        self.embedded.append(text)
+        generator = random.Random(text)
+        return [generator.random() for _ in range(1536)]
+
+    def generate_embedding(self, text):
+        return self.embed(text)
+
+    def generate_embeddings(self, texts):
+        return [self.embed(text) for text in texts]
+
+    @contextmanager
+    def failing_fast(self):
+        yield self
+
+
+@pytest.fixture
+def client(monkeypatch):
+    import utils.store
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    fake = FakeClient()
+    monkeypatch.setattr(utils.store, "get_client", lambda: fake)
+    return fake
+
+
+@pytest.fixture
+def vss():
+    # Stores need the sqlite-vss extension, which not every build of sqlite3 can load
+    if not hasattr(sqlite3.Connection, "enable_load_extension"):
+        pytest.skip("sqlite3 can't load extensions")
+
+
+@pytest.fixture
+def store(tmp_path, vss):
+    from utils.store import Store
+
+    s = Store(str(tmp_path / "store.db"))
+    s.reset_db()
+    yield s
+    s.close()
+
+
+@pytest.fixture
+def docs(tmp_path):
+    directory = tmp_path / "docs"
+    directory.mkdir()
+    return directory
+
+
+def write_files(directory, files):
+    for name, content in files.items():
+        (directory / name).write_text(content, encoding="utf-8")
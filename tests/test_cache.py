@@ -0,0 +1,30 @@
+from utils.cache import ResultCache, make_etag
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_empty_cache_stores_nothing():
+    cache = ResultCache(max_entries=0)
+    cache.put("a", 1)
+
+    assert cache.get("a") is None
+
+
+def test_etag_depends_on_the_whole_key():
+    assert make_etag(("search", "docs", "id-1", "query")) == make_etag(
+        ("search", "docs", "id-1", "query")
+    )
+    assert make_etag(("search", "docs", "id-1", "query")) != make_etag(
+        ("search", "docs", "id-2", "query")
+    )
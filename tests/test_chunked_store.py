@@ -0,0 +1,56 @@
+import array
+
+from conftest import write_files
+from utils.chunking import chunk_text
+from utils.processing import Processor
+
+
+def build(directory, store) -> Processor:
+    processor = Processor(str(directory), store, delay_per_request=0)
+    processor.run_build()
+    return processor
+
+
+def test_build_chunked_store(docs, store, client):
+    write_files(
+        docs,
+        {
+            "install.md": "# Install\n\nRun the installer.\n\n## Linux\n\nUse the package manager.",
+            "notes.txt": "First paragraph.\n\nSecond paragraph.",
+            "copy.txt": "First paragraph.\n\nSecond paragraph.",
+        },
+    )
+    store.set_chunking(50, 10)
+    build(docs, store)
+
+    assert store.get_failures() == []
+    assert sorted(item[2] for item in store.get_all_metadata()) == [
+        "copy.txt",
+        "install.md",
+        "notes.txt",
+    ]
+    # Searching with a chunk's own embedding finds the item it belongs to
+    install = (docs / "install.md").read_text(encoding="utf-8")
+    linux = [
+        chunk
+        for chunk in chunk_text(install, True, 50, 10)
+        if chunk.heading.endswith("Linux")
+    ]
+    query = array.array("f", client.embed(linux[0].text)).tobytes()
+    results = store.search_and_map_by_embedding(query, limit=1)
+    assert results[0][1] == "install"
+
+
+def test_update_only_embeds_changed_chunks(docs, store, client):
+    write_files(docs, {"doc.md": "# A\n\nKept.\n\n# B\n\nOld."})
+    store.set_chunking(50, 10)
+    processor = build(docs, store)
+
+    client.embedded = []
+    write_files(docs, {"doc.md": "# A\n\nKept.\n\n# B\n\nNew."})
+    with store.batch():
+        processor.update_file(store.get_id_from_path("doc.md"), str(docs / "doc.md"))
+
+    # Only the edited chunk and the title are embedded again
+    assert len(client.embedded) == 2
+    assert any(text.endswith("New.") for text in client.embedded)
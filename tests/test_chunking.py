@@ -0,0 +1,22 @@
+from utils.chunking import chunk_text
+
+
+def test_headings_are_only_in_the_prefix():
+    text = "# A\n\nIntro.\n\n## B\n\nFirst.\n\nSecond.\n\n## Empty\n\n# C\n\nLast."
+
+    chunks = chunk_text(text, True, 50, 0)
+
+    assert [chunk.text for chunk in chunks] == [
+        "A\n\nIntro.",
+        "A > B\n\nFirst.\n\nSecond.",
+        "C\n\nLast.",
+    ]
+
+
+def test_fenced_lines_arent_headings():
+    text = "# A\n\n```\n# not a heading\n```"
+
+    chunks = chunk_text(text, True, 50, 0)
+
+    assert [chunk.heading for chunk in chunks] == ["A"]
+    assert "# not a heading" in chunks[0].text
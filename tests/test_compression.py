@@ -0,0 +1,30 @@
+from utils.store import Store
+
+
+def test_writer_follows_compression_changes(store, client):
+    for number in range(5):
+        store.insert_into_knowledge_base(
+            f"{number}.txt", str(number), f"Shared boilerplate, line {number}.", "text"
+        )
+    # Another process changes the compression while this store is held open
+    other = Store(store.get_name())
+    other.set_compression(True)
+    first_dictionary = other.get_content_dictionary()
+    store.insert_into_knowledge_base("a.txt", "a", "Shared boilerplate, retrained retrained", "text")
+
+    other.set_compression(True)
+    assert other.get_content_dictionary() != first_dictionary
+    store.insert_into_knowledge_base("b.txt", "b", "Shared boilerplate, b.", "text")
+    assert store.get_entry_from_path("a.txt")[3] == "Shared boilerplate, retrained retrained"
+
+    other.set_compression(False)
+    store.insert_into_knowledge_base("c.txt", "c", "Shared boilerplate, c.", "text")
+    other.close()
+
+    contents = {item[2]: item[3] for item in store.get_all()}
+    assert contents["b.txt"] == "Shared boilerplate, b."
+    assert contents["c.txt"] == "Shared boilerplate, c."
+    store.cursor.execute(
+        "SELECT count(*) FROM knowledge_base WHERE typeof(content) = 'blob'"
+    )
+    assert store.cursor.fetchone()[0] == 0
@@ -0,0 +1,92 @@
+import time
+
+from utils.datastore import Datastore
+from utils.store import Store
+
+
+def test_queued_stores_get_their_own_timeout(tmp_path, vss, monkeypatch):
+    datastore = Datastore(str(tmp_path / "datastore"))
+    names = [f"store-{number}" for number in range(12)]
+    for name in names:
+        datastore.add_new_store(name, str(tmp_path))
+
+    def slow_search(self, *args, **kwargs):
+        time.sleep(0.3)
+        return []
+
+    monkeypatch.setattr(Store, "search_and_map_by_embedding", slow_search)
+    results, errors = datastore.search_stores(
+        names, "query", timeout=0.5, query_embedding=b""
+    )
+
+    assert results == []
+    assert errors == {}
+
+
+def test_readonly_warm_up_skips_unbuilt_and_migrates_old_stores(tmp_path, vss):
+    location = str(tmp_path / "datastore")
+    datastore = Datastore(location)
+    datastore.add_new_store("empty", str(tmp_path))
+    datastore.add_new_store("old", str(tmp_path))
+    store = datastore.get_store("old")
+    store.reset_db()
+    # Stores written before the meta table existed don't have one
+    store.cursor.execute("DROP TABLE store_meta")
+    store.conn.commit()
+    store.close()
+    datastore.conn.commit()
+
+    readonly = Datastore(location, readonly=True)
+    readonly.warm_up()
+
+    assert readonly.get_store_version("old").endswith("-0")
+    assert not readonly.get_store("empty").is_built()
+
+
+def test_federated_collapsed_search_fills_the_limit(tmp_path, vss, client):
+    datastore = Datastore(str(tmp_path / "datastore"))
+    for name in ["a", "b"]:
+        datastore.add_new_store(name, str(tmp_path))
+        store = datastore.get_store(name)
+        store.reset_db()
+        for number in range(3):
+            store.insert_into_knowledge_base(
+                f"readme-{number}.md", f"readme-{number}", "Readme.", "markdown"
+            )
+        store.insert_into_knowledge_base(f"{name}.md", name, f"Doc {name}.", "markdown")
+        store.close()
+
+    results, errors = datastore.search_stores(
+        ["a", "b"], "Readme.", limit=3, collapse_duplicates=True
+    )
+
+    assert errors == {}
+    assert sorted(row[3] for row in results) == ["Doc a.", "Doc b.", "Readme."]
+
+
+def test_timed_out_search_keeps_its_store_to_itself(tmp_path, vss, monkeypatch):
+    location = str(tmp_path / "datastore")
+    datastore = Datastore(location)
+    datastore.add_new_store("a", str(tmp_path))
+    datastore.conn.commit()
+    readonly = Datastore(location, readonly=True)
+
+    searched_with = []
+
+    def search(self, *args, **kwargs):
+        searched_with.append(self)
+        if len(searched_with) == 1:
+            time.sleep(0.5)
+        return []
+
+    monkeypatch.setattr(Store, "search_and_map_by_embedding", search)
+    _, errors = readonly.search_stores(["a"], "query", timeout=0.1, query_embedding=b"")
+    assert "a" in errors
+    readonly.search_stores(["a"], "query", query_embedding=b"")
+
+    # The second search couldn't use the store the first was still searching
+    assert searched_with[1] is not searched_with[0]
+    time.sleep(0.6)
+    assert readonly.checked_out_stores == set()
+    readonly.search_stores(["a"], "query", query_embedding=b"")
+    assert searched_with[2] is searched_with[0]
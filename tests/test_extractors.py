@@ -0,0 +1,59 @@
+import pytest
+
+from conftest import write_files
+from utils.extractors import EXTRACTORS, Extractor, register_extractor
+from utils.processing import Processor
+
+
+def test_every_registered_type_is_processed(docs, store):
+    write_files(
+        docs,
+        {
+            "a.md": "A",
+            "b.txt": "B",
+            "c.html": "<p>C</p>",
+            "d.htm": "<p>D</p>",
+            "e.csv": "E",
+        },
+    )
+    processor = Processor(str(docs), store)
+
+    files = processor.get_all_directory_processable_files()
+
+    assert sorted(f[len(str(docs)) + 1 :] for f in files) == [
+        "a.md",
+        "b.txt",
+        "c.html",
+        "d.htm",
+    ]
+
+
+def test_incomplete_extractor_cant_be_registered():
+    class CSVExtractor(Extractor):
+        extensions = [".csv"]
+
+    with pytest.raises(TypeError):
+        register_extractor(CSVExtractor())
+    assert ".csv" not in EXTRACTORS
+
+
+def test_malformed_front_matter_is_recorded_as_failure(docs, store, client):
+    write_files(
+        docs,
+        {
+            "good.md": "Fine.",
+            "bad.md": "---\nprivate: [true\n---\nSecret.",
+        },
+    )
+    processor = Processor(str(docs), store, delay_per_request=0)
+
+    # Discovery keeps the file, so it isn't dropped silently
+    files = processor.get_all_directory_processable_files()
+    assert sorted(f[len(str(docs)) + 1 :] for f in files) == ["bad.md", "good.md"]
+
+    processor.run_build()
+
+    assert [item[2] for item in store.get_all_metadata()] == ["good.md"]
+    assert [failure[0] for failure in store.get_failures()] == ["bad.md"]
+    assert "Malformed front matter" in store.get_failures()[0][1]
+    assert not any("Secret." in text for text in client.embedded)
@@ -0,0 +1,49 @@
+import os
+
+from conftest import write_files
+from utils.processing import Processor
+
+
+def test_missing_file_is_recorded(docs, store, client):
+    processor = Processor(str(docs), store, delay_per_request=0)
+    processor.run_build()
+
+    processor.process_file(str(docs / "gone.txt"))
+
+    assert [failure[0] for failure in store.get_failures()] == ["gone.txt"]
+    assert store.get_all_metadata() == []
+
+
+def test_failed_item_writes_are_rolled_back(docs, store, client):
+    store.set_chunking(50, 10)
+    processor = Processor(str(docs), store, delay_per_request=0)
+    processor.run_build()
+    write_files(docs, {"a.md": "# A\n\nFirst.\n\n# B\n\nSecond.", "b.txt": "Kept."})
+
+    def unreadable(text):
+        # Fails once the item's chunks have already been embedded and written
+        if text == "a":
+            raise PermissionError(f"Can't read {text}")
+        return generate_embedding(text)
+
+    generate_embedding = client.generate_embedding
+    client.generate_embedding = unreadable
+    with store.batch():
+        processor.process_file(str(docs / "b.txt"))
+        processor.process_file(str(docs / "a.md"))
+
+    assert [failure[0] for failure in store.get_failures()] == ["a.md"]
+    assert [item[2] for item in store.get_all_metadata()] == ["b.txt"]
+    store.cursor.execute(
+        "SELECT count(*) FROM chunks WHERE item_id != ?",
+        (store.get_id_from_path("b.txt"),),
+    )
+    assert store.cursor.fetchone()[0] == 0
+    # The rolled back chunk vectors reach the index regardless, so they're tombstoned
+    assert store.get_tombstone_count("vss_chunks") == 2
+
+    client.generate_embedding = generate_embedding
+    assert processor.retry_failed() == 0
+    assert sorted(item[2] for item in store.get_all_metadata()) == ["a.md", "b.txt"]
+    results = store.search_and_map_by_embedding(store.embed_query("First."), limit=5)
+    assert sorted(result[1] for result in results) == ["a", "b"]
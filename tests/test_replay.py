@@ -0,0 +1,55 @@
+import json
+
+from utils.replay import load_query_log, replay_queries
+from utils.store import DEFAULT_TITLE_WEIGHT, Store
+
+
+def test_replay_reports_result_differences(store, client, tmp_path):
+    for number in range(3):
+        store.insert_into_knowledge_base(
+            f"{number}.txt", str(number), f"Item {number}.", "text"
+        )
+    query = {
+        "column": "content",
+        "limit": 2,
+        "collapse": False,
+        "title_weight": DEFAULT_TITLE_WEIGHT,
+    }
+    results = store.search_and_map_by_embedding(
+        Store.embed_query("Item 0."), search_in="content", limit=2
+    )
+    log = [
+        # Replays with the same results it was logged with
+        {
+            "endpoint": "search",
+            "store": "docs",
+            "query": "Item 0.",
+            "result_ids": [row[0] for row in results],
+            "timings_ms": {"search": 1.0},
+            **query,
+        },
+        # Logged before the store changed, so only one of its results is still the same
+        {
+            "endpoint": "similar",
+            "store": "docs",
+            "identifier": store.get_id_from_path("1.txt"),
+            "result_ids": [results[0][0], 999],
+            "timings_ms": {"search": 3.0},
+            **query,
+        },
+        {"endpoint": "federated", "stores": ["docs"], "query": "Item 0.", **query},
+    ]
+    log_file = tmp_path / "queries.jsonl"
+    log_file.write_text("".join(json.dumps(entry) + "\n" for entry in log))
+
+    entries, skipped = load_query_log(str(log_file), from_store="docs")
+    report = replay_queries(
+        lambda: Store(store.get_name(), readonly=True), entries, concurrency=2
+    )
+
+    assert skipped == 1
+    assert report["queries"] == 2
+    assert report["errors"] == 0
+    assert report["diff_rate"] == 0.5
+    assert report["mean_overlap"] == 0.75
+    assert report["logged_latency_ms"]["max"] == 3.0
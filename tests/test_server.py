@@ -0,0 +1,69 @@
+import pytest
+
+import server
+from utils.cache import ResultCache
+from utils.datastore import Datastore
+
+
+@pytest.fixture
+def datastore(tmp_path, vss, client, monkeypatch):
+    datastore = Datastore(str(tmp_path / "datastore"))
+    datastore.add_new_store("docs", str(tmp_path))
+    store = datastore.get_store("docs")
+    store.reset_db()
+    store.insert_into_knowledge_base("install.md", "install", "Run the installer.", "markdown")
+    store.close()
+    datastore.conn.commit()
+
+    monkeypatch.setattr(server, "readonly_datastore", datastore)
+    monkeypatch.setattr(server, "result_cache", ResultCache())
+    return datastore
+
+
+@pytest.fixture
+def app_client():
+    return server.app.test_client()
+
+
+def test_results_are_cached_until_the_store_changes(datastore, client, app_client):
+    first = app_client.get("/stores/docs/search?query=installer")
+    embedded = len(client.embedded)
+    second = app_client.get("/stores/docs/search?query=installer")
+
+    assert second.json["data"] == first.json["data"]
+    assert len(client.embedded) == embedded
+
+    store = datastore.get_store("docs")
+    store.insert_into_knowledge_base("usage.md", "usage", "Search for things.", "markdown")
+    store.close()
+    third = app_client.get("/stores/docs/search?query=installer")
+
+    # The new item's title and content, then the query, which is embedded again
+    assert len(client.embedded) == embedded + 3
+    assert len(third.json["data"]) == 2
+    assert third.headers["ETag"] != first.headers["ETag"]
+
+
+def test_matching_etag_is_not_modified(datastore, app_client):
+    first = app_client.get("/stores/docs/search?query=installer")
+
+    second = app_client.get(
+        "/stores/docs/search?query=installer",
+        headers={"If-None-Match": first.headers["ETag"]},
+    )
+
+    assert second.status_code == 304
+    assert second.data == b""
+
+
+def test_partial_federated_results_are_not_cached(datastore, client, app_client):
+    first = app_client.get("/search?query=installer&stores=docs,missing")
+    embedded = len(client.embedded)
+    second = app_client.get("/search?query=installer&stores=docs,missing")
+
+    assert "missing" in first.json["errors"]
+    assert len(first.json["data"]) == 1
+    assert "ETag" not in first.headers
+    # Searched again, rather than served from the cache
+    assert len(client.embedded) == embedded + 1
+    assert second.json["data"] == first.json["data"]
@@ -0,0 +1,73 @@
+import array
+
+import pytest
+
+from utils.sharding import ShardedStore
+
+
+@pytest.fixture
+def sharded(tmp_path, vss, client):
+    s = ShardedStore([str(tmp_path / f"shard-{i}.db") for i in range(3)])
+    s.reset_db()
+    yield s
+    s.close()
+
+
+def paths_by_shard(store, count=2):
+    """
+    Gets a markdown path for each shard, so that tests can place items on the shard they want.
+    """
+    paths = {}
+    number = 0
+    while len(paths) < count:
+        path = f"doc-{number}.md"
+        paths.setdefault(store.shard_for_path(path), path)
+        number += 1
+    return paths
+
+
+def test_global_ids_round_trip(sharded):
+    for shard_index in range(sharded.num_shards):
+        for identifier in [1, 2, 1000]:
+            global_id = sharded.to_global_id(shard_index, identifier)
+            assert sharded.from_global_id(global_id) == (shard_index, identifier)
+
+
+def test_move_item_across_shards(sharded):
+    paths = paths_by_shard(sharded)
+    (source_shard, source), (target_shard, target) = paths.items()
+    sharded.insert_into_knowledge_base(source, "source", "Moved.", "markdown")
+    identifier = sharded.get_id_from_path(source)
+
+    sharded.move_item(identifier, target, "target")
+
+    assert sharded.get_by_id(identifier) is None
+    moved_id = sharded.get_id_from_path(target)
+    assert sharded.from_global_id(moved_id)[0] == target_shard
+    assert sharded.get_by_id(moved_id)[1:] == ("target", target, "Moved.", "markdown")
+    assert [item[2] for item in sharded.get_all_metadata()] == [target]
+
+
+def test_duplicates_are_collapsed_across_shards(sharded, client):
+    paths = paths_by_shard(sharded, count=3)
+    for shard_index, path in paths.items():
+        sharded.insert_into_knowledge_base(path, f"title {shard_index}", "Same.", "markdown")
+
+    query = array.array("f", client.embed("Same.")).tobytes()
+    results = sharded.search_and_map_by_embedding(query, limit=10, collapse_duplicates=True)
+
+    assert [row[2] for row in results] == ["Same."]
+
+
+def test_similar_to_item_excludes_it(sharded):
+    paths = paths_by_shard(sharded, count=3)
+    for shard_index, path in paths.items():
+        sharded.insert_into_knowledge_base(
+            path, f"title {shard_index}", f"Content {shard_index}.", "markdown"
+        )
+    identifier = sharded.get_id_from_path(paths[1])
+
+    results = sharded.search_similar_to_item(identifier, limit=10)
+
+    assert identifier not in [row[0] for row in results]
+    assert len(results) == 2
@@ -0,0 +1,114 @@
+import array
+import io
+
+import pytest
+from click.testing import CliRunner
+
+from utils.datastore import Datastore
+from utils.snapshot import (
+    MAGIC,
+    SECTION_HEADER,
+    SnapshotError,
+    export_store,
+    import_store,
+    read_head,
+)
+from utils.store import Store
+
+ITEMS = {
+    "install.md": "Run the installer.",
+    "usage.md": "Call the search command.",
+    "faq.md": "Questions and answers.",
+}
+
+
+@pytest.fixture
+def source(store, client):
+    for path, content in ITEMS.items():
+        store.insert_into_knowledge_base(path, path[:-3], content, "markdown")
+    return store
+
+
+def export(store, vector_format="float32") -> bytes:
+    f = io.BytesIO()
+    export_store(store, f, location="/docs", vector_format=vector_format)
+    return f.getvalue()
+
+
+def load(snapshot: bytes, path) -> Store:
+    target = Store(str(path))
+    f = io.BytesIO(snapshot)
+    import_store(target, f, read_head(f))
+    return target
+
+
+def embed(client, text: str) -> bytes:
+    return array.array("f", client.embed(text)).tobytes()
+
+
+def section_offset(snapshot: bytes, tag: bytes) -> int:
+    """
+    Gets the offset of the payload of the given section.
+    """
+    offset = len(MAGIC)
+    while True:
+        found, length = SECTION_HEADER.unpack_from(snapshot, offset)
+        offset += SECTION_HEADER.size
+        if found == tag:
+            return offset
+        offset += length + 32
+
+
+def test_float32_round_trip(source, client, tmp_path):
+    target = load(export(source), tmp_path / "imported.db")
+
+    assert target.get_all() == source.get_all()
+    query = embed(client, "Call the search command.")
+    assert target.search_and_map_by_embedding(query) == source.search_and_map_by_embedding(
+        query
+    )
+    target.close()
+
+
+def test_int8_round_trip_is_within_tolerance(source, client, tmp_path):
+    target = load(export(source, "int8"), tmp_path / "imported.db")
+
+    assert target.get_all() == source.get_all()
+    for identifier, *_ in source.get_all():
+        for original, restored in zip(
+            source.get_item_vector(identifier), target.get_item_vector(identifier)
+        ):
+            original = array.array("f", original)
+            restored = array.array("f", restored)
+            scale = max(abs(v) for v in original) / 127
+            assert all(abs(a - b) <= scale for a, b in zip(original, restored))
+    query = embed(client, "Call the search command.")
+    assert target.search_and_map_by_embedding(query, limit=1)[0][1] == "usage"
+    target.close()
+
+
+@pytest.mark.parametrize("tag", [b"META", b"VECS"])
+def test_corrupted_section_is_rejected(source, tmp_path, tag):
+    snapshot = bytearray(export(source))
+    snapshot[section_offset(snapshot, tag) + 1] ^= 0xFF
+
+    with pytest.raises(SnapshotError):
+        load(bytes(snapshot), tmp_path / "imported.db")
+
+
+def test_failed_import_removes_the_store(source, tmp_path, monkeypatch):
+    import main
+
+    snapshot = bytearray(export(source))
+    snapshot[section_offset(snapshot, b"VECS") + 1] ^= 0xFF
+    (tmp_path / "snapshot.bin").write_bytes(snapshot)
+    datastore = Datastore(str(tmp_path / "datastore"))
+    monkeypatch.setattr(main, "get_datastore", lambda: datastore)
+
+    result = CliRunner().invoke(
+        main.import_snapshot, [str(tmp_path / "snapshot.bin"), "imported"]
+    )
+
+    assert "Error importing store" in result.output
+    assert not datastore.check_store_exists("imported")
+    assert not (tmp_path / "datastore" / "imported").exists()
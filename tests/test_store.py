@@ -0,0 +1,108 @@
+import sqlite3
+
+from conftest import write_files
+from utils.processing import Processor
+from utils.store import Store
+
+
+def test_duplicate_content_in_one_batch(docs, store, client):
+    write_files(docs, {"old.txt": "Old."})
+    processor = Processor(str(docs), store, delay_per_request=0)
+    processor.run_build()
+
+    # The second copy reuses the content embedding of the first before either is committed
+    write_files(docs, {"a.txt": "Shared.", "b.txt": "Shared.", "old.txt": "Edited."})
+    processor.apply_changes({str(docs)})
+
+    assert store.get_failures() == []
+    assert sorted(item[2] for item in store.get_all_metadata()) == [
+        "a.txt",
+        "b.txt",
+        "old.txt",
+    ]
+    assert client.embedded.count("Shared.") == 1
+
+
+def test_search_skips_tombstoned_vectors(store, client):
+    for number in range(20):
+        store.insert_into_knowledge_base(
+            f"{number}.txt", str(number), f"Item {number}.", "text"
+        )
+    for number in range(15):
+        store.delete_item(store.get_id_from_path(f"{number}.txt"))
+
+    assert store.get_tombstone_count() == 15
+    query = store.embed_query("Item 0.")
+    results = store.search_and_map_by_embedding(query, limit=3)
+    assert len(results) == 3
+    assert all(int(title) >= 15 for _, title, _, _ in results)
+
+
+def test_search_empty_store(store, client):
+    assert store.search_and_map_by_embedding(store.embed_query("Anything")) == []
+
+
+def test_open_while_another_connection_writes(store, client):
+    store.insert_into_knowledge_base("a.txt", "a", "A.", "text")
+    store_id = store.get_meta("store_id")
+
+    writer = sqlite3.connect(store.get_name())
+    writer.execute("BEGIN")
+    writer.execute("INSERT INTO failed_items VALUES ('b.txt', 'error', 1, 0)")
+    try:
+        reader = Store(store.get_name())
+        assert reader.get_meta("store_id") == store_id
+        assert len(reader.search_and_map_by_embedding(reader.embed_query("A."))) == 1
+        reader.close()
+    finally:
+        writer.rollback()
+        writer.close()
+
+
+def insert_copies(store, prefix=""):
+    """
+    Inserts five copies of a readme under different titles, and five distinct documents.
+    """
+    for number in range(5):
+        store.insert_into_knowledge_base(
+            f"{prefix}readme-{number}.md", f"readme-{number}", "Readme.", "markdown"
+        )
+        store.insert_into_knowledge_base(
+            f"{prefix}doc-{number}.md", f"doc-{number}", f"Doc {number}.", "markdown"
+        )
+
+
+def test_collapsed_search_fills_the_limit(store, client):
+    insert_copies(store)
+
+    results = store.search_and_map_by_embedding(
+        store.embed_query("Readme."), limit=3, collapse_duplicates=True
+    )
+
+    assert len(results) == 3
+    assert [result[2] for result in results].count("Readme.") == 1
+
+
+def test_fused_ranking_fills_in_missing_distances():
+    # Item 1 only matched by title, item 3 only by content, so each gets the furthest distance
+    # seen in the column it's missing from
+    fused = Store.fuse_search_results(
+        [(1, 0.1), (2, 0.5)], [(2, 0.2), (3, 0.4)], title_weight=0.5
+    )
+
+    assert [rowid for rowid, _ in fused] == [1, 2, 3]
+    assert [round(distance, 6) for _, distance in fused] == [0.25, 0.35, 0.45]
+
+
+def test_similar_excludes_the_item_without_embedding(store, client):
+    for number in range(3):
+        store.insert_into_knowledge_base(
+            f"{number}.txt", str(number), f"Item {number}.", "text"
+        )
+    identifier = store.get_id_from_path("1.txt")
+    client.embedded = []
+
+    results = store.search_similar_to_item(identifier, limit=10)
+
+    assert client.embedded == []
+    assert sorted(row[1] for row in results) == ["0", "2"]
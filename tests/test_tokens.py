@@ -0,0 +1,37 @@
+import utils.tokens
+from utils.tokens import count_tokens, plan_inputs
+
+
+class WordEncoding:
+    """
+    Encodes each word as a token, recording the length of every text it encodes.
+    """
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text, disallowed_special=()):
+        self.encoded.append(len(text))
+        return text.split(" ")
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def test_counting_stops_past_limit(monkeypatch):
+    encoding = WordEncoding()
+    monkeypatch.setattr(utils.tokens, "get_encoding", lambda: encoding)
+    text = "word " * 100_000
+
+    assert count_tokens(text, 10) > 10
+    assert max(encoding.encoded) < 1000
+
+
+def test_truncate_only_encodes_prefix(monkeypatch):
+    encoding = WordEncoding()
+    monkeypatch.setattr(utils.tokens, "get_encoding", lambda: encoding)
+    text = " ".join(str(number) for number in range(100_000))
+
+    assert plan_inputs(text, "truncate", 5) == ["0 1 2 3 4"]
+    assert plan_inputs("0 1 2", "truncate", 5) == ["0 1 2"]
+    assert max(encoding.encoded) < 1000
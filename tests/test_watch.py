@@ -0,0 +1,73 @@
+import time
+
+from conftest import write_files
+from utils.processing import Processor
+from utils.watcher import Watcher
+
+
+def test_failed_batch_applies_other_files(docs, store, client):
+    processor = Processor(str(docs), store, delay_per_request=0)
+    processor.run_build()
+
+    generate_embedding = client.generate_embedding
+
+    def flaky(text):
+        if text == "Bad.":
+            raise RuntimeError("database is locked")
+        return generate_embedding(text)
+
+    client.generate_embedding = flaky
+    write_files(docs, {"a.txt": "Good.", "b.txt": "Bad.", "c.txt": "Also good."})
+    failed_paths = processor.apply_changes({str(docs)})
+
+    assert failed_paths == {str(docs / "b.txt")}
+    assert sorted(item[2] for item in store.get_all_metadata()) == ["a.txt", "c.txt"]
+
+
+def test_requeued_paths_are_yielded_again(docs):
+    watcher = Watcher(str(docs), poll=True, poll_interval=0.01, retry_delay=0.01)
+    try:
+        watcher.requeue({str(docs / "a.txt")})
+        assert next(watcher.watch()) == {str(docs / "a.txt")}
+    finally:
+        watcher.close()
+
+
+def test_breaker_pauses_outside_transactions(docs, store, client, monkeypatch):
+    import httpx
+    import openai
+    import utils.embeddings
+    import utils.store
+    from utils.embeddings import OpenAIClient
+
+    processor = Processor(str(docs), store, delay_per_request=0)
+    processor.run_build()
+
+    api = OpenAIClient()
+    api.breaker = utils.embeddings.CircuitBreaker(threshold=1, cooldown=0.01)
+    monkeypatch.setattr(utils.store, "get_client", lambda: api)
+    failures = {"b": 2}
+
+    def get_embedding(text):
+        if failures.get(text, 0) > 0:
+            failures[text] -= 1
+            raise openai.APIConnectionError(request=httpx.Request("POST", "http://api"))
+        return client.embed(text)
+
+    paused_in_transaction = []
+    real_sleep = time.sleep
+
+    def sleep(seconds):
+        paused_in_transaction.append(store.conn.in_transaction)
+        real_sleep(seconds)
+
+    monkeypatch.setattr(utils.embeddings, "get_embedding", get_embedding)
+    monkeypatch.setattr(utils.embeddings.time, "sleep", sleep)
+    write_files(docs, {"a.txt": "A.", "b.txt": "B.", "c.txt": "C."})
+    failed_paths = processor.apply_changes({str(docs)})
+
+    assert failed_paths == set()
+    assert sorted(item[2] for item in store.get_all_metadata()) == ["a.txt", "b.txt", "c.txt"]
+    # The files applied before the breaker opened were committed before pausing
+    assert len(paused_in_transaction) == 2
+    assert not any(paused_in_transaction)
@@ -0,0 +1,44 @@
+"""
+A module for caching search results between requests.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class ResultCache:
+    """
+    A bounded cache of search results, which evicts the least recently used entry once full.
+
+    Keys should include the version of every store that was searched, so that results are never
+    served once a store has changed, and the entries for old versions simply age out.
+    """
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def make_etag(key: Hashable) -> str:
+    """
+    Makes an ETag for a cache key, so that clients can revalidate results they already hold.
+    """
+    return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:32]
@@ -0,0 +1,110 @@
+"""
+A module for splitting documents into chunks which are embedded separately, so that long
+documents are searched passage by passage, and an edit only re-embeds the chunks it touched.
+"""
+import re
+from typing import NamedTuple
+from utils.tokens import count_tokens, split_tokens
+
+# The overlap to use when only a chunk size is given, unless the chunks are too small for it
+DEFAULT_CHUNK_OVERLAP = 64
+
+HEADING = re.compile(r"^(#{1,6})[ \t]+(.*?)[ \t#]*$")
+FENCE = re.compile(r"^[ \t]*(```|~~~)")
+PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n")
+LEADING_BLANK_LINES = re.compile(r"^(?:[ \t]*\r?\n)+")
+
+
+class Chunk(NamedTuple):
+    # The path of headings the chunk falls under, such as "Install > Linux"
+    heading: str
+    # The text which is embedded, prefixed with the heading path so a chunk keeps its context
+    text: str
+
+
+def get_default_overlap(size: int) -> int:
+    return min(DEFAULT_CHUNK_OVERLAP, size // 4)
+
+
+def split_sections(text: str) -> list[tuple[str, str]]:
+    """
+    Splits markdown into (heading path, text) sections at each heading. The heading lines
+    themselves are left out of the text, as chunks are prefixed with their heading path. Lines
+    inside code fences are never taken for headings.
+    """
+    sections = []
+    headings = []
+    lines = []
+    in_fence = False
+    for line in text.splitlines(keepends=True):
+        if FENCE.match(line):
+            in_fence = not in_fence
+        match = None if in_fence else HEADING.match(line.rstrip("\r\n"))
+        if match is not None:
+            sections.append((" > ".join(headings), "".join(lines)))
+            lines = []
+            level = len(match.group(1))
+            headings = headings[: level - 1] + [match.group(2)]
+            continue
+        lines.append(line)
+    sections.append((" > ".join(headings), "".join(lines)))
+    # Sections holding nothing but their heading are left out
+    return [
+        (heading, LEADING_BLANK_LINES.sub("", body))
+        for heading, body in sections
+        if body.strip() != ""
+    ]
+
+
+def split_units(text: str, size: int) -> list[str]:
+    """
+    Splits text into paragraphs, breaking up any paragraph longer than the chunk size.
+    """
+    units = []
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        if paragraph.strip() == "":
+            continue
+        if count_tokens(paragraph, size) > size:
+            units.extend(split_tokens(paragraph, size))
+        else:
+            units.append(paragraph)
+    return units
+
+
+def chunk_text(text: str, markdown: bool, size: int, overlap: int) -> list[Chunk]:
+    """
+    Splits a document into chunks of up to `size` tokens. Paragraphs are kept whole where they
+    fit, markdown chunks never cross a heading, and each chunk repeats up to `overlap` tokens
+    of whole paragraphs from the end of the one before it.
+
+    Chunks are cut from paragraph boundaries rather than fixed offsets, so an edit only changes
+    the chunks around it, and the rest hash the same as before.
+    """
+    sections = split_sections(text) if markdown else [("", text)]
+    chunks = []
+    for heading, section in sections:
+        units = split_units(section, size)
+        tokens = [count_tokens(unit) for unit in units]
+        start = 0
+        while start < len(units):
+            end = start + 1
+            total = tokens[start]
+            while end < len(units) and total + tokens[end] <= size:
+                total += tokens[end]
+                end += 1
+
+            body = "\n\n".join(units[start:end])
+            chunks.append(Chunk(heading, f"{heading}\n\n{body}" if heading else body))
+            if end == len(units):
+                break
+
+            # Step back over whole paragraphs for the overlap, always moving forward
+            next_start = end
+            repeated = 0
+            while next_start - 1 > start and repeated + tokens[next_start - 1] <= overlap:
+                next_start -= 1
+                repeated += tokens[next_start]
+            start = next_start
+
+    # Every document gets at least one chunk, even if it's only whitespace
+    return chunks or [Chunk("", text)]
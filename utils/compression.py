@@ -0,0 +1,79 @@
+"""
+A module for compressing item content with a dictionary trained on the store's own documents.
+
+Documents in a store tend to share a lot of boilerplate, such as front matter keys, headings
+and common phrases, which a single document is too short to compress away on its own. Priming
+zlib with a dictionary of those shared strings lets even short documents compress well.
+"""
+import zlib
+from collections import Counter
+from typing import Optional
+
+# zlib can only look back this far, so any more of a dictionary would go unused
+MAX_DICTIONARY_SIZE = 32 * 1024
+COMPRESSION_LEVEL = 9
+
+
+def train_dictionary(samples: list[str], size: int = MAX_DICTIONARY_SIZE) -> bytes:
+    """
+    Builds a compression dictionary from sample documents, out of the lines and words which
+    recur across them. zlib finds matches closer to the end of a dictionary more cheaply, so
+    the strings which save the most are placed last.
+    """
+    line_counts = Counter()
+    word_counts = Counter()
+    for sample in samples:
+        line_counts.update(
+            {line.strip() for line in sample.splitlines() if len(line.strip()) >= 4}
+        )
+        word_counts.update(word for word in sample.split() if len(word) >= 4)
+
+    # Score each string by the bytes it could save across the samples
+    candidates = [
+        (count * len(line), line) for line, count in line_counts.items() if count > 1
+    ]
+    candidates += [
+        (count * len(word), word) for word, count in word_counts.items() if count > 1
+    ]
+    candidates.sort(reverse=True)
+
+    chosen = []
+    total = 0
+    for _, text in candidates:
+        encoded = text.encode("utf-8") + b"\n"
+        if total + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        total += len(encoded)
+
+    if not chosen:
+        # Nothing recurs, so fall back to raw sample text, which still shares common words
+        return "\n".join(samples).encode("utf-8")[-size:]
+    return b"".join(reversed(chosen))
+
+
+def compress(content: str, dictionary: bytes) -> bytes:
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=dictionary)
+    return compressor.compress(content.encode("utf-8")) + compressor.flush()
+
+
+def get_dictionary_id(dictionary: bytes) -> int:
+    """
+    Gets the id zlib records in the header of data compressed with a dictionary.
+    """
+    return zlib.adler32(dictionary)
+
+
+def read_dictionary_id(data: bytes) -> Optional[int]:
+    """
+    Reads the id of the dictionary that data was compressed with from its zlib header, or None
+    if it was compressed without one.
+    """
+    if len(data) < 6 or not data[1] & 0x20:
+        return None
+    return int.from_bytes(data[2:6], "big")
+
+
+def decompress(data: bytes, dictionary: bytes) -> str:
+    decompressor = zlib.decompressobj(zdict=dictionary)
+    return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
@@ -5,8 +5,16 @@ A file to deal with utilities relating to the global datastore.
 import sqlite3
 import os
 import shutil
-from typing import Tuple
-from utils.store import Store
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import TYPE_CHECKING, Optional, Tuple, Union
+
+# The store modules pull in the embeddings and vector search stacks, so they're only imported
+# once a store is actually opened
+if TYPE_CHECKING:
+    from utils.store import Store
+    from utils.sharding import ShardedStore
 
 
 class Datastore:
@@ -14,18 +22,40 @@ class Datastore:
     A class to manage the global datastore.
     """
 
-    def __init__(self, location: str) -> None:
+    def __init__(self, location: str, readonly: bool = False) -> None:
+        """
+        A read-only datastore opens its stores read-only and keeps them open between uses,
+        reopening a store whenever its files are replaced.
+        """
+        self.location = location
+        self.readonly = readonly
+        self.db_path = os.path.join(self.location, "datastore.db")
+        self.store_cache = {}
+        # Cached stores lent out to a search thread, which no other thread may use until returned
+        self.checked_out_stores = set()
+        self.checkout_lock = threading.Lock()
+
+        if readonly:
+            self.connect()
+            return
+
         if not os.path.exists(location):
             os.makedirs(location)
 
-        self.location = location
-        self.db_path = os.path.join(self.location, "datastore.db")
         print("Database file: ", self.db_path)
-        self.conn = sqlite3.connect(self.db_path)
-        self.cursor = self.conn.cursor()
-
+        self.connect()
         self.init_if_empty()
 
+    def connect(self):
+        """
+        Opens the connection to the stores table, such as after forking.
+        """
+        if self.readonly:
+            self.conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        else:
+            self.conn = sqlite3.connect(self.db_path)
+        self.cursor = self.conn.cursor()
+
     def __enter__(self):
         return self
 
@@ -40,6 +70,8 @@ class Datastore:
         )
         if not self.cursor.fetchone():
             self.create_stores_table()
+        else:
+            self.migrate_stores_table()
 
     def reset(self):
         self.cursor.execute("DROP TABLE IF EXISTS stores")
@@ -61,44 +93,169 @@ class Datastore:
             CREATE TABLE IF NOT EXISTS stores (
                 id integer PRIMARY KEY,
                 location text NOT NULL,
-                name text NOT NULL UNIQUE
+                name text NOT NULL UNIQUE,
+                shards integer NOT NULL DEFAULT 1
             )
             """
         )
 
-    def add_new_store(self, name: str, location: str) -> None:
+    def migrate_stores_table(self):
+        """
+        Adds any columns which are missing from a stores table created by an older version.
+        """
+        self.cursor.execute("PRAGMA table_info(stores)")
+        columns = [row[1] for row in self.cursor.fetchall()]
+        if "shards" not in columns:
+            self.cursor.execute(
+                "ALTER TABLE stores ADD COLUMN shards integer NOT NULL DEFAULT 1"
+            )
+            self.conn.commit()
+
+    def add_new_store(self, name: str, location: str, shards: int = 1) -> None:
+        if shards < 1:
+            raise ValueError("A store must have at least one shard.")
+
         self.cursor.execute(
             """
-            INSERT INTO stores (name, location)
-            VALUES (?, ?)
+            INSERT INTO stores (name, location, shards)
+            VALUES (?, ?, ?)
             """,
-            (name, location),
+            (name, location, shards),
         )
         self.conn.commit()
 
+        from utils.sharding import open_store
+
         os.makedirs(os.path.join(self.location, name))
-        Store(os.path.join(self.location, name, "data.db"))
+        open_store(self.get_store_paths(name, shards)).close()
+
+    def get_store_shards(self, name: str) -> int:
+        self.cursor.execute(
+            """
+            SELECT shards FROM stores WHERE name = ?
+            """,
+            (name,),
+        )
+        row = self.cursor.fetchone()
+        return row[0] if row is not None else 1
+
+    def get_store_paths(self, name: str, shards: Optional[int] = None) -> list[str]:
+        """
+        Gets the database files which make up a store, one per shard.
+        """
+        if shards is None:
+            shards = self.get_store_shards(name)
+        if shards == 1:
+            return [os.path.join(self.location, name, "data.db")]
+        return [
+            os.path.join(self.location, name, f"shard-{i}.db") for i in range(shards)
+        ]
+
+    def get_store(self, name: str) -> Union["Store", "ShardedStore"]:
+        from utils.sharding import open_store
 
-    def get_store(self, name: str) -> Store:
         try:
-            return Store(os.path.join(self.location, name, "data.db"))
+            if self.readonly:
+                return self.get_cached_store(name)
+            return open_store(self.get_store_paths(name))
         except Exception as e:
             print(f"Error getting store {name}: {e}")
             raise e
 
-    def get_db_store(self, name: str) -> Tuple[str, str]:
+    def get_cached_store(self, name: str) -> Union["Store", "ShardedStore"]:
+        """
+        Gets an open read-only store, reopening it if its files have changed since it was opened.
+        """
+        from utils.sharding import open_store
+
+        paths = self.get_store_paths(name)
+        signature = [
+            (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            for stat in (os.stat(path) for path in paths)
+        ]
+        cached = self.store_cache.get(name)
+        if cached is not None and cached[1] == signature:
+            return cached[0]
+
+        store = open_store(paths, readonly=True)
+        with self.checkout_lock:
+            if cached is not None:
+                print(f"Store {name} changed on disk, reloading it")
+                # A store which is checked out is closed once it's returned instead
+                if cached[0] not in self.checked_out_stores:
+                    cached[0].close()
+            self.store_cache[name] = (store, signature)
+        return store
+
+    def checkout_store(self, name: str) -> Union["Store", "ShardedStore"]:
+        """
+        Gets a read-only store for a single thread to use, to be handed back with return_store
+        once the thread is done with it. The cached store is lent to one thread at a time, and
+        while it's out, such as to a search which timed out but is still running, a store of
+        the thread's own is opened instead.
+        """
+        from utils.sharding import open_store
+
+        store = self.get_cached_store(name)
+        with self.checkout_lock:
+            if store not in self.checked_out_stores:
+                self.checked_out_stores.add(store)
+                return store
+        return open_store(self.get_store_paths(name), readonly=True)
+
+    def return_store(self, store: Union["Store", "ShardedStore"]) -> None:
+        """
+        Hands back a store from checkout_store, from whichever thread used it.
+        """
+        with self.checkout_lock:
+            if store in self.checked_out_stores:
+                self.checked_out_stores.discard(store)
+                # Unless it was reloaded while it was out
+                if any(cached is store for cached, _ in self.store_cache.values()):
+                    return
+        store.close()
+
+    def get_store_version(self, name: str) -> str:
+        """
+        Gets the version of a store's contents, which changes whenever the store is written to.
+        """
+        store = self.get_store(name)
+        try:
+            return store.get_version()
+        finally:
+            if not self.readonly:
+                store.close()
+
+    def warm_up(self) -> None:
+        """
+        Opens every store and loads its index, so that it's ready before serving. Read-only
+        stores are never migrated when opened, so each is first opened for writing to bring it
+        up to the current schema. Stores which haven't been built yet are skipped.
+        """
+        from utils.sharding import open_store
+
+        for name, _, _ in self.get_all_db_stores():
+            if self.readonly:
+                open_store(self.get_store_paths(name)).close()
+            store = self.get_store(name)
+            if not store.is_built():
+                print(f"Store {name} hasn't been built yet, skipping it")
+                continue
+            store.warm_up()
+
+    def get_db_store(self, name: str) -> Tuple[str, str, int]:
         self.cursor.execute(
             """
-            SELECT name, location FROM stores WHERE name = ?
+            SELECT name, location, shards FROM stores WHERE name = ?
             """,
             (name,),
         )
         return self.cursor.fetchone()
 
-    def get_all_db_stores(self) -> list[Tuple[str, str]]:
+    def get_all_db_stores(self) -> list[Tuple[str, str, int]]:
         self.cursor.execute(
             """
-            SELECT name, location FROM stores
+            SELECT name, location, shards FROM stores
             """
         )
         return self.cursor.fetchall()
@@ -136,3 +293,124 @@ class Datastore:
             (name,),
         )
         return self.cursor.fetchone() is not None
+
+    def search_stores(
+        self,
+        names: list[str],
+        query: str,
+        search_in: str = "content",
+        limit: int = 10,
+        timeout: float = 10.0,
+        collapse_duplicates: bool = False,
+        title_weight: Optional[float] = None,
+        query_embedding: Optional[bytes] = None,
+    ) -> Tuple[list[tuple], dict[str, str]]:
+        """
+        Searches several stores at once. The query is embedded a single time, each store is
+        searched concurrently on a thread pool, and the results are merged into one global
+        top-k by distance. Stores which fail or don't answer within the timeout are skipped.
+
+        :param query_embedding: The query's embedding, if it has already been generated.
+
+        :return: The merged (store, rowid, title, content, distance) results, and a dict of
+        store names to the error which kept them out of the results.
+        """
+        from utils.store import DEFAULT_TITLE_WEIGHT, Store
+        from utils.sharding import open_store
+
+        if title_weight is None:
+            title_weight = DEFAULT_TITLE_WEIGHT
+
+        errors = {}
+        paths = {}
+        for name in names:
+            if self.check_store_exists(name):
+                paths[name] = self.get_store_paths(name)
+            else:
+                errors[name] = f"Store '{name}' does not exist."
+
+        if not paths:
+            return [], errors
+
+        if query_embedding is None:
+            query_embedding = Store.embed_query(query)
+
+        def search_one(
+            name: str, store_limit: int, checked_out: dict[str, "Store"]
+        ) -> list[tuple]:
+            # SQLite connections can't be shared across threads, so each search opens its own,
+            # or is lent a read-only store which no other thread is using
+            store = checked_out.get(name) or open_store(paths[name])
+            try:
+                return store.search_and_map_by_embedding(
+                    query_embedding,
+                    search_in=search_in,
+                    limit=store_limit,
+                    collapse_duplicates=collapse_duplicates,
+                    title_weight=title_weight,
+                )
+            finally:
+                # Only once the search has finished, even if it's already timed out
+                if name in checked_out:
+                    self.return_store(store)
+                else:
+                    store.close()
+
+        # Duplicates in different stores are only collapsed here, so while too few results are
+        # left, search again for twice as many from each store
+        store_limit = limit
+        while True:
+            # Read-only stores are checked out up front, as the datastore's own connection
+            # can't be used from the search threads
+            checked_out = {}
+            if self.readonly:
+                checked_out = {name: self.checkout_store(name) for name in paths}
+            rows_by_store = self.search_concurrently(
+                list(paths),
+                lambda name, store_limit=store_limit, checked_out=checked_out: search_one(
+                    name, store_limit, checked_out
+                ),
+                timeout,
+                errors,
+            )
+            results = [
+                (name, *row) for name, rows in rows_by_store.items() for row in rows
+            ]
+            results.sort(key=lambda row: row[4])
+            if collapse_duplicates:
+                results = Store.collapse_duplicate_results(results, content_index=3)
+
+            exhausted = all(len(rows) < store_limit for rows in rows_by_store.values())
+            if len(results) >= limit or exhausted:
+                return results[:limit], errors
+            store_limit *= 2
+            paths = {name: paths[name] for name in rows_by_store}
+
+    @staticmethod
+    def search_concurrently(
+        names: list[str], search_one, timeout: float, errors: dict[str, str]
+    ) -> dict[str, list[tuple]]:
+        """
+        Runs search_one for every store at once, getting the rows of each store which answered
+        within the timeout, and recording why any other store didn't in errors.
+        """
+        # Each store gets its own thread, so every search starts straight away, and the shared
+        # deadline is each store's own timeout, rather than being spent waiting in a queue
+        executor = ThreadPoolExecutor(max_workers=len(names))
+        futures = {name: executor.submit(search_one, name) for name in names}
+        deadline = time.monotonic() + timeout
+
+        rows_by_store = {}
+        for name, future in futures.items():
+            try:
+                remaining = max(0.0, deadline - time.monotonic())
+                rows_by_store[name] = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                errors[name] = f"Search timed out after {timeout}s."
+            except Exception as e:
+                errors[name] = str(e)
+
+        # Don't hold the caller up on stores which timed out, but let their searches run to the
+        # end rather than cancelling them, so that they always hand back their stores
+        executor.shutdown(wait=False)
+        return rows_by_store
@@ -1,15 +1,71 @@
 import openai
-from tenacity import retry, wait_random_exponential, stop_after_attempt
+from tenacity import (
+    retry,
+    retry_if_exception,
+    wait_random_exponential,
+    stop_after_attempt,
+)
 import os
+import math
+import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
+from utils.tokens import (
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_MODEL,
+    count_tokens,
+    plan_inputs,
+)
 
 load_dotenv()
 
 openai.api_key = os.environ["OPENAI_API_KEY"]
 
 
-@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
-def get_embedding(text: str, model="text-embedding-ada-002") -> list[float]:
+class PermanentEmbeddingError(Exception):
+    """
+    Raised when the embeddings API rejects an input, so retrying it will never succeed.
+    """
+
+
+class EmbeddingsUnavailableError(Exception):
+    """
+    Raised instead of pausing while the circuit breaker is open, when the caller has asked to
+    fail fast, so that it can release what it holds before waiting the pause out itself.
+    """
+
+
+def is_retryable(e: BaseException) -> bool:
+    """
+    Whether an error from the embeddings API is transient, such as a rate limit, a timeout, or
+    an outage, rather than a problem with the request itself.
+    """
+    if isinstance(e, openai.RateLimitError):
+        # Running out of quota is reported as a rate limit, but waiting won't bring it back
+        return e.code != "insufficient_quota"
+    if isinstance(e, openai.APIConnectionError):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+
+def is_permanent(e: BaseException) -> bool:
+    """
+    Whether an error from the embeddings API means the input itself can't be embedded.
+    Other non-retryable errors, such as an invalid API key, affect every input alike.
+    """
+    return isinstance(e, (openai.BadRequestError, openai.UnprocessableEntityError))
+
+
+retry_transient_errors = retry(
+    retry=retry_if_exception(is_retryable),
+    wait=wait_random_exponential(min=1, max=20),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+
+
+@retry_transient_errors
+def get_embedding(text: str, model=EMBEDDING_MODEL) -> list[float]:
     try:
         return openai.embeddings.create(input=[text], model=model).data[0].embedding
     except Exception as e:
@@ -17,14 +73,159 @@ def get_embedding(text: str, model="text-embedding-ada-002") -> list[float]:
         raise e
 
 
+@retry_transient_errors
+def get_embeddings(texts: list[str], model=EMBEDDING_MODEL) -> list[list[float]]:
+    try:
+        data = openai.embeddings.create(input=texts, model=model).data
+        return [item.embedding for item in sorted(data, key=lambda item: item.index)]
+    except Exception as e:
+        print(f"Error generating embeddings: {e}")
+        raise e
+
+
+def combine_embeddings(embeddings: list[list[float]], weights: list[int]) -> list[float]:
+    """
+    Combines the embeddings of the pieces of a text into one, by averaging them weighted by the
+    length of each piece, and normalizing the result like the model's own embeddings.
+    """
+    combined = [
+        sum(embedding[i] * weight for embedding, weight in zip(embeddings, weights))
+        for i in range(len(embeddings[0]))
+    ]
+    norm = math.sqrt(sum(value * value for value in combined)) or 1.0
+    return [value / norm for value in combined]
+
+
+class CircuitBreaker:
+    """
+    Pauses requests while the embeddings API is failing. Once a number of requests in a row
+    have failed even after retrying, the circuit opens, and requests wait out a cooldown before
+    a single request is let through to test the API. Each failed test doubles the cooldown, up
+    to a maximum, and the first success closes the circuit again.
+    """
+
+    def __init__(
+        self, threshold: int = 3, cooldown: float = 60.0, max_cooldown: float = 900.0
+    ) -> None:
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def get_remaining_cooldown(self) -> float:
+        """
+        Gets the number of seconds left before a request may be made.
+        """
+        if self.opened_at is None:
+            return 0.0
+        return max(self.opened_at + self.cooldown - time.monotonic(), 0.0)
+
+    def wait_until_ready(self) -> None:
+        """
+        Blocks until a request may be made.
+        """
+        remaining = self.get_remaining_cooldown()
+        if remaining > 0:
+            print(
+                f"Embeddings API is failing, pausing for {round(remaining)}s before trying again."
+            )
+            time.sleep(remaining)
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.cooldown = self.base_cooldown
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.opened_at is not None:
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self.opened_at = time.monotonic()
+        elif self.consecutive_failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
 class OpenAIClient:
     def __init__(self):
         self.num_requests_completed = 0
         self.num_current_requests = 0
+        self.breaker = CircuitBreaker(
+            threshold=int(os.environ.get("EMBEDDING_BREAKER_THRESHOLD", 3)),
+            cooldown=float(os.environ.get("EMBEDDING_BREAKER_COOLDOWN", 60)),
+        )
+        self.fail_fast = False
 
     def generate_embedding(self, text):
+        # Inputs over the token limit are truncated or split before they're sent, as the API
+        # would reject them outright
+        inputs = plan_inputs(text)
+
+        def request():
+            if len(inputs) == 1:
+                return get_embedding(inputs[0])
+            return combine_embeddings(
+                get_embeddings(inputs),
+                [count_tokens(piece) for piece in inputs],
+            )
+
+        return self.call_with_breaker(request)
+
+    def generate_embeddings(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embeds several short texts, such as the chunks of a document, in as few requests as
+        possible. Any text over the token limit is truncated.
+        """
+        inputs = [plan_inputs(text, "truncate")[0] for text in texts]
+        embeddings = []
+        for start in range(0, len(inputs), EMBEDDING_BATCH_SIZE):
+            batch = inputs[start : start + EMBEDDING_BATCH_SIZE]
+            embeddings.extend(self.call_with_breaker(lambda: get_embeddings(batch)))
+        return embeddings
+
+    @contextmanager
+    def failing_fast(self):
+        """
+        Within the block, requests raise an EmbeddingsUnavailableError rather than pausing while
+        the circuit breaker is open, such as so that a transaction can be committed first.
+        """
+        fail_fast = self.fail_fast
+        self.fail_fast = True
+        try:
+            yield self
+        finally:
+            self.fail_fast = fail_fast
+
+    def call_with_breaker(self, request):
+        """
+        Makes a request to the embeddings API, pausing while the circuit breaker is open.
+        """
         self.num_current_requests += 1
-        embedding = get_embedding(text)
-        self.num_current_requests -= 1
+        try:
+            while True:
+                if self.fail_fast and self.breaker.get_remaining_cooldown() > 0:
+                    raise EmbeddingsUnavailableError(
+                        "Embeddings API is failing, pausing before trying again"
+                    )
+                self.breaker.wait_until_ready()
+                try:
+                    embedding = request()
+                except Exception as e:
+                    if is_permanent(e):
+                        raise PermanentEmbeddingError(str(e)) from e
+                    if not is_retryable(e):
+                        raise e
+                    # Transient errors are retried after the breaker's pause, rather than
+                    # failing the input
+                    self.breaker.record_failure()
+                    continue
+                self.breaker.record_success()
+                break
+        finally:
+            self.num_current_requests -= 1
         self.num_requests_completed += 1
         return embedding
@@ -0,0 +1,255 @@
+"""
+A module for extracting the text to store from each type of file.
+
+Extractors stream text out of a file in blocks, so that hashing a file for a sync never holds
+the whole of it in memory, and each declares a cheap check of whether a file should be
+processed at all. New formats are supported by registering another extractor.
+"""
+import hashlib
+import os
+import re
+from abc import ABC, abstractmethod
+from html.parser import HTMLParser
+from typing import Iterator, Optional
+import frontmatter
+
+# How many characters to read from a file at a time
+READ_BLOCK_SIZE = 64 * 1024
+# Front matter longer than this is assumed not to be front matter at all
+MAX_FRONT_MATTER_SIZE = 64 * 1024
+FRONT_MATTER_DELIMITERS = ["---", "+++"]
+DEFAULT_MAX_EXTRACTED_CHARS = 10 * 1024 * 1024
+
+
+def get_max_extracted_chars() -> int:
+    """
+    Gets the most characters of text to take from a single file, or 0 for no limit. By default,
+    a file is capped well past what's embedded, so that a huge export can't exhaust memory.
+    """
+    return int(os.environ.get("MAX_EXTRACTED_CHARS", DEFAULT_MAX_EXTRACTED_CHARS))
+
+
+class ExtractionError(Exception):
+    """
+    Raised when a file's text can't be extracted as it is, such as when its front matter is
+    malformed.
+    """
+
+
+class Extractor(ABC):
+    """
+    Extracts the text of the files with the given extensions, which are stored with the given
+    type. Subclasses must implement extract, so an incomplete extractor can't be instantiated
+    to be registered.
+    """
+
+    extensions: list[str] = []
+    filetype = "text"
+
+    def should_process(self, file: str) -> bool:
+        """
+        Checks whether a file should be processed, without reading any more of it than needed.
+        """
+        return "_private" not in file
+
+    @abstractmethod
+    def extract(self, file: str) -> Iterator[str]:
+        """
+        Yields the text of a file, a block at a time.
+        """
+
+
+class TextExtractor(Extractor):
+    """
+    Extracts plain text as-is, front matter included. Files marked `private: true` in their
+    front matter are skipped, which only takes reading the front matter.
+    """
+
+    extensions = [".txt"]
+    filetype = "text"
+
+    def extract(self, file: str) -> Iterator[str]:
+        # Malformed front matter could be hiding `private: true`, so the file fails rather
+        # than being stored
+        head = self.read_front_matter(file)
+        if head is not None:
+            self.parse_front_matter(head)
+        with open(file, "r", encoding="utf-8") as f:
+            while True:
+                block = f.read(READ_BLOCK_SIZE)
+                if block == "":
+                    return
+                yield block
+
+    def should_process(self, file: str) -> bool:
+        if not super().should_process(file):
+            return False
+        try:
+            head = self.read_front_matter(file)
+            if head is None:
+                return True
+            fm = self.parse_front_matter(head)
+        except (UnicodeDecodeError, OSError, ExtractionError):
+            # Left to fail when processed, so that it's recorded with the other failures
+            return True
+        return not (fm.get("private") == "true" or fm.get("private") == True)
+
+    @staticmethod
+    def parse_front_matter(head: str) -> frontmatter.Post:
+        """
+        Parses a front matter block, raising an ExtractionError if it's malformed.
+        """
+        try:
+            return frontmatter.loads(head)
+        except Exception as e:
+            # Each front matter format has its own parser, with its own errors
+            raise ExtractionError(f"Malformed front matter: {e}") from e
+
+    @staticmethod
+    def read_front_matter(file: str) -> Optional[str]:
+        """
+        Reads the front matter block from the start of a file, or None if it has none.
+        """
+        with open(file, "r", encoding="utf-8") as f:
+            delimiter = f.readline().strip()
+            if delimiter not in FRONT_MATTER_DELIMITERS:
+                return None
+            lines = [delimiter + "\n"]
+            size = 0
+            for line in f:
+                lines.append(line)
+                if line.strip() == delimiter:
+                    return "".join(lines)
+                size += len(line)
+                if size > MAX_FRONT_MATTER_SIZE:
+                    return None
+        return None
+
+
+class MarkdownExtractor(TextExtractor):
+    extensions = [".md"]
+    filetype = "markdown"
+
+
+class HTMLTextParser(HTMLParser):
+    """
+    Collects the visible text of an HTML document as it's fed, breaking lines at block tags.
+    """
+
+    SKIPPED_TAGS = {"script", "style", "noscript", "template"}
+    BLOCK_TAGS = set(
+        "address article aside blockquote br dd div dl dt figcaption footer h1 h2 h3 h4 "
+        "h5 h6 header hr li main nav ol p pre section table td th title tr ul".split()
+    )
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.pieces = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.pieces.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.pieces.append("\n")
+
+    def handle_data(self, data):
+        if self.skip_depth == 0:
+            self.pieces.append(data)
+
+    def take_text(self) -> str:
+        """
+        Takes the text collected since the last call, with its whitespace tidied up.
+        """
+        text = "".join(self.pieces)
+        self.pieces = []
+        text = re.sub(r"[ \t\r\f\v]+", " ", text)
+        text = re.sub(r" ?\n ?", "\n", text)
+        return re.sub(r"\n{3,}", "\n\n", text)
+
+
+class HTMLExtractor(Extractor):
+    """
+    Extracts the visible text of HTML pages, leaving out their markup, scripts and styles.
+    """
+
+    extensions = [".html", ".htm"]
+    filetype = "html"
+
+    def extract(self, file: str) -> Iterator[str]:
+        parser = HTMLTextParser()
+        with open(file, "r", encoding="utf-8") as f:
+            while True:
+                block = f.read(READ_BLOCK_SIZE)
+                if block == "":
+                    break
+                parser.feed(block)
+                text = parser.take_text()
+                if text != "":
+                    yield text
+        parser.close()
+        text = parser.take_text()
+        if text != "":
+            yield text
+
+
+# Extractors by the file extension they handle
+EXTRACTORS: dict[str, Extractor] = {}
+
+
+def register_extractor(extractor: Extractor) -> None:
+    """
+    Registers an extractor for each of its extensions, replacing any already registered.
+    """
+    for extension in extractor.extensions:
+        EXTRACTORS[extension] = extractor
+
+
+def get_extractor(file: str) -> Optional[Extractor]:
+    """
+    Gets the extractor for a file, or None if there's none for its type.
+    """
+    return EXTRACTORS.get(os.path.splitext(file)[1])
+
+
+register_extractor(TextExtractor())
+register_extractor(MarkdownExtractor())
+register_extractor(HTMLExtractor())
+
+
+def extract_text(file: str) -> Iterator[str]:
+    """
+    Yields the text of a file a block at a time, up to MAX_EXTRACTED_CHARS if it's set.
+    """
+    remaining = get_max_extracted_chars() or None
+    for block in get_extractor(file).extract(file):
+        if remaining is not None:
+            block = block[:remaining]
+            remaining -= len(block)
+        yield block
+        if remaining == 0:
+            return
+
+
+def read_text(file: str) -> str:
+    """
+    Reads the whole text of a file, for storing and embedding it.
+    """
+    return "".join(extract_text(file))
+
+
+def hash_text(file: str) -> str:
+    """
+    Hashes the text of a file without holding all of it in memory. Matches
+    `Store.hash_content` of the same text, so it can be compared with stored hashes.
+    """
+    digest = hashlib.sha256()
+    for block in extract_text(file):
+        digest.update(block.encode("utf-8"))
+    return digest.hexdigest()
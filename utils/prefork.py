@@ -0,0 +1,68 @@
+"""
+A module for serving a WSGI app from a pool of pre-forked worker processes.
+"""
+import os
+import signal
+from typing import Callable, Optional
+from werkzeug.serving import make_server
+
+
+def serve_prefork(
+    app,
+    port: int,
+    workers: int,
+    host: str = "127.0.0.1",
+    after_fork: Optional[Callable[[], None]] = None,
+) -> None:
+    """
+    Binds the server socket, then forks the given number of workers which all accept connections
+    on it. Anything loaded before calling this is shared with the workers copy-on-write, so it
+    should be warmed up first. Workers which exit are replaced until the server is stopped.
+
+    :param after_fork: Called in each worker before it starts serving, to reopen anything which
+    can't be safely carried across a fork.
+    """
+    server = make_server(host, port, app)
+    children = set()
+    stopping = False
+
+    def spawn() -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                if after_fork is not None:
+                    after_fork()
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    print(f"Serving on http://{host}:{port} with {workers} workers")
+    for _ in range(workers):
+        spawn()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited, starting a new one")
+            spawn()
+
+    server.server_close()
@@ -3,15 +3,29 @@ The processing module is responsible for providing utilities which help process
 """
 from time import sleep
 import os
-import frontmatter
+from typing import Callable, Optional
 from rich.progress import track
 import click
 from utils.walker import Walker
-from utils.store import Store
-
-default_file_limit = int(os.environ["DEFAULT_FILE_LIMIT"])
-default_delay_per_request = float(os.environ["DEFAULT_DELAY_PER_REQUEST"])
-typeformat = {"txt": "text", "md": "markdown"}
+from utils.watcher import Watcher
+from utils.store import Store, get_compact_threshold
+from utils.chunking import chunk_text
+from utils.extractors import (
+    EXTRACTORS,
+    ExtractionError,
+    get_extractor,
+    hash_text,
+    read_text,
+)
+from utils.tokens import (
+    EMBEDDING_BATCH_SIZE,
+    MAX_EMBEDDING_TOKENS,
+    count_tokens,
+    estimate_cost,
+    estimate_duration,
+    get_token_policy,
+    plan_inputs,
+)
 
 
 class Processor:
@@ -24,15 +38,20 @@ class Processor:
         directory: str,
         store: Store,
         file_types_to_process: list[str] = [],
-        file_limit: int = default_file_limit,
-        delay_per_request: float = default_delay_per_request,
+        file_limit: Optional[int] = None,
+        delay_per_request: Optional[float] = None,
     ) -> None:
         self.directory = directory
         self.store = store
         if len(file_types_to_process) == 0:
-            self.file_types_to_process = [".txt", ".md"]
+            self.file_types_to_process = list(EXTRACTORS)
         else:
             self.file_types_to_process = file_types_to_process
+        # The defaults are read when processing starts, rather than when the module is imported
+        if file_limit is None:
+            file_limit = int(os.environ.get("DEFAULT_FILE_LIMIT", 200))
+        if delay_per_request is None:
+            delay_per_request = float(os.environ.get("DEFAULT_DELAY_PER_REQUEST", 30))
         self.file_limit = file_limit
         self.delay_per_request = delay_per_request
 
@@ -49,6 +68,77 @@ class Processor:
         print(f"Found {len(files_to_process)} files to process. Processing...")
         print("\n\n")
         self.process_files(files=files_to_process)
+        self.report_failures()
+
+    def estimate_build(self, chunking: Optional[tuple[int, int]] = None) -> dict:
+        """
+        Estimate the tokens, requests, cost and duration of building the store, without making
+        any calls to the embeddings API, or changing the store.
+
+        :param chunking: The (size, overlap) in tokens the build would chunk items with, or None
+        to embed them whole.
+        """
+        files = self.get_all_directory_processable_files()
+        policy = get_token_policy()
+
+        embedded_documents = set()
+        embedded_contents = set()
+        embedded_chunks = set()
+        estimate = {
+            "files": 0,
+            "inputs": 0,
+            "tokens": 0,
+            "requests": 0,
+            "over_limit": 0,
+        }
+
+        for file in files:
+            content = self.read_file(file)
+            if content == "":
+                continue
+            title = self.get_file_name_from_path(file)
+            estimate["files"] += 1
+
+            # Mirror the deduplication done on insert, where repeated content isn't re-embedded
+            content_hash = Store.hash_content(content)
+            if (title, content_hash) in embedded_documents:
+                continue
+            embedded_documents.add((title, content_hash))
+            texts = [title]
+            if content_hash not in embedded_contents and chunking is not None:
+                embedded_contents.add(content_hash)
+                # Chunks are embedded in batches, and repeated chunks only once
+                is_markdown = get_extractor(file).filetype == "markdown"
+                chunk_texts = []
+                for chunk in chunk_text(content, is_markdown, *chunking):
+                    chunk_hash = Store.hash_content(chunk.text)
+                    if chunk_hash not in embedded_chunks:
+                        embedded_chunks.add(chunk_hash)
+                        chunk_texts.append(chunk.text)
+                estimate["inputs"] += len(chunk_texts)
+                estimate["tokens"] += sum(count_tokens(text) for text in chunk_texts)
+                estimate["requests"] += -(-len(chunk_texts) // EMBEDDING_BATCH_SIZE)
+            elif content_hash not in embedded_contents:
+                embedded_contents.add(content_hash)
+                texts.append(content)
+
+            for text in texts:
+                inputs = plan_inputs(text, policy)
+                if count_tokens(text, MAX_EMBEDDING_TOKENS) > MAX_EMBEDDING_TOKENS:
+                    estimate["over_limit"] += 1
+                estimate["inputs"] += len(inputs)
+                estimate["tokens"] += sum(count_tokens(piece) for piece in inputs)
+                estimate["requests"] += 1
+
+        estimate["policy"] = policy
+        estimate["cost"] = estimate_cost(estimate["tokens"])
+        estimate["duration"] = estimate_duration(
+            estimate["requests"],
+            estimate["tokens"],
+            estimate["files"],
+            self.delay_per_request,
+        )
+        return estimate
 
     def run_sync(self):
         """
@@ -56,26 +146,261 @@ class Processor:
         """
         print(f"Running sync on store {self.store.get_name()}, {self.directory}")
         self.identify_files_out_of_sync()
+        dropped = self.store.compact(get_compact_threshold())
+        if dropped > 0:
+            click.echo(f"Compacted the store, dropping {dropped} vectors")
+        self.report_failures()
 
-    def file_is_private(self, file: str) -> bool:
+    def retry_failed(self) -> int:
         """
-        Checks if a file is private.
+        Reprocess every file which previously failed, returning how many still fail. Files which
+        no longer exist are dropped from the failures.
         """
-        if "_private" in file:
-            return True
+        failures = self.store.get_failures()
+        for path, _, _, _ in track(failures, description="[green]Retrying files"):
+            file = os.path.join(self.directory, path)
+            if not os.path.isfile(file):
+                self.store.clear_failure(path)
+                continue
+            entry = self.store.get_metadata_from_path(path)
+            if entry is None:
+                self.process_file(file)
+            else:
+                self.update_file(entry[0], file)
+        return len(self.store.get_failures())
 
-        with open(file, "r", encoding="utf-8") as f:
-            fm = frontmatter.load(f)
-            if "private" in fm and (fm["private"] == "true" or fm["private"] == True):
-                return True
-            return False
+    def report_failures(self) -> None:
+        """
+        Print a summary of the files which failed to process.
+        """
+        failures = self.store.get_failures()
+        if len(failures) == 0:
+            return
+        click.echo(f"\n{len(failures)} files failed to process:", err=True)
+        for path, error, attempts, _ in failures:
+            click.echo(f"  {path} ({attempts} attempts): {error}", err=True)
+        click.echo("Fix them, then run `store retry-failed` to process them again.", err=True)
+
+    def run_watch(
+        self,
+        watcher: Watcher,
+        batch_size: int = 20,
+        compact_threshold: Optional[float] = None,
+    ):
+        """
+        Keep the store in sync with the processing directory, applying changes as they happen.
+
+        :param compact_threshold: If given, the vector index is compacted in between changes
+        whenever more than this fraction of its vectors are tombstoned.
+        """
+        print(f"Watching {self.directory} for changes to store {self.store.get_name()}")
+        try:
+            for changed_paths in watcher.watch():
+                try:
+                    failed_paths = self.apply_changes(changed_paths, batch_size)
+                    if compact_threshold is not None:
+                        dropped = self.store.compact(compact_threshold)
+                        if dropped > 0:
+                            click.echo(f"Compacted the store, dropping {dropped} vectors")
+                except Exception as e:
+                    click.echo(f"Error applying changes: {e}", err=True)
+                    failed_paths = changed_paths
+                if failed_paths:
+                    # Otherwise they'd stay out of sync until they happened to change again
+                    click.echo(
+                        f"Retrying {len(failed_paths)} paths with the next changes", err=True
+                    )
+                    watcher.requeue(failed_paths)
+        finally:
+            watcher.close()
+
+    def apply_changes(self, changed_paths: set[str], batch_size: int = 20) -> set[str]:
+        """
+        Apply only the adds, updates, deletes and renames needed for the given changed paths,
+        in transactions of at most batch_size files. If a transaction fails, its files are
+        applied again one at a time, so one bad file doesn't hold back the rest. While the
+        embeddings API is failing, each file is committed before pausing for it.
+
+        :return: The paths of the files which still couldn't be applied.
+        """
+        new_files = []
+        updated_files = []
+        deleted_entries = {}
+
+        for file in self.expand_changed_paths(changed_paths):
+            entry = self.store.get_metadata_from_path(
+                os.path.relpath(file, self.directory)
+            )
+            try:
+                processable = os.path.isfile(file) and self.file_should_be_processed(file)
+            except OSError:
+                processable = False
+
+            if processable and entry is None:
+                new_files.append(file)
+            elif processable:
+                updated_files.append((entry, file))
+            elif entry is not None:
+                deleted_entries[entry[0]] = entry
+
+        # A file which disappeared and reappeared elsewhere with the same content was renamed.
+        # Entries only hold content hashes, so stored content never has to be read.
+        deleted_by_content = {entry[3]: entry for entry in deleted_entries.values()}
+        operations = []
+        for file in new_files:
+            entry = deleted_by_content.pop(self.try_hash_file(file), None)
+            if entry is not None:
+                del deleted_entries[entry[0]]
+                operations.append(("move", entry, file))
+            else:
+                operations.append(("add", None, file))
+        for entry, file in updated_files:
+            if self.try_hash_file(file) != entry[3]:
+                operations.append(("update", entry, file))
+        for entry in deleted_entries.values():
+            operations.append(("delete", entry, None))
+
+        if len(operations) == 0:
+            return set()
+
+        click.echo(
+            ", ".join(
+                f"{sum(1 for op in operations if op[0] == kind)} {kind}"
+                for kind in ["add", "update", "move", "delete"]
+            )
+        )
+        # Only imported once there are changes, so that estimating doesn't need an API key
+        from utils.embeddings import EmbeddingsUnavailableError
+        from utils.store import get_client
+
+        client = get_client()
+        failed_paths = set()
+        pending = operations
+        # The number of pending operations left to apply one at a time, after a failed batch
+        alone = 0
+        with client.failing_fast():
+            while pending:
+                # The embeddings API's pauses are waited out in between transactions, so the
+                # write lock is never held through one, and while it's failing each file is
+                # committed on its own
+                client.breaker.wait_until_ready()
+                size = 1 if alone > 0 or client.breaker.is_open() else batch_size
+                batch = pending[:size]
+                applied = 0
+                try:
+                    with self.store.batch():
+                        for operation in batch:
+                            try:
+                                self.apply_operation(*operation)
+                            except EmbeddingsUnavailableError:
+                                # Only this operation was rolled back, so the ones before it
+                                # are committed
+                                break
+                            applied += 1
+                except Exception as e:
+                    if len(batch) > 1:
+                        click.echo(
+                            f"Error applying changes ({e}), applying them one at a time",
+                            err=True,
+                        )
+                        alone = len(batch)
+                        continue
+                    click.echo(f"Error applying changes: {e}", err=True)
+                    failed_paths.update(self.get_operation_paths(*batch[0]))
+                    applied = 1
+                pending = pending[applied:]
+                alone = max(alone - applied, 0)
+        return failed_paths
+
+    def apply_operation(self, kind: str, entry: Optional[tuple], file: Optional[str]) -> None:
+        """
+        Apply a single add, update, move or delete planned by apply_changes.
+        """
+        if kind == "add":
+            self.process_file(file)
+        elif kind == "update":
+            self.update_file(entry[0], file)
+        elif kind == "move":
+            self.run_recording_failures(
+                file,
+                lambda: self.store.move_item(
+                    identifier=entry[0],
+                    path=os.path.relpath(file, self.directory),
+                    title=self.get_file_name_from_path(file),
+                ),
+            )
+        else:
+            self.store.delete_item(entry[0])
+
+    def get_operation_paths(
+        self, kind: str, entry: Optional[tuple], file: Optional[str]
+    ) -> list[str]:
+        """
+        Get the paths an operation planned by apply_changes was applied for.
+        """
+        paths = [file] if file is not None else []
+        if entry is not None and kind != "update":
+            paths.append(os.path.join(self.directory, entry[2]))
+        return paths
+
+    def expand_changed_paths(self, changed_paths: set[str]) -> set[str]:
+        """
+        Expand changed directories into the files beneath them, both on disk and in the store,
+        so that files removed along with their directory are caught as well.
+        """
+        files = set()
+        stored_paths = None
+        for path in changed_paths:
+            if os.path.isfile(path):
+                files.add(path)
+                continue
+            if os.path.isdir(path):
+                files.update(Walker(path).walk_files())
+
+            if stored_paths is None:
+                stored_paths = [item[2] for item in self.store.get_all_metadata()]
+            prefix = os.path.relpath(path, self.directory)
+            for stored_path in stored_paths:
+                if prefix == "." or stored_path == prefix or stored_path.startswith(
+                    prefix + os.sep
+                ):
+                    files.add(os.path.join(self.directory, stored_path))
+
+        return files
+
+    @staticmethod
+    def read_file(file: str) -> str:
+        """
+        Read the text of a file, as extracted for its type.
+        """
+        return read_text(file)
+
+    @staticmethod
+    def try_hash_file(file: str) -> Optional[str]:
+        """
+        Hash the text of a file, or None if it isn't valid UTF-8 or can't be extracted. The file is
+        streamed, so large files are never held in memory.
+        """
+        try:
+            return hash_text(file)
+        except (UnicodeDecodeError, OSError, ExtractionError):
+            return None
+
+    def file_should_be_processed(self, file: str) -> bool:
+        """
+        Checks if a file is the right type to process, and if its extractor accepts it, such as
+        it not being private.
+        """
+        return self.file_is_type_to_process(file) and get_extractor(file).should_process(
+            file
+        )
 
     def file_is_type_to_process(self, file: str) -> bool:
         """
-        Checks if a file is the right type to process.
+        Checks if a file is the right type to process, and has an extractor for its type.
         """
         file_type = os.path.splitext(file)[1]
-        if file_type in self.file_types_to_process:
+        if file_type in self.file_types_to_process and get_extractor(file) is not None:
             return True
         return False
 
@@ -87,10 +412,9 @@ class Processor:
 
         for file in self.walker.walk_files():
             if len(new_files) >= self.file_limit:
-                return
-            if self.file_is_private(file):
-                continue
-            if not self.file_is_type_to_process(file):
+                break
+            # The type is checked first, so that files of other types are never opened
+            if not self.file_should_be_processed(file):
                 continue
             new_files.append(file)
 
@@ -108,25 +432,70 @@ class Processor:
         """
         Process an individual file, inserting it into the datastore.
         """
-        file_type = os.path.splitext(file)[1]
-        formatted_type = typeformat[file_type[1:]]
+        formatted_type = get_extractor(file).filetype
         formatted_path = os.path.relpath(file, self.directory)
         formatted_title = self.get_file_name_from_path(file)
 
-        with open(file, "r", encoding="utf-8") as f:
-            content = f.read()
+        def insert():
+            content = self.read_file(file)
             if content == "":
                 return
-            try:
-                self.store.insert_into_knowledge_base(
-                    path=formatted_path,
-                    title=formatted_title,
-                    content=content,
-                    filetype=formatted_type,
-                )
-            except Exception as e:
+            self.store.insert_into_knowledge_base(
+                path=formatted_path,
+                title=formatted_title,
+                content=content,
+                filetype=formatted_type,
+            )
+
+        self.run_recording_failures(file, insert)
+
+    def update_file(self, identifier: int, file: str) -> None:
+        """
+        Update the stored item with the given id from its file on disk.
+        """
+        self.run_recording_failures(
+            file,
+            lambda: self.store.update_item(
+                identifier=identifier,
+                title=self.get_file_name_from_path(file),
+                content=self.read_file(file),
+            ),
+        )
+
+    def run_recording_failures(self, file: str, action: Callable[[], None]) -> bool:
+        """
+        Run an action which processes the given file. If the file fails for a reason which
+        retrying won't fix, anything it wrote is rolled back, the failure is recorded in the
+        store and processing carries on, otherwise the error is raised. Returns whether the
+        action succeeded.
+        """
+        path = os.path.relpath(file, self.directory)
+        try:
+            with self.store.savepoint():
+                action()
+        except Exception as e:
+            if not self.is_permanent_failure(e):
                 print(f"Error processing file {file}: {e}")
                 raise e
+            click.echo(f"Skipping file {file}: {e}", err=True)
+            self.store.record_failure(path, f"{type(e).__name__}: {e}")
+            return False
+        self.store.clear_failure(path)
+        return True
+
+    @staticmethod
+    def is_permanent_failure(e: Exception) -> bool:
+        """
+        Whether a file failed for a reason which retrying won't fix until the file changes, such
+        as being rejected by the embeddings API, not being valid UTF-8, having malformed front
+        matter, or not being readable, including having been deleted since it was listed.
+        """
+        # Only imported once something has failed, so that estimating doesn't need an API key
+        from utils.embeddings import PermanentEmbeddingError
+
+        return isinstance(
+            e, (PermanentEmbeddingError, UnicodeDecodeError, OSError, ExtractionError)
+        )
 
     def identify_files_out_of_sync(self):
         """
@@ -147,7 +516,7 @@ class Processor:
         if len(deleted_files) > 0:
             click.echo("Deleting files...")
             for file in track(deleted_files, description="[green]Deleting files"):
-                db_file = self.store.get_entry_from_path(file[2])
+                db_file = self.store.get_metadata_from_path(file[2])
                 self.store.delete_item(db_file[0])
 
         if len(new_files) > 0:
@@ -158,17 +527,9 @@ class Processor:
         if len(updated_files) > 0:
             click.echo("Updating files...")
             for file in track(updated_files, description="[green]Updating files"):
-                path = file[2]
-                identifier = file[0]
-                full_path = os.path.join(self.directory, path)
+                full_path = os.path.join(self.directory, file[2])
                 print(f"Full path: {full_path}")
-                with open(full_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-                    self.store.update_item(
-                        identifier=identifier,
-                        title=self.get_file_name_from_path(path),
-                        content=content,
-                    )
+                self.update_file(file[0], full_path)
 
     def identify_new_files(self):
         """
@@ -193,7 +554,9 @@ class Processor:
         - File exists in datastore but not on disk
         """
         processable_files = self.get_all_directory_processable_files()
-        db_files = [(item[0], item[1], item[2]) for item in self.store.get_all()]
+        db_files = [
+            (item[0], item[1], item[2]) for item in self.store.get_all_metadata()
+        ]
 
         deleted_files = []
 
@@ -210,20 +573,22 @@ class Processor:
         Identify files which meet the following criteria:
         - File exists in datastore and on disk
         - File content in datastore does not match file content on disk
+        Only content hashes are compared, so stored content is never read.
         """
-        db_files = self.store.get_all()
+        db_files = self.store.get_all_metadata()
 
         updated_files = []
 
         for file in db_files:
             filepath = os.path.join(self.directory, file[2])
             try:
-                with open(filepath, "r", encoding="utf-8") as f:
-                    content = f.read()
-                    if content != file[3]:
-                        updated_files.append(file)
+                if hash_text(filepath) != file[3]:
+                    updated_files.append(file)
             except FileNotFoundError:
                 continue
+            except (UnicodeDecodeError, OSError, ExtractionError):
+                # Updated so that the failure is recorded
+                updated_files.append(file)
 
         return updated_files
 
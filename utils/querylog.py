@@ -0,0 +1,87 @@
+"""
+A module for capturing the searches a server receives as JSONL, so they can be replayed later.
+"""
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+from typing import Optional
+
+
+class QueryLog:
+    """
+    Appends a sample of search requests to a JSONL file from a background thread, so that
+    logging never holds up a response. If the writer falls behind, entries are dropped rather
+    than queued without limit.
+    """
+
+    def __init__(self, path: str, sample_rate: float = 1.0, max_pending: int = 10000) -> None:
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_pending = max_pending
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    @staticmethod
+    def from_env() -> Optional["QueryLog"]:
+        """
+        Gets the query log configured by QUERY_LOG_PATH, or None if query logging is off.
+        """
+        path = os.environ.get("QUERY_LOG_PATH")
+        if not path:
+            return None
+        return QueryLog(path, float(os.environ.get("QUERY_LOG_SAMPLE_RATE", 1.0)))
+
+    def record(self, entry: dict) -> None:
+        """
+        Queues an entry to be written, if it's sampled.
+        """
+        if random.random() >= self.sample_rate:
+            return
+        self.start()
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            pass
+
+    def start(self) -> None:
+        """
+        Starts the writer thread, or restarts it in a forked worker, which doesn't inherit it.
+        """
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.max_pending)
+            self.thread = threading.Thread(target=self.write_entries, daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def write_entries(self) -> None:
+        entries = self.queue
+        # Each line goes out in a single append, so workers sharing the file don't interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            while True:
+                entry = entries.get()
+                if entry is None:
+                    return
+                os.write(fd, (json.dumps(entry) + "\n").encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    def close(self) -> None:
+        """
+        Writes out any queued entries and stops the writer thread.
+        """
+        if self.pid != os.getpid():
+            return
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+        self.pid = None
@@ -0,0 +1,164 @@
+"""
+A module for replaying captured query logs against a store, to compare latency and results
+with those seen when the queries were first served.
+"""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+from utils.store import Store
+
+REPLAYABLE_ENDPOINTS = ["search", "similar"]
+
+
+def load_query_log(path: str, from_store: Optional[str] = None) -> tuple[list[dict], int]:
+    """
+    Reads the entries of a query log which can be replayed against a single store.
+
+    :param from_store: Only keep the queries which were made against this store.
+    :return: The entries, and the number of entries which were skipped.
+    """
+    entries = []
+    skipped = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            entry = json.loads(line)
+            if entry.get("endpoint") not in REPLAYABLE_ENDPOINTS or (
+                from_store is not None and entry.get("store") != from_store
+            ):
+                skipped += 1
+                continue
+            entries.append(entry)
+    return entries, skipped
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """
+    Gets the nearest-rank percentile of some values, or 0 if there are none.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def summarize_latencies(latencies: list[float]) -> dict:
+    return {
+        "p50": percentile(latencies, 0.5),
+        "p90": percentile(latencies, 0.9),
+        "p99": percentile(latencies, 0.99),
+        "max": max(latencies, default=0.0),
+    }
+
+
+def replay_queries(
+    open_store: Callable[[], Store],
+    entries: list[dict],
+    rate: float = 0.0,
+    concurrency: int = 4,
+) -> dict:
+    """
+    Re-issues logged queries against a store, and reports how their latency and results
+    compare with the log.
+
+    Queries are embedded up front, once per distinct query, so only the search itself is timed
+    and repeated queries don't cost repeated API calls. With a rate, queries are sent on a fixed
+    schedule and latency is measured from when each was due, so time spent queued behind slow
+    queries counts against them, as it would for real traffic.
+
+    :param open_store: Opens the store to replay against, called once per worker thread.
+    :param rate: The number of queries per second to send, or 0 to send them as fast as possible.
+    """
+    embeddings = {}
+    for entry in entries:
+        if entry["endpoint"] == "search" and entry["query"] not in embeddings:
+            embeddings[entry["query"]] = Store.embed_query(entry["query"])
+
+    local = threading.local()
+    stores = []
+    stores_lock = threading.Lock()
+
+    def get_store():
+        if not hasattr(local, "store"):
+            local.store = open_store()
+            with stores_lock:
+                stores.append(local.store)
+        return local.store
+
+    def run(entry: dict, due: float):
+        store = get_store()
+        start = max(due, time.perf_counter())
+        try:
+            if entry["endpoint"] == "search":
+                results = store.search_and_map_by_embedding(
+                    embeddings[entry["query"]],
+                    search_in=entry["column"],
+                    limit=entry["limit"],
+                    collapse_duplicates=entry["collapse"],
+                    title_weight=entry["title_weight"],
+                )
+            else:
+                results = store.search_similar_to_item(
+                    entry["identifier"],
+                    search_in=entry["column"],
+                    limit=entry["limit"],
+                    collapse_duplicates=entry["collapse"],
+                    title_weight=entry["title_weight"],
+                )
+        except Exception as e:
+            return None, str(e)
+        latency = (time.perf_counter() - (due if rate > 0 else start)) * 1000
+        return latency, [result[0] for result in results]
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    started = time.perf_counter()
+    futures = []
+    for i, entry in enumerate(entries):
+        due = started + i / rate if rate > 0 else started
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        futures.append((entry, executor.submit(run, entry, due)))
+
+    latencies = []
+    errors = 0
+    differing = 0
+    overlaps = []
+    for entry, future in futures:
+        latency, result_ids = future.result()
+        if latency is None:
+            errors += 1
+            continue
+        latencies.append(latency)
+        logged_ids = entry.get("result_ids", [])
+        if result_ids != logged_ids:
+            differing += 1
+        overlaps.append(
+            len(set(result_ids) & set(logged_ids)) / len(logged_ids) if logged_ids else 1.0
+        )
+    duration = time.perf_counter() - started
+
+    executor.shutdown()
+    for store in stores:
+        store.close()
+
+    # Cached responses never searched, so they say nothing about search latency
+    logged_latencies = [
+        entry["timings_ms"]["search"]
+        for entry in entries
+        if not entry.get("cached") and "search" in entry.get("timings_ms", {})
+    ]
+    replayed = len(latencies)
+    return {
+        "queries": len(entries),
+        "errors": errors,
+        "duration": duration,
+        "throughput": replayed / duration if duration > 0 else 0.0,
+        "latency_ms": summarize_latencies(latencies),
+        "logged_latency_ms": summarize_latencies(logged_latencies),
+        "diff_rate": differing / replayed if replayed else 0.0,
+        "mean_overlap": sum(overlaps) / len(overlaps) if overlaps else 0.0,
+    }
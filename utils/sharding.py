@@ -0,0 +1,396 @@
+"""
+A module for stores which are horizontally split across multiple SQLite files.
+"""
+import heapq
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from itertools import islice
+from typing import Optional
+from utils.store import DEFAULT_TITLE_WEIGHT, Store
+
+
+def open_store(paths: list[str], readonly: bool = False):
+    """
+    Opens the store made up of the given database files, sharding it if there is more than one.
+    """
+    if len(paths) == 1:
+        return Store(paths[0], readonly=readonly)
+    return ShardedStore(paths, readonly=readonly)
+
+
+class ShardedStore:
+    """
+    A store which is spread over multiple shard databases, each with its own vss index.
+
+    Items are routed to a shard by a stable hash of their path, and searches are scattered
+    across every shard in parallel before the results are merged by distance. Item ids are
+    global, encoding both the shard and the id of the row within that shard, so that they
+    can be used anywhere a plain `Store` id is expected.
+    """
+
+    def __init__(self, shard_paths: list[str], readonly: bool = False) -> None:
+        self.shard_paths = shard_paths
+        self.num_shards = len(shard_paths)
+        # Each shard connection is only ever used by one search thread at a time
+        self.shards = [
+            Store(path, check_same_thread=False, readonly=readonly)
+            for path in self.shard_paths
+        ]
+        self.executor = ThreadPoolExecutor(max_workers=self.num_shards)
+
+    def get_name(self):
+        return os.path.dirname(self.shard_paths[0])
+
+    def is_built(self) -> bool:
+        return all(shard.is_built() for shard in self.shards)
+
+    def warm_up(self):
+        for shard in self.shards:
+            shard.warm_up()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for shard in self.shards:
+            shard.close()
+
+    @contextmanager
+    def batch(self):
+        """
+        Groups every write made inside the block into a single transaction per shard.
+        """
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.batch())
+            yield self
+
+    @contextmanager
+    def savepoint(self):
+        """
+        Rolls back the writes made inside the block on every shard if it raises.
+        """
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.savepoint())
+            yield self
+
+    def shard_for_path(self, path: str) -> int:
+        """
+        Gets the index of the shard which owns the given path.
+        """
+        return zlib.crc32(path.encode("utf-8")) % self.num_shards
+
+    def to_global_id(self, shard_index: int, identifier: int) -> int:
+        """
+        Converts the id of a row within a shard to a store-wide id.
+        """
+        return identifier * self.num_shards + shard_index
+
+    def from_global_id(self, identifier: int) -> tuple[int, int]:
+        """
+        Converts a store-wide id to the shard index and the id of the row within that shard.
+        """
+        return identifier % self.num_shards, identifier // self.num_shards
+
+    def globalize_rows(self, shard_index: int, rows: list[tuple]) -> list[tuple]:
+        """
+        Replaces the shard-local ids at the start of each row with store-wide ids.
+        """
+        return [(self.to_global_id(shard_index, row[0]), *row[1:]) for row in rows]
+
+    def reset_db(self):
+        for shard in self.shards:
+            shard.reset_db()
+
+    def get_generation(self) -> int:
+        """
+        Gets the generation of the store, which goes up every time an item in any shard changes.
+        """
+        return sum(shard.get_generation() for shard in self.shards)
+
+    def get_version(self) -> str:
+        return ":".join(shard.get_version() for shard in self.shards)
+
+    def create_knowledge_base_table(self):
+        for shard in self.shards:
+            shard.create_knowledge_base_table()
+
+    def create_vss_table(self):
+        for shard in self.shards:
+            shard.create_vss_table()
+
+    def insert_into_knowledge_base(self, path, title, content, filetype):
+        """
+        Insert a new item into the shard which owns its path.
+        """
+        self.shards[self.shard_for_path(path)].insert_into_knowledge_base(
+            path, title, content, filetype
+        )
+
+    def load_items(
+        self, items: list[tuple], title_embedding: bytes, content_embedding: bytes
+    ) -> None:
+        """
+        Insert items which share the given embeddings, each into the shard which owns its path.
+        """
+        items_by_shard = {}
+        for item in items:
+            items_by_shard.setdefault(self.shard_for_path(item[0]), []).append(item)
+        for shard_index, shard_items in items_by_shard.items():
+            self.shards[shard_index].load_items(
+                shard_items, title_embedding, content_embedding
+            )
+
+    def search_and_map_similar_items(
+        self,
+        query: str,
+        search_in="content",
+        limit=10,
+        collapse_duplicates=False,
+        title_weight=DEFAULT_TITLE_WEIGHT,
+    ):
+        """
+        Search every shard for items similar to the given query.
+        """
+        query_embedding = Store.embed_query(query)
+
+        return self.search_and_map_by_embedding(
+            query_embedding, search_in, limit, collapse_duplicates, title_weight
+        )
+
+    def search_and_map_by_embedding(
+        self,
+        query_embedding: bytes,
+        search_in="content",
+        limit=10,
+        collapse_duplicates=False,
+        title_weight=DEFAULT_TITLE_WEIGHT,
+        title_query_embedding: Optional[bytes] = None,
+        exclude_id: Optional[int] = None,
+    ):
+        """
+        Scatter a search across all shards in parallel, then gather the per-shard results
+        with a k-way merge into a single top-k by distance.
+        """
+        # Make room for the excluded item, which would otherwise take up a result
+        shard_limit = limit + 1 if exclude_id is not None else limit
+
+        # Duplicates on different shards are only collapsed here, so while too few results are
+        # left, search again for twice as many from each shard
+        while True:
+            futures = [
+                self.executor.submit(
+                    shard.search_and_map_by_embedding,
+                    query_embedding,
+                    search_in,
+                    shard_limit,
+                    collapse_duplicates,
+                    title_weight,
+                    title_query_embedding,
+                )
+                for shard in self.shards
+            ]
+            shard_results = [
+                self.globalize_rows(shard_index, future.result())
+                for shard_index, future in enumerate(futures)
+            ]
+
+            results = heapq.merge(*shard_results, key=lambda row: row[3])
+            if exclude_id is not None:
+                results = (row for row in results if row[0] != exclude_id)
+            if collapse_duplicates:
+                results = Store.collapse_duplicate_results(list(results))
+            results = list(islice(results, limit))
+
+            exhausted = all(len(rows) < shard_limit for rows in shard_results)
+            if len(results) >= limit or exhausted:
+                return results
+            shard_limit *= 2
+
+    def search_similar_to_item(
+        self,
+        identifier: int,
+        search_in="content",
+        limit=10,
+        collapse_duplicates=False,
+        title_weight=DEFAULT_TITLE_WEIGHT,
+    ):
+        """
+        Search every shard for items similar to the item with the given id, using its stored
+        vector. The item itself is left out of the results.
+        """
+        shard_index, local_id = self.from_global_id(identifier)
+        try:
+            title_embedding, content_embedding = self.shards[
+                shard_index
+            ].get_item_vector(local_id)
+        except ValueError:
+            raise ValueError(f"No item with id {identifier}")
+
+        return self.search_and_map_by_embedding(
+            content_embedding,
+            search_in,
+            limit,
+            collapse_duplicates,
+            title_weight,
+            title_query_embedding=title_embedding,
+            exclude_id=identifier,
+        )
+
+    def get_vector_counts(self) -> tuple[int, int]:
+        """
+        Gets the number of live and tombstoned vectors, across all shards.
+        """
+        counts = [shard.get_vector_counts() for shard in self.shards]
+        return sum(live for live, _ in counts), sum(dead for _, dead in counts)
+
+    def compact(self, threshold: Optional[float] = None) -> int:
+        """
+        Rebuilds the vector index of each shard whose tombstones are over the threshold, or of
+        every shard if no threshold is given.
+        """
+        return sum(shard.compact(threshold) for shard in self.shards)
+
+    def record_failure(self, path: str, error: str) -> None:
+        self.shards[self.shard_for_path(path)].record_failure(path, error)
+
+    def clear_failure(self, path: str) -> None:
+        self.shards[self.shard_for_path(path)].clear_failure(path)
+
+    def get_failures(self):
+        """
+        Get every file which failed to process, across all shards.
+        """
+        failures = []
+        for shard in self.shards:
+            failures.extend(shard.get_failures())
+        return sorted(failures)
+
+    def get_all_titles(self):
+        """
+        Gets all of the titles in the knowledge base, across all shards.
+        """
+        titles = []
+        for shard in self.shards:
+            titles.extend(shard.get_all_titles())
+        return titles
+
+    def get_all(self):
+        """
+        Get all items in the knowledge base, across all shards.
+        """
+        items = []
+        for shard_index, shard in enumerate(self.shards):
+            items.extend(self.globalize_rows(shard_index, shard.get_all()))
+        return items
+
+    def get_all_metadata(self):
+        """
+        Get the metadata and content hashes of all items, across all shards.
+        """
+        items = []
+        for shard_index, shard in enumerate(self.shards):
+            items.extend(self.globalize_rows(shard_index, shard.get_all_metadata()))
+        return items
+
+    def get_by_id(self, identifier):
+        """
+        Get the item with the given id.
+        """
+        shard_index, local_id = self.from_global_id(identifier)
+        item = self.shards[shard_index].get_by_id(local_id)
+        if item is None:
+            return None
+        return self.globalize_rows(shard_index, [item])[0]
+
+    def update_item(self, identifier: int, title: str, content: str):
+        """
+        Update the item with the given id, title, and content.
+        """
+        shard_index, local_id = self.from_global_id(identifier)
+        self.shards[shard_index].update_item(local_id, title, content)
+
+    def move_item(self, identifier: int, path: str, title: str):
+        """
+        Move the item with the given id to a new path and title. If the new path belongs to
+        another shard, the item is re-inserted there instead.
+        """
+        shard_index, local_id = self.from_global_id(identifier)
+        if self.shard_for_path(path) == shard_index:
+            self.shards[shard_index].move_item(local_id, path, title)
+            return
+
+        item = self.shards[shard_index].get_by_id(local_id)
+        self.shards[shard_index].delete_item(local_id)
+        self.insert_into_knowledge_base(path, title, item[3], item[4])
+
+    def delete_item(self, identifier: int):
+        """
+        Delete the item with the given id.
+        """
+        shard_index, local_id = self.from_global_id(identifier)
+        self.shards[shard_index].delete_item(local_id)
+
+    def get_id_from_title(self, title):
+        """
+        Get the id of the item with the given title.
+        """
+        for shard_index, shard in enumerate(self.shards):
+            shard.cursor.execute(
+                """
+                SELECT id FROM knowledge_base
+                WHERE title = ?
+                """,
+                (title,),
+            )
+            row = shard.cursor.fetchone()
+            if row is not None:
+                return self.to_global_id(shard_index, row[0])
+        raise ValueError(f"No item with title {title}")
+
+    def get_id_from_path(self, path):
+        """
+        Get the id of the item with the given path.
+        """
+        shard_index = self.shard_for_path(path)
+        return self.to_global_id(
+            shard_index, self.shards[shard_index].get_id_from_path(path)
+        )
+
+    def get_entry_from_path(self, path):
+        """
+        Get the entry with the given path.
+        """
+        shard_index = self.shard_for_path(path)
+        entry = self.shards[shard_index].get_entry_from_path(path)
+        if entry is None:
+            return None
+        return self.globalize_rows(shard_index, [entry])[0]
+
+    def get_metadata_from_path(self, path):
+        """
+        Get the metadata and content hash of the item with the given path.
+        """
+        shard_index = self.shard_for_path(path)
+        entry = self.shards[shard_index].get_metadata_from_path(path)
+        if entry is None:
+            return None
+        return self.globalize_rows(shard_index, [entry])[0]
+
+    def get_chunking(self) -> Optional[tuple[int, int]]:
+        return self.shards[0].get_chunking()
+
+    def set_chunking(self, size: int, overlap: int = 0) -> None:
+        for shard in self.shards:
+            shard.set_chunking(size, overlap)
+
+    def set_compression(self, enabled: bool) -> tuple[int, int]:
+        """
+        Turns content compression on or off for every shard, each with its own dictionary.
+        """
+        sizes = [shard.set_compression(enabled) for shard in self.shards]
+        return sum(before for before, _ in sizes), sum(after for _, after in sizes)
+
+    embed_query = staticmethod(Store.embed_query)
+    get_content_summary = staticmethod(Store.get_content_summary)
@@ -0,0 +1,233 @@
+"""
+A module for exporting stores to, and importing them from, compact binary snapshots.
+
+A snapshot is a stream of sections, each written as a 4 byte tag, an 8 byte payload length,
+the payload, and the sha256 of the payload:
+
+- HEAD: JSON describing the snapshot (version, vector format, dimensions, counts, location)
+- META: zlib compressed JSON with one list per column of item metadata
+- TEXT: zlib compressed JSON list of item contents
+- VECS: every vector's title and content embedding, back to back, as float32 or int8
+
+Vectors are written and read in order, so neither side has to hold the whole block in memory,
+and importing never calls the embeddings API.
+"""
+import array
+import hashlib
+import json
+import struct
+import time
+import zlib
+from typing import BinaryIO, Iterator, Union
+from utils.store import Store
+from utils.sharding import ShardedStore
+
+MAGIC = b"SVSSNAP1"
+VERSION = 1
+DIMENSIONS = 1536
+SECTION_HEADER = struct.Struct("<4sQ")
+VECTORS_PER_CHUNK = 256
+
+
+class SnapshotError(ValueError):
+    """
+    Raised when a snapshot is malformed or fails its checksums.
+    """
+
+
+def get_shards(store: Union[Store, ShardedStore]) -> list[Store]:
+    if isinstance(store, ShardedStore):
+        return store.shards
+    return [store]
+
+
+def quantize(vector: bytes) -> bytes:
+    """
+    Quantizes a float32 vector to int8, prefixed with the float32 scale needed to restore it.
+    """
+    values = array.array("f")
+    values.frombytes(vector)
+    scale = max((abs(v) for v in values), default=0.0) / 127 or 1.0
+    quantized = array.array("b", (round(v / scale) for v in values))
+    return struct.pack("<f", scale) + quantized.tobytes()
+
+
+def dequantize(data: bytes) -> bytes:
+    """
+    Restores an int8 vector written by `quantize` to float32.
+    """
+    (scale,) = struct.unpack_from("<f", data)
+    quantized = array.array("b")
+    quantized.frombytes(data[4:])
+    return array.array("f", (v * scale for v in quantized)).tobytes()
+
+
+def vector_size(vector_format: str) -> int:
+    if vector_format == "int8":
+        return 4 + DIMENSIONS
+    return 4 * DIMENSIONS
+
+
+def write_section(f: BinaryIO, tag: bytes, payload: bytes) -> None:
+    f.write(SECTION_HEADER.pack(tag, len(payload)))
+    f.write(payload)
+    f.write(hashlib.sha256(payload).digest())
+
+
+def read_section(f: BinaryIO, expected_tag: bytes) -> bytes:
+    length = read_section_header(f, expected_tag)
+    payload = f.read(length)
+    if len(payload) != length:
+        raise SnapshotError(f"Snapshot ends in the middle of section {expected_tag}")
+    verify_checksum(f, hashlib.sha256(payload), expected_tag)
+    return payload
+
+
+def read_section_header(f: BinaryIO, expected_tag: bytes) -> int:
+    header = f.read(SECTION_HEADER.size)
+    if len(header) != SECTION_HEADER.size:
+        raise SnapshotError(f"Snapshot is missing section {expected_tag}")
+    tag, length = SECTION_HEADER.unpack(header)
+    if tag != expected_tag:
+        raise SnapshotError(f"Expected section {expected_tag}, found {tag}")
+    return length
+
+
+def verify_checksum(f: BinaryIO, digest, tag: bytes) -> None:
+    if f.read(32) != digest.digest():
+        raise SnapshotError(f"Checksum mismatch in section {tag}")
+
+
+def export_store(
+    store: Union[Store, ShardedStore],
+    f: BinaryIO,
+    location: str,
+    vector_format: str = "float32",
+) -> tuple[int, int]:
+    """
+    Writes a snapshot of the store to the given binary file.
+
+    :param location: The source directory of the store, recorded for imports.
+    :param vector_format: "float32" for exact vectors, or "int8" for quantized ones.
+    :return: The number of items and vectors written.
+    """
+    if vector_format not in ["float32", "int8"]:
+        raise ValueError("Invalid vector format, must be either 'float32' or 'int8'")
+
+    # Vector ids are only unique within a shard, so renumber them across the snapshot
+    columns = {"path": [], "title": [], "type": [], "content_hash": [], "vector": []}
+    contents = []
+    vector_keys = {}
+    for shard_index, shard in enumerate(get_shards(store)):
+        for path, title, content, filetype, content_hash, vector_id in shard.get_export_rows():
+            key = (shard_index, vector_id)
+            if key not in vector_keys:
+                vector_keys[key] = len(vector_keys)
+            columns["path"].append(path)
+            columns["title"].append(title)
+            columns["type"].append(filetype)
+            columns["content_hash"].append(content_hash)
+            columns["vector"].append(vector_keys[key])
+            contents.append(content)
+
+    head = {
+        "version": VERSION,
+        "vector_format": vector_format,
+        "dimensions": DIMENSIONS,
+        "items": len(contents),
+        "vectors": len(vector_keys),
+        "location": location,
+        "created": time.time(),
+    }
+
+    f.write(MAGIC)
+    write_section(f, b"HEAD", json.dumps(head).encode("utf-8"))
+    write_section(f, b"META", zlib.compress(json.dumps(columns).encode("utf-8")))
+    write_section(f, b"TEXT", zlib.compress(json.dumps(contents).encode("utf-8")))
+
+    # Stream the vector block, as it's by far the largest section
+    shards = get_shards(store)
+    f.write(
+        SECTION_HEADER.pack(b"VECS", len(vector_keys) * 2 * vector_size(vector_format))
+    )
+    digest = hashlib.sha256()
+    for shard_index, vector_id in vector_keys:
+        for vector in shards[shard_index].get_vector(vector_id):
+            data = quantize(vector) if vector_format == "int8" else vector
+            digest.update(data)
+            f.write(data)
+    f.write(digest.digest())
+
+    return len(contents), len(vector_keys)
+
+
+def read_vectors(
+    f: BinaryIO, count: int, vector_format: str
+) -> Iterator[tuple[bytes, bytes]]:
+    """
+    Streams the (title, content) embedding pairs out of a snapshot's vector block, verifying its
+    checksum once the block has been read.
+    """
+    size = vector_size(vector_format)
+    length = read_section_header(f, b"VECS")
+    if length != count * 2 * size:
+        raise SnapshotError("Vector block doesn't match the number of vectors")
+
+    digest = hashlib.sha256()
+    for _ in range(count):
+        pair = f.read(2 * size)
+        if len(pair) != 2 * size:
+            raise SnapshotError("Snapshot ends in the middle of the vector block")
+        digest.update(pair)
+        title, content = pair[:size], pair[size:]
+        if vector_format == "int8":
+            title, content = dequantize(title), dequantize(content)
+        yield title, content
+    verify_checksum(f, digest, b"VECS")
+
+
+def read_head(f: BinaryIO) -> dict:
+    """
+    Reads the header of a snapshot, describing its contents.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise SnapshotError("Not a store snapshot")
+    head = json.loads(read_section(f, b"HEAD"))
+    if head["version"] != VERSION:
+        raise SnapshotError(f"Unsupported snapshot version {head['version']}")
+    if head["dimensions"] != DIMENSIONS:
+        raise SnapshotError(f"Unsupported vector dimensions {head['dimensions']}")
+    return head
+
+
+def import_store(
+    store: Union[Store, ShardedStore], f: BinaryIO, head: dict
+) -> tuple[int, int]:
+    """
+    Bulk loads a snapshot into an empty store, without generating any embeddings. Expects the
+    header to have already been read with `read_head`.
+
+    :return: The number of items and vectors loaded.
+    """
+    columns = json.loads(zlib.decompress(read_section(f, b"META")))
+    contents = json.loads(zlib.decompress(read_section(f, b"TEXT")))
+
+    items_by_vector = [[] for _ in range(head["vectors"])]
+    for i, content in enumerate(contents):
+        items_by_vector[columns["vector"][i]].append(
+            (columns["path"][i], columns["title"][i], content, columns["type"][i])
+        )
+
+    store.reset_db()
+    vectors = read_vectors(f, head["vectors"], head["vector_format"])
+    for start in range(0, head["vectors"], VECTORS_PER_CHUNK):
+        with store.batch():
+            for items in items_by_vector[start : start + VECTORS_PER_CHUNK]:
+                title_embedding, content_embedding = next(vectors)
+                store.load_items(items, title_embedding, content_embedding)
+
+    # Make sure the trailing checksum of the vector block is verified
+    for _ in vectors:
+        pass
+
+    return len(contents), head["vectors"]
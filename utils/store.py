@@ -1,31 +1,256 @@
 import sqlite3
-from utils.embeddings import OpenAIClient
+import hashlib
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Optional
 import sqlite_vss
 import array
+from utils.chunking import chunk_text
+from utils.compression import (
+    compress,
+    decompress,
+    get_dictionary_id,
+    read_dictionary_id,
+    train_dictionary,
+)
+from utils.tokens import count_tokens
 
-opc = OpenAIClient()
+
+# When searching both columns, how much the title counts towards the fused distance
+DEFAULT_TITLE_WEIGHT = 0.3
+# When searching both columns, how many candidates to fetch from each, as a multiple of the limit
+FUSED_CANDIDATES = 3
+# How many documents to sample when training a store's compression dictionary
+DICTIONARY_SAMPLES = 2000
+# How many items to recompress per statement when turning compression on or off
+RECOMPRESS_CHUNK = 500
+# When searching chunks, how many to fetch, as a multiple of the limit, as one item's chunks
+# often take several of the closest places
+CHUNK_CANDIDATES = 5
+
+# Each vector index, with its tombstones, its columns, the table whose rows reference its
+# vectors, and the meta key holding its next free vector id
+VECTOR_INDEXES = {
+    "vss_knowledge_base": {
+        "tombstones": "vss_tombstones",
+        "columns": ["title_embedding", "content_embedding"],
+        "references": "knowledge_base",
+        "next_id_key": "next_vector_id",
+    },
+    "vss_chunks": {
+        "tombstones": "vss_chunk_tombstones",
+        "columns": ["content_embedding"],
+        "references": "chunks",
+        "next_id_key": "next_chunk_vector_id",
+    },
+}
+
+
+def get_compact_threshold() -> float:
+    """
+    Gets the fraction of tombstoned vectors above which a store's vector index is rebuilt.
+    """
+    return float(os.environ.get("COMPACT_TOMBSTONE_RATIO", 0.2))
+
+
+def get_mmap_size() -> int:
+    """
+    Gets the number of bytes of each read-only store to memory map.
+    """
+    return int(os.environ.get("SERVER_MMAP_SIZE", 1024 * 1024 * 1024))
+
+
+@lru_cache(maxsize=None)
+def get_client():
+    """
+    Gets the shared embeddings client, only importing the embeddings stack once it's needed.
+    """
+    from utils.embeddings import OpenAIClient
+
+    return OpenAIClient()
 
 
 class Store:
-    def __init__(self, db_name):
+    def __init__(self, db_name, check_same_thread=True, readonly=False):
         self.db_name = db_name
-        self.conn = sqlite3.connect(db_name)
+        self.readonly = readonly
+        if readonly:
+            # Immutable connections skip locking entirely, and can be shared between threads
+            # and inherited by forked processes, as nothing is ever written through them
+            self.conn = sqlite3.connect(
+                f"file:{db_name}?mode=ro&immutable=1",
+                uri=True,
+                check_same_thread=False,
+            )
+        else:
+            self.conn = sqlite3.connect(db_name, check_same_thread=check_same_thread)
         self.conn.enable_load_extension(True)
         self.cursor = self.conn.cursor()
         sqlite_vss.load(self.conn)
+        self.batch_depth = 0
+        # Vectors written in the open transaction, by index and vector id. sqlite-vss only adds
+        # vectors to its index on commit, so until then they can't be read back from it.
+        self.uncommitted_vectors = {}
+        # The last dictionary content was compressed or decompressed with, and its id, as None
+        # when the store's content isn't compressed
+        self.content_dictionary = None
+        self.content_dictionary_id = None
+        if readonly:
+            self.cursor.execute(f"PRAGMA mmap_size = {get_mmap_size()}")
+        else:
+            self.migrate()
 
     def get_name(self):
         return self.db_name
 
+    def is_built(self) -> bool:
+        """
+        Whether the store's tables have been created, which only happens once it's built.
+        """
+        self.cursor.execute(
+            """
+            SELECT count(*) FROM sqlite_master
+            WHERE name IN ('knowledge_base', 'vss_knowledge_base', 'store_meta')
+            """
+        )
+        return self.cursor.fetchone()[0] == 3
+
+    def warm_up(self):
+        """
+        Loads the vector index and reads through the knowledge base, so that their pages are
+        resident before the store is used, or shared with forked processes.
+        """
+        self.cursor.execute("SELECT 1 FROM vss_knowledge_base LIMIT 1")
+        self.cursor.fetchall()
+        if self.get_chunking() is not None:
+            self.cursor.execute("SELECT 1 FROM vss_chunks LIMIT 1")
+            self.cursor.fetchall()
+        self.cursor.execute("SELECT count(*), sum(length(content)) FROM knowledge_base")
+        self.cursor.fetchall()
+
+    def close(self):
+        self.conn.close()
+
+    def commit(self):
+        """
+        Commits the current transaction, unless a batch is open, in which case the batch commits it.
+        """
+        if self.batch_depth == 0:
+            self.conn.commit()
+            self.uncommitted_vectors = {}
+
+    @contextmanager
+    def batch(self):
+        """
+        Groups every write made inside the block into a single transaction.
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        except Exception:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.conn.rollback()
+                self.uncommitted_vectors = {}
+            raise
+        self.batch_depth -= 1
+        if self.batch_depth == 0:
+            self.conn.commit()
+            self.uncommitted_vectors = {}
+
+    @contextmanager
+    def savepoint(self):
+        """
+        Rolls back the writes made inside the block if it raises, keeping the rest of the open
+        transaction. sqlite-vss doesn't roll its indexes back to a savepoint, so vectors added
+        inside the block still reach them on commit. Those are tombstoned, and their ids are
+        never given out again.
+        """
+        with self.batch():
+            if not self.conn.in_transaction:
+                self.cursor.execute("BEGIN")
+            uncommitted_vectors = dict(self.uncommitted_vectors)
+            self.cursor.execute("SAVEPOINT store_savepoint")
+            try:
+                yield self
+            except Exception:
+                next_ids = {
+                    config["next_id_key"]: self.get_meta(config["next_id_key"])
+                    for config in VECTOR_INDEXES.values()
+                }
+                self.cursor.execute("ROLLBACK TO store_savepoint")
+                self.cursor.execute("RELEASE store_savepoint")
+                for key, next_id in next_ids.items():
+                    if next_id is not None:
+                        self.set_meta(key, next_id)
+                for index, vector_id in self.uncommitted_vectors.keys() - uncommitted_vectors:
+                    self.cursor.execute(
+                        f"""
+                        INSERT OR IGNORE INTO {VECTOR_INDEXES[index]['tombstones']} (rowid)
+                        VALUES (?)
+                        """,
+                        (vector_id,),
+                    )
+                self.uncommitted_vectors = uncommitted_vectors
+                raise
+            self.cursor.execute("RELEASE store_savepoint")
+
+    def migrate(self):
+        """
+        Brings a knowledge base created by an older version up to the current schema.
+        """
+        self.cursor.execute(
+            """
+            SELECT name FROM sqlite_master WHERE type='table' AND name='knowledge_base'
+            """
+        )
+        if self.cursor.fetchone() is None:
+            return
+
+        self.cursor.execute("PRAGMA table_info(knowledge_base)")
+        columns = [row[1] for row in self.cursor.fetchall()]
+        if "vector_id" not in columns:
+            self.cursor.execute("ALTER TABLE knowledge_base ADD COLUMN content_hash TEXT")
+            self.cursor.execute("ALTER TABLE knowledge_base ADD COLUMN vector_id INTEGER")
+            # Older stores keyed the vector search table by the item id
+            self.cursor.execute("UPDATE knowledge_base SET vector_id = id")
+            self.cursor.execute("SELECT id, content FROM knowledge_base")
+            for identifier, content in self.cursor.fetchall():
+                self.cursor.execute(
+                    "UPDATE knowledge_base SET content_hash = ? WHERE id = ?",
+                    (Store.hash_content(content), identifier),
+                )
+            self.create_knowledge_base_indexes()
+        self.create_meta_table()
+        self.create_failed_items_table()
+        self.create_tombstones_table()
+        self.create_chunk_tables()
+        self.conn.commit()
+
     def reset_db(self):
         self.cursor.execute("DROP TABLE IF EXISTS knowledge_base")
         self.cursor.execute("DROP TABLE IF EXISTS vss_knowledge_base")
+        self.cursor.execute("DROP TABLE IF EXISTS failed_items")
+        self.cursor.execute("DROP TABLE IF EXISTS vss_tombstones")
+        self.cursor.execute("DROP TABLE IF EXISTS chunks")
+        self.cursor.execute("DROP TABLE IF EXISTS vss_chunks")
+        self.cursor.execute("DROP TABLE IF EXISTS vss_chunk_tombstones")
         self.create_knowledge_base_table()
         self.create_vss_table()
+        self.create_meta_table()
+        self.create_failed_items_table()
+        self.create_tombstones_table()
+        self.create_chunk_tables()
+        self.bump_generation()
+        self.commit()
 
     def create_knowledge_base_table(self):
         """
-        Creates the knowledge base table.
+        Creates the knowledge base table. Items with identical content share a row in the
+        vector search table, referenced by their vector_id.
         """
         self.cursor.execute(
             """
@@ -34,38 +259,664 @@ class Store:
                 path TEXT NOT NULL UNIQUE,
                 title TEXT NOT NULL,
                 content TEXT NOT NULL,
-                type TEXT NOT NULL DEFAULT 'txt'
+                type TEXT NOT NULL DEFAULT 'txt',
+                content_hash TEXT,
+                vector_id INTEGER
             )
             """
         )
+        self.create_knowledge_base_indexes()
 
-    def insert_into_knowledge_base(self, path, title, content, filetype):
+    def create_knowledge_base_indexes(self):
+        self.cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS knowledge_base_content_hash
+            ON knowledge_base (content_hash)
+            """
+        )
+        self.cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS knowledge_base_vector_id
+            ON knowledge_base (vector_id)
+            """
+        )
+
+    def create_meta_table(self):
         """
-        Insert a new item into the knowledge base.
+        Creates the table holding store-wide values, such as the next free vector id, and the
+        random id which tells this store apart from any other created under the same name.
+        """
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS store_meta (
+                key TEXT PRIMARY KEY,
+                value
+            )
+            """
+        )
+        # Only written when missing, so that opening a store never waits on another's writes
+        if self.get_meta("store_id") is None:
+            self.set_meta("store_id", uuid.uuid4().hex)
+
+    def create_failed_items_table(self):
+        """
+        Creates the table of files which couldn't be processed, so they can be retried later
+        without holding up the rest of a build or sync.
+        """
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS failed_items (
+                path TEXT PRIMARY KEY,
+                error TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 1,
+                last_attempt REAL NOT NULL
+            )
+            """
+        )
+
+    def create_tombstones_table(self):
+        """
+        Creates the table of vectors which no item references anymore. Deleting from the vector
+        index is expensive and fragments it, so vectors are only marked dead here, filtered out
+        of searches, and dropped in bulk when the store is compacted.
+        """
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS vss_tombstones (
+                rowid INTEGER PRIMARY KEY
+            )
+            """
+        )
+
+    def create_chunk_tables(self):
+        """
+        Creates the tables for chunked stores: the chunks of each item, their own vector index,
+        and its tombstones. Chunks with identical text share a vector, like items do.
+        """
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                item_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                heading TEXT NOT NULL DEFAULT '',
+                content_hash TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                vector_id INTEGER NOT NULL
+            )
+            """
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS chunks_item_id ON chunks (item_id)"
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS chunks_content_hash ON chunks (content_hash)"
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS chunks_vector_id ON chunks (vector_id)"
+        )
+        self.create_vss_chunks_table()
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS vss_chunk_tombstones (
+                rowid INTEGER PRIMARY KEY
+            )
+            """
+        )
+
+    def create_vss_chunks_table(self):
+        self.cursor.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS vss_chunks USING vss0(
+                content_embedding(1536)
+            );
+            """
+        )
+
+    def create_vector_index(self, index: str):
+        if index == "vss_chunks":
+            self.create_vss_chunks_table()
+        else:
+            self.create_vss_table()
+
+    def record_failure(self, path: str, error: str) -> None:
+        """
+        Records that the file at the given path failed to process, counting repeated attempts.
+        """
+        self.cursor.execute(
+            """
+            INSERT INTO failed_items (path, error, attempts, last_attempt) VALUES (?, ?, 1, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                error = excluded.error,
+                attempts = attempts + 1,
+                last_attempt = excluded.last_attempt
+            """,
+            (path, error, time.time()),
+        )
+        self.commit()
+
+    def clear_failure(self, path: str) -> None:
+        self.cursor.execute("DELETE FROM failed_items WHERE path = ?", (path,))
+        self.commit()
+
+    def get_failures(self):
+        """
+        Get the (path, error, attempts, last_attempt) of every file which failed to process.
+        """
+        self.cursor.execute(
+            """
+            SELECT path, error, attempts, last_attempt FROM failed_items
+            ORDER BY path
+            """
+        )
+        return self.cursor.fetchall()
+
+    def get_meta(self, key: str, default=None):
+        self.cursor.execute("SELECT value FROM store_meta WHERE key = ?", (key,))
+        row = self.cursor.fetchone()
+        return row[0] if row is not None else default
+
+    def set_meta(self, key: str, value) -> None:
+        self.cursor.execute(
+            """
+            INSERT INTO store_meta (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            """,
+            (key, value),
+        )
+
+    def get_generation(self) -> int:
+        """
+        Gets the generation of the store, which goes up every time its items change.
+        """
+        return self.get_meta("generation", 0)
+
+    def bump_generation(self) -> None:
+        self.set_meta("generation", self.get_generation() + 1)
+
+    def get_version(self) -> str:
+        """
+        Gets a string which identifies the current contents of the store, for caching results.
+        """
+        return f"{self.get_meta('store_id')}-{self.get_generation()}"
+
+    def get_chunking(self) -> Optional[tuple[int, int]]:
+        """
+        Gets the (size, overlap) in tokens that items are chunked with, or None if the store
+        embeds each item whole.
+        """
+        size = self.get_meta("chunk_size")
+        if not size:
+            return None
+        return size, self.get_meta("chunk_overlap", 0)
+
+    def set_chunking(self, size: int, overlap: int = 0) -> None:
+        """
+        Sets the chunk size and overlap in tokens, or turns chunking off with a size of 0. Items
+        which are already stored keep their chunks, so the store should be rebuilt afterwards.
+        """
+        Store.validate_chunking(size, overlap)
+        self.create_meta_table()
+        self.set_meta("chunk_size", size)
+        self.set_meta("chunk_overlap", overlap)
+        # Searches are answered from a different index, so cached results are stale
+        self.bump_generation()
+        self.commit()
+
+    @staticmethod
+    def validate_chunking(size: int, overlap: int) -> None:
+        """
+        Raises a ValueError if the chunk size and overlap can't be used together.
+        """
+        if size < 0 or overlap < 0:
+            raise ValueError("Chunk size and overlap can't be negative")
+        if size > 0 and overlap >= size:
+            raise ValueError("Chunk overlap must be smaller than the chunk size")
+
+    def get_content_dictionary(self) -> Optional[bytes]:
+        """
+        Gets the dictionary which new content is compressed with, or None if compression is off.
+        It's read again every time, as another process may have turned compression on or off,
+        or retrained it, since the store was opened.
+        """
+        self.content_dictionary = self.get_meta("content_dictionary")
+        self.content_dictionary_id = (
+            get_dictionary_id(self.content_dictionary)
+            if self.content_dictionary is not None
+            else None
+        )
+        return self.content_dictionary
+
+    def encode_content(self, content: str):
+        """
+        Converts content to the form it's stored in, compressed if compression is on. Called
+        from within write transactions, so the dictionary can't change before they commit.
+        """
+        dictionary = self.get_content_dictionary()
+        if dictionary is None:
+            return content
+        return compress(content, dictionary)
+
+    def decode_content(self, value) -> str:
+        """
+        Converts stored content back to text. Content stored before compression was turned on
+        is still plain text, so only blobs are decompressed. The dictionary is kept between
+        calls, and only read again when a blob's header names a different one.
+        """
+        if isinstance(value, str):
+            return value
+        if read_dictionary_id(value) != self.content_dictionary_id:
+            self.get_content_dictionary()
+        return decompress(value, self.content_dictionary)
+
+    def decode_rows(self, rows: list[tuple], content_index: int) -> list[tuple]:
+        """
+        Decodes the stored content at the given index of each row.
+        """
+        return [
+            (
+                *row[:content_index],
+                self.decode_content(row[content_index]),
+                *row[content_index + 1 :],
+            )
+            for row in rows
+        ]
+
+    def set_compression(self, enabled: bool) -> tuple[int, int]:
+        """
+        Turns content compression on or off, recompressing every item. Turning it on trains a
+        new dictionary from a sample of the store's content.
+
+        :return: The total size of the stored content before and after, in bytes.
+        """
+        self.cursor.execute("SELECT COALESCE(SUM(length(content)), 0) FROM knowledge_base")
+        size_before = self.cursor.fetchone()[0]
+
+        self.cursor.execute(
+            "SELECT content FROM knowledge_base ORDER BY random() LIMIT ?",
+            (DICTIONARY_SAMPLES,),
+        )
+        samples = [self.decode_content(row[0]) for row in self.cursor.fetchall()]
+        new_dictionary = train_dictionary(samples) if enabled else None
+
+        self.conn.commit()
+        # The write lock is taken straight away, so no item can be written with the old
+        # dictionary while the rest are recompressed
+        self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            self.cursor.execute("SELECT id FROM knowledge_base")
+            identifiers = [row[0] for row in self.cursor.fetchall()]
+            for start in range(0, len(identifiers), RECOMPRESS_CHUNK):
+                chunk = identifiers[start : start + RECOMPRESS_CHUNK]
+                self.cursor.execute(
+                    f"""
+                    SELECT id, content FROM knowledge_base
+                    WHERE id IN ({','.join('?' for _ in chunk)})
+                    """,
+                    chunk,
+                )
+                updates = []
+                for identifier, value in self.cursor.fetchall():
+                    content = self.decode_content(value)
+                    if new_dictionary is not None:
+                        content = compress(content, new_dictionary)
+                    updates.append((content, identifier))
+                self.cursor.executemany(
+                    "UPDATE knowledge_base SET content = ? WHERE id = ?", updates
+                )
+            if new_dictionary is None:
+                self.cursor.execute("DELETE FROM store_meta WHERE key = 'content_dictionary'")
+            else:
+                self.set_meta("content_dictionary", new_dictionary)
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        self.get_content_dictionary()
+
+        # Give the freed pages back to the filesystem
+        self.cursor.execute("VACUUM")
+        self.cursor.execute("SELECT COALESCE(SUM(length(content)), 0) FROM knowledge_base")
+        return size_before, self.cursor.fetchone()[0]
+
+    def allocate_vector_id(self, index: str = "vss_knowledge_base") -> int:
+        """
+        Gets a vector id which has never been used in the given vector index.
+        """
+        config = VECTOR_INDEXES[index]
+        next_vector_id = self.get_meta(config["next_id_key"])
+        if next_vector_id is None:
+            self.cursor.execute(
+                f"SELECT COALESCE(MAX(vector_id), 0) + 1 FROM {config['references']}"
+            )
+            next_vector_id = self.cursor.fetchone()[0]
+        self.set_meta(config["next_id_key"], next_vector_id + 1)
+        return next_vector_id
+
+    def prepare_chunks(self, content: str, filetype: str) -> list[tuple]:
+        """
+        Splits content into chunks and gets a vector for each. A chunk whose text is already in
+        the store reuses that vector, so after an edit only the changed chunks are embedded, all
+        in as few requests as possible.
+
+        :return: A (heading, content_hash, tokens, vector_id) tuple per chunk, in order.
+        """
+        size, overlap = self.get_chunking()
+        chunks = chunk_text(content, filetype == "markdown", size, overlap)
+        hashes = [Store.hash_content(chunk.text) for chunk in chunks]
+
+        vector_ids = {}
+        missing = {}
+        for chunk, content_hash in zip(chunks, hashes):
+            if content_hash in vector_ids or content_hash in missing:
+                continue
+            self.cursor.execute(
+                "SELECT vector_id FROM chunks WHERE content_hash = ? LIMIT 1",
+                (content_hash,),
+            )
+            row = self.cursor.fetchone()
+            if row is not None:
+                vector_ids[content_hash] = row[0]
+            else:
+                missing[content_hash] = chunk.text
+
+        if missing:
+            embeddings = get_client().generate_embeddings(list(missing.values()))
+            for content_hash, embedding in zip(missing, embeddings):
+                vector_id = self.allocate_vector_id("vss_chunks")
+                embedding_binary = array.array("f", embedding).tobytes()
+                self.cursor.execute(
+                    "INSERT INTO vss_chunks (rowid, content_embedding) VALUES (?, ?)",
+                    (vector_id, embedding_binary),
+                )
+                self.uncommitted_vectors[("vss_chunks", vector_id)] = (embedding_binary,)
+                vector_ids[content_hash] = vector_id
+
+        return [
+            (chunk.heading, content_hash, count_tokens(chunk.text), vector_ids[content_hash])
+            for chunk, content_hash in zip(chunks, hashes)
+        ]
+
+    def combine_chunk_vectors(self, chunks: list[tuple]) -> bytes:
+        """
+        Combines the embeddings of an item's chunks, weighted by their length, into a single
+        content embedding for the item, so item-level searches work without another request.
+        Chunks embedded in the open transaction are taken from memory, as only committed ones
+        can be read back from the index.
         """
+        from utils.embeddings import combine_embeddings
+
+        embeddings = {}
+        committed = []
+        for vector_id in {chunk[3] for chunk in chunks}:
+            uncommitted = self.uncommitted_vectors.get(("vss_chunks", vector_id))
+            if uncommitted is not None:
+                embeddings[vector_id] = array.array("f", uncommitted[0]).tolist()
+            else:
+                committed.append(vector_id)
+        if committed:
+            self.cursor.execute(
+                f"""
+                SELECT rowid, content_embedding FROM vss_chunks
+                WHERE rowid IN ({','.join('?' for _ in committed)})
+                """,
+                committed,
+            )
+            embeddings.update(
+                (rowid, array.array("f", embedding).tolist())
+                for rowid, embedding in self.cursor.fetchall()
+            )
+        combined = combine_embeddings(
+            [embeddings[chunk[3]] for chunk in chunks], [chunk[2] for chunk in chunks]
+        )
+        return array.array("f", combined).tobytes()
+
+    def replace_chunks(self, identifier: int, chunks: list[tuple]) -> None:
+        """
+        Replaces the chunks of an item, tombstoning any chunk vectors left unreferenced.
+        """
+        self.cursor.execute(
+            "SELECT DISTINCT vector_id FROM chunks WHERE item_id = ?", (identifier,)
+        )
+        old_vector_ids = [row[0] for row in self.cursor.fetchall()]
+        self.cursor.execute("DELETE FROM chunks WHERE item_id = ?", (identifier,))
+        self.cursor.executemany(
+            """
+            INSERT INTO chunks (item_id, position, heading, content_hash, tokens, vector_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [(identifier, position, *chunk) for position, chunk in enumerate(chunks)],
+        )
+        for vector_id in old_vector_ids:
+            self.release_vector(vector_id, "vss_chunks")
+
+    def get_or_create_vector(
+        self,
+        title: str,
+        content_hash: str,
+        content: str,
+        chunks: Optional[list[tuple]] = None,
+    ) -> int:
+        """
+        Gets the id of a vector for the given title and content. An item with the same title and
+        content shares its vector outright, and an item with only the same content lends its
+        content embedding, so that only the title has to be embedded. In a chunked store, the
+        content embedding is combined from the item's chunks.
+        """
+        self.cursor.execute(
+            """
+            SELECT vector_id FROM knowledge_base
+            WHERE content_hash = ? AND title = ?
+            LIMIT 1
+            """,
+            (content_hash, title),
+        )
+        row = self.cursor.fetchone()
+        if row is not None:
+            return row[0]
+
+        content_embedding_binary = None
         self.cursor.execute(
             """
-            INSERT INTO knowledge_base (path, title, content, type)
-            VALUES (?, ?, ?, ?)
+            SELECT vector_id FROM knowledge_base
+            WHERE content_hash = ?
+            LIMIT 1
             """,
-            (path, title, content, filetype),
+            (content_hash,),
         )
+        row = self.cursor.fetchone()
+        if row is not None:
+            content_embedding_binary = self.get_vector(row[0])[1]
 
         title_embedding_binary = array.array(
-            "f", opc.generate_embedding(title)
-        ).tobytes()
-        content_embedding_binary = array.array(
-            "f", opc.generate_embedding(content)
+            "f", get_client().generate_embedding(title)
         ).tobytes()
+        if content_embedding_binary is None and chunks is not None:
+            content_embedding_binary = self.combine_chunk_vectors(chunks)
+        if content_embedding_binary is None:
+            content_embedding_binary = array.array(
+                "f", get_client().generate_embedding(content)
+            ).tobytes()
 
+        vector_id = self.allocate_vector_id()
         self.cursor.execute(
             """
             INSERT INTO vss_knowledge_base (rowid, title_embedding, content_embedding)
-            VALUES (last_insert_rowid(), ?, ?)
+            VALUES (?, ?, ?)
+            """,
+            (vector_id, title_embedding_binary, content_embedding_binary),
+        )
+        self.uncommitted_vectors[("vss_knowledge_base", vector_id)] = (
+            title_embedding_binary,
+            content_embedding_binary,
+        )
+        return vector_id
+
+    def load_items(
+        self, items: list[tuple], title_embedding: bytes, content_embedding: bytes
+    ) -> None:
+        """
+        Insert (path, title, content, filetype) items which all share the given, already
+        generated, embeddings. Used to bulk load stores without calling the embeddings API.
+        """
+        # Not kept in memory until commit like other new vectors, as imports load a whole
+        # snapshot in one transaction, and never read its vectors back while loading
+        vector_id = self.allocate_vector_id()
+        self.cursor.execute(
+            """
+            INSERT INTO vss_knowledge_base (rowid, title_embedding, content_embedding)
+            VALUES (?, ?, ?)
+            """,
+            (vector_id, title_embedding, content_embedding),
+        )
+        self.cursor.executemany(
+            """
+            INSERT INTO knowledge_base (path, title, content, type, content_hash, vector_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    path,
+                    title,
+                    self.encode_content(content),
+                    filetype,
+                    Store.hash_content(content),
+                    vector_id,
+                )
+                for path, title, content, filetype in items
+            ],
+        )
+        self.bump_generation()
+        self.commit()
+
+    def get_vector(self, vector_id: int) -> tuple[bytes, bytes]:
+        """
+        Gets the stored title and content embeddings of a vector. A vector inserted in the open
+        transaction isn't in the index yet, so it's taken from memory instead.
+        """
+        uncommitted = self.uncommitted_vectors.get(("vss_knowledge_base", vector_id))
+        if uncommitted is not None:
+            return uncommitted
+        self.cursor.execute(
+            """
+            SELECT title_embedding, content_embedding FROM vss_knowledge_base
+            WHERE rowid = ?
             """,
-            (title_embedding_binary, content_embedding_binary),
+            (vector_id,),
+        )
+        return self.cursor.fetchone()
+
+    def release_vector(self, vector_id: int, index: str = "vss_knowledge_base") -> None:
+        """
+        Tombstones a vector once nothing references it anymore.
+        """
+        config = VECTOR_INDEXES[index]
+        self.cursor.execute(
+            f"SELECT 1 FROM {config['references']} WHERE vector_id = ? LIMIT 1",
+            (vector_id,),
         )
+        if self.cursor.fetchone() is None:
+            self.cursor.execute(
+                f"""
+                INSERT OR IGNORE INTO {config['tombstones']} (rowid)
+                VALUES (?)
+                """,
+                (vector_id,),
+            )
+
+    def get_tombstone_count(self, index: str = "vss_knowledge_base") -> int:
+        self.cursor.execute(f"SELECT count(*) FROM {VECTOR_INDEXES[index]['tombstones']}")
+        return self.cursor.fetchone()[0]
+
+    def get_vector_counts(self) -> tuple[int, int]:
+        """
+        Gets the number of live and tombstoned vectors across the vector indexes.
+        """
+        live = 0
+        tombstoned = 0
+        for index, config in VECTOR_INDEXES.items():
+            self.cursor.execute(
+                f"SELECT count(DISTINCT vector_id) FROM {config['references']}"
+            )
+            live += self.cursor.fetchone()[0]
+            tombstoned += self.get_tombstone_count(index)
+        return live, tombstoned
+
+    def compact(self, threshold: Optional[float] = None) -> int:
+        """
+        Rebuilds the vector indexes from only the live vectors, dropping every tombstoned one.
+
+        :param threshold: Only compact if more than this fraction of the vectors are tombstoned.
+        :return: The number of vectors dropped.
+        """
+        live, tombstoned = self.get_vector_counts()
+        if tombstoned == 0:
+            return 0
+        if threshold is not None and tombstoned / (live + tombstoned) <= threshold:
+            return 0
+
+        self.conn.commit()
+        self.cursor.execute("BEGIN")
+        try:
+            for index, config in VECTOR_INDEXES.items():
+                if self.get_tombstone_count(index) == 0:
+                    continue
+                columns = ", ".join(config["columns"])
+                # Only vectors that are still referenced are kept, which drops any stray ones too
+                self.cursor.execute(
+                    f"""
+                    CREATE TEMP TABLE vss_compaction AS
+                    SELECT rowid AS vector_id, {columns}
+                    FROM {index}
+                    WHERE rowid IN (SELECT vector_id FROM {config['references']})
+                    """
+                )
+                self.cursor.execute(f"DROP TABLE {index}")
+                self.create_vector_index(index)
+                self.cursor.execute(
+                    f"""
+                    INSERT INTO {index} (rowid, {columns})
+                    SELECT vector_id, {columns} FROM vss_compaction
+                    """
+                )
+                self.cursor.execute("DROP TABLE vss_compaction")
+                self.cursor.execute(f"DELETE FROM {config['tombstones']}")
+        except Exception:
+            self.conn.rollback()
+            raise
         self.conn.commit()
+        return tombstoned
+
+    def insert_into_knowledge_base(self, path, title, content, filetype):
+        """
+        Insert a new item into the knowledge base.
+        """
+        content_hash = Store.hash_content(content)
+        chunks = (
+            self.prepare_chunks(content, filetype)
+            if self.get_chunking() is not None
+            else None
+        )
+        vector_id = self.get_or_create_vector(title, content_hash, content, chunks)
+
+        self.cursor.execute(
+            """
+            INSERT INTO knowledge_base (path, title, content, type, content_hash, vector_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (
+                path,
+                title,
+                self.encode_content(content),
+                filetype,
+                content_hash,
+                vector_id,
+            ),
+        )
+        if chunks is not None:
+            self.replace_chunks(self.cursor.lastrowid, chunks)
+        self.bump_generation()
+        self.commit()
 
     def create_vss_table(self):
         """
@@ -88,70 +939,289 @@ class Store:
         :param search_in: The column to search in ('title' or 'content').
         :return: A list of tuples containing the rowid and similarity distance of the matching items.
         """
+        return [
+            (row[0], row[3])
+            for row in self.search_and_map_similar_items(query, search_in)
+        ]
+
+    def search_and_map_similar_items(
+        self,
+        query: str,
+        search_in="content",
+        limit=10,
+        collapse_duplicates=False,
+        title_weight=DEFAULT_TITLE_WEIGHT,
+    ):
+        """
+        Search for items similar to the given query, and map the results to the corresponding rows in the knowledge base.
+
+        :param query: The query string to search for.
+        :param search_in: The column to search in ('title', 'content' or 'both').
+        :param collapse_duplicates: Whether to return only one result per unique content.
+        :param title_weight: How much the title counts towards the distance when searching both.
+        :return: A list of tuples containing the rowid and similarity distance of the matching items.
+        """
         # Generate the embedding for the query
-        query_embedding = array.array("f", opc.generate_embedding(query)).tobytes()
+        query_embedding = Store.embed_query(query)
+
+        return self.search_and_map_by_embedding(
+            query_embedding, search_in, limit, collapse_duplicates, title_weight
+        )
+
+    def search_and_map_by_embedding(
+        self,
+        query_embedding: bytes,
+        search_in="content",
+        limit=10,
+        collapse_duplicates=False,
+        title_weight=DEFAULT_TITLE_WEIGHT,
+        title_query_embedding: Optional[bytes] = None,
+        exclude_id: Optional[int] = None,
+    ):
+        """
+        Search for items similar to an already generated query embedding, and map the results
+        to the corresponding rows in the knowledge base.
+
+        :param query_embedding: The binary query embedding, as returned by `embed_query`.
+        :param search_in: The column to search in ('title', 'content' or 'both').
+        :param limit: The maximum number of results to return.
+        :param collapse_duplicates: Whether to return only one result per unique content.
+        :param title_weight: How much the title counts towards the distance when searching both.
+        :param title_query_embedding: The embedding to search the title column with, if it should
+        differ from query_embedding.
+        :param exclude_id: The id of an item to leave out of the results.
+        :return: A list of (rowid, title, content, distance) tuples, ordered by distance.
+        """
+        if title_query_embedding is None:
+            title_query_embedding = query_embedding
+        # Make room for the excluded item, which would otherwise take up a result
+        vector_limit = limit + 1 if exclude_id is not None else limit
+
+        # Collapsed copies with different titles each have a vector at the same distance, so
+        # while too few results are left, search again over twice as many vectors
+        while True:
+            search_results = self.search_vector_candidates(
+                query_embedding, title_query_embedding, search_in, vector_limit, title_weight
+            )
+            results = self.map_search_results(search_results)
+            if exclude_id is not None:
+                results = [result for result in results if result[0] != exclude_id]
+            if collapse_duplicates:
+                seen = set()
+                collapsed = []
+                for result in results:
+                    if result[2] not in seen:
+                        seen.add(result[2])
+                        collapsed.append(result)
+                results = collapsed
+            if len(results) >= limit or len(search_results) < vector_limit:
+                break
+            vector_limit *= 2
+
+        # Items sharing a vector all match, so there can be more rows than vectors, and only
+        # the content of the rows which are returned is read and decompressed
+        results = results[:limit]
+        contents = self.get_contents([result[0] for result in results])
+        return [
+            (rowid, title, contents[rowid], distance)
+            for rowid, title, _, distance in results
+        ]
 
-        # Choose the column to search against
-        column = "title_embedding" if search_in == "title" else "content_embedding"
+    def search_vector_candidates(
+        self,
+        query_embedding: bytes,
+        title_query_embedding: bytes,
+        search_in: str,
+        limit: int,
+        title_weight: float,
+    ) -> list[tuple]:
+        """
+        Get the (rowid, distance) of the vectors closest to the query in the given column, or
+        fused across both.
+        """
+        if search_in == "both":
+            return Store.fuse_search_results(
+                self.search_vectors(
+                    title_query_embedding, "title_embedding", limit * FUSED_CANDIDATES
+                ),
+                self.search_content(query_embedding, limit * FUSED_CANDIDATES),
+                title_weight,
+            )[:limit]
+        if search_in == "title":
+            return self.search_vectors(title_query_embedding, "title_embedding", limit)
+        return self.search_content(query_embedding, limit)
 
-        # Execute the vector search query
+    def map_search_results(self, search_results: list[tuple]) -> list[tuple]:
+        """
+        Map (rowid, distance) vector search results to the (rowid, title, content_hash,
+        distance) of every item referencing each vector, ordered by distance.
+        """
+        if not search_results:
+            return []
         self.cursor.execute(
             f"""
-            SELECT rowid, distance
-            FROM vss_knowledge_base
-            WHERE vss_search({column}, ?)
-            ORDER BY distance ASC
-            LIMIT 10;
-            """,
-            (query_embedding,),
+                WITH SearchResults(rowid, distance) AS (
+                    VALUES {','.join(f'({row[0]}, {row[1]})' for row in search_results)}
+                )
+                SELECT knowledge_base.rowid, title, content_hash, SearchResults.distance
+                FROM knowledge_base
+                INNER JOIN SearchResults ON knowledge_base.vector_id = SearchResults.rowid
+                ORDER BY SearchResults.distance ASC, knowledge_base.rowid ASC;
+                """
         )
-
-        # Fetch and return the results
         return self.cursor.fetchall()
 
-    def search_and_map_similar_items(self, query: str, search_in="content", limit=10):
+    def search_similar_to_item(
+        self,
+        identifier: int,
+        search_in="content",
+        limit=10,
+        collapse_duplicates=False,
+        title_weight=DEFAULT_TITLE_WEIGHT,
+    ):
         """
-        Search for items similar to the given query, and map the results to the corresponding rows in the knowledge base.
+        Search for items similar to the item with the given id, using its stored vector rather
+        than generating a new embedding. The item itself is left out of the results.
+        """
+        title_embedding, content_embedding = self.get_item_vector(identifier)
 
-        :param query: The query string to search for.
-        :param search_in: The column to search in ('title' or 'content').
-        :return: A list of tuples containing the rowid and similarity distance of the matching items.
+        return self.search_and_map_by_embedding(
+            content_embedding,
+            search_in,
+            limit,
+            collapse_duplicates,
+            title_weight,
+            title_query_embedding=title_embedding,
+            exclude_id=identifier,
+        )
+
+    def get_item_vector(self, identifier: int) -> tuple[bytes, bytes]:
         """
-        # Generate the embedding for the query
-        query_embedding = array.array("f", opc.generate_embedding(query)).tobytes()
+        Gets the stored title and content embeddings of the item with the given id.
+        """
+        self.cursor.execute(
+            "SELECT vector_id FROM knowledge_base WHERE id = ?", (identifier,)
+        )
+        row = self.cursor.fetchone()
+        if row is None:
+            raise ValueError(f"No item with id {identifier}")
+        return self.get_vector(row[0])
 
-        # Choose the column to search against
-        column = "title_embedding" if search_in == "title" else "content_embedding"
+    def search_content(self, query_embedding: bytes, limit: int):
+        """
+        Get the (rowid, distance) of the item vectors whose content is closest to the query
+        embedding, searching chunks instead if the store is chunked.
+        """
+        if self.get_chunking() is None:
+            return self.search_vectors(query_embedding, "content_embedding", limit)
+        return self.search_chunks(query_embedding, limit)
 
-        # Step 1: Execute the vector search query to get rowids
+    def search_chunks(self, query_embedding: bytes, limit: int):
+        """
+        Get the (rowid, distance) of the item vectors with the chunks closest to the query
+        embedding. Each item is as close as its closest chunk.
+        """
+        chunk_results = self.search_vectors(
+            query_embedding, "content_embedding", limit * CHUNK_CANDIDATES, "vss_chunks"
+        )
+        if not chunk_results:
+            return []
         self.cursor.execute(
             f"""
-            SELECT rowid, distance
-            FROM vss_knowledge_base
-            WHERE vss_search({column}, ?)
-            ORDER BY distance ASC
-            LIMIT ?;
+            WITH ChunkResults(rowid, distance) AS (
+                VALUES {','.join(f'({row[0]}, {row[1]})' for row in chunk_results)}
+            )
+            SELECT knowledge_base.vector_id, MIN(ChunkResults.distance) AS distance
+            FROM chunks
+            INNER JOIN ChunkResults ON chunks.vector_id = ChunkResults.rowid
+            INNER JOIN knowledge_base ON knowledge_base.id = chunks.item_id
+            GROUP BY knowledge_base.vector_id
+            ORDER BY distance ASC, knowledge_base.vector_id ASC
+            LIMIT ?
             """,
-            (query_embedding, limit),
+            (limit,),
         )
-        search_results = self.cursor.fetchall()
+        return self.cursor.fetchall()
+
+    def search_vectors(
+        self,
+        query_embedding: bytes,
+        column: str,
+        limit: int,
+        index: str = "vss_knowledge_base",
+    ):
+        """
+        Get the (rowid, distance) of the vectors closest to the query embedding in a column.
+        Tombstoned vectors are skipped, so while they crowd out the closest live ones, the
+        search is repeated over twice as many vectors, until enough live ones are found or the
+        whole index has been searched.
+        """
+        config = VECTOR_INDEXES[index]
+        if not self.has_vectors(index):
+            # faiss aborts the whole process when asked to search an empty index
+            return []
+        self.cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {config['tombstones']})")
+        candidates = limit * 2 if self.cursor.fetchone()[0] else limit
 
-        results = []
-        if search_results:
+        while True:
             self.cursor.execute(
                 f"""
-                    WITH SearchResults(rowid, distance) AS (
-                        VALUES {','.join(f'({row[0]}, {row[1]})' for row in search_results)}
-                    )
-                    SELECT knowledge_base.rowid, title, content, SearchResults.distance
-                    FROM knowledge_base
-                    INNER JOIN SearchResults ON knowledge_base.rowid = SearchResults.rowid
-                    ORDER BY SearchResults.distance ASC;
-                    """
+                WITH Candidates AS (
+                    SELECT rowid, distance
+                    FROM {index}
+                    WHERE vss_search({column}, ?)
+                    LIMIT ?
+                )
+                SELECT Candidates.rowid, Candidates.distance, tombstones.rowid IS NOT NULL
+                FROM Candidates
+                LEFT JOIN {config['tombstones']} AS tombstones
+                ON tombstones.rowid = Candidates.rowid
+                ORDER BY Candidates.distance ASC
+                """,
+                (query_embedding, candidates),
             )
-            results = self.cursor.fetchall()
+            rows = self.cursor.fetchall()
+            live = [(rowid, distance) for rowid, distance, dead in rows if not dead]
+            if len(live) >= limit or len(rows) < candidates:
+                return live[:limit]
+            candidates *= 2
 
-        return results
+    def has_vectors(self, index: str = "vss_knowledge_base") -> bool:
+        """
+        Whether any vector has been added to the given vector index, live or tombstoned.
+        """
+        config = VECTOR_INDEXES[index]
+        self.cursor.execute(
+            f"""
+            SELECT EXISTS (SELECT 1 FROM {config['references']})
+            OR EXISTS (SELECT 1 FROM {config['tombstones']})
+            """
+        )
+        return bool(self.cursor.fetchone()[0])
+
+    @staticmethod
+    def fuse_search_results(
+        title_results: list[tuple], content_results: list[tuple], title_weight: float
+    ) -> list[tuple]:
+        """
+        Fuse title and content search results into a single weighted distance per rowid.
+        A rowid missing from one column's results is given the furthest distance seen in that
+        column, as it's at least that far away.
+        """
+        title_distances = dict(title_results)
+        content_distances = dict(content_results)
+        furthest_title = max(title_distances.values(), default=0.0)
+        furthest_content = max(content_distances.values(), default=0.0)
+
+        fused = [
+            (
+                rowid,
+                title_weight * title_distances.get(rowid, furthest_title)
+                + (1 - title_weight) * content_distances.get(rowid, furthest_content),
+            )
+            for rowid in title_distances.keys() | content_distances.keys()
+        ]
+        return sorted(fused, key=lambda row: (row[1], row[0]))
 
     def get_all_titles(self):
         """
@@ -173,8 +1243,50 @@ class Store:
             SELECT id, title, path, content, type FROM knowledge_base
             """
         )
+        return self.decode_rows(self.cursor.fetchall(), 3)
+
+    def get_all_metadata(self):
+        """
+        Get the id, title, path, content hash and type of all items, without reading their
+        content, for listing and syncing the store.
+        """
+        self.cursor.execute(
+            """
+            SELECT id, title, path, content_hash, type FROM knowledge_base
+            """
+        )
         return self.cursor.fetchall()
 
+    def get_contents(self, identifiers: list[int]) -> dict[int, str]:
+        """
+        Get the content of the items with the given ids, by id.
+        """
+        if not identifiers:
+            return {}
+        self.cursor.execute(
+            f"""
+            SELECT id, content FROM knowledge_base
+            WHERE id IN ({','.join('?' for _ in identifiers)})
+            """,
+            identifiers,
+        )
+        return {
+            identifier: self.decode_content(content)
+            for identifier, content in self.cursor.fetchall()
+        }
+
+    def get_export_rows(self):
+        """
+        Get every item along with its content hash and vector id, for exporting the store.
+        """
+        self.cursor.execute(
+            """
+            SELECT path, title, content, type, content_hash, vector_id FROM knowledge_base
+            ORDER BY vector_id, id
+            """
+        )
+        return self.decode_rows(self.cursor.fetchall(), 2)
+
     def get_by_id(self, identifier):
         """
         Get the item with the given id.
@@ -186,72 +1298,99 @@ class Store:
             """,
             (identifier,),
         )
-        return self.cursor.fetchone()
+        row = self.cursor.fetchone()
+        return self.decode_rows([row], 3)[0] if row is not None else None
 
     def update_item(self, identifier: int, title: str, content: str):
         """
         Update the item with the given id, title, and content.
-        This function will delete the old entry in the vector search table and create a new one,
-        as well as updating the knowledge base.
+        The item is pointed at a vector for its new title and content, and its old vector is
+        deleted from the vector search table if nothing else shares it.
         """
-        # Update the knowledge base
         self.cursor.execute(
-            """
-            UPDATE knowledge_base
-            SET title = ?, content = ?
-            WHERE id = ?
-            """,
-            (title, content, identifier),
+            "SELECT path FROM knowledge_base WHERE id = ?", (identifier,)
         )
+        path = self.cursor.fetchone()[0]
 
-        # Generate embeddings for the new title and content
-        title_embedding_binary = array.array(
-            "f", opc.generate_embedding(title)
-        ).tobytes()
-        content_embedding_binary = array.array(
-            "f", opc.generate_embedding(content)
-        ).tobytes()
+        self.repoint_item(identifier, path, title, content)
+
+        # Commit the transaction
+        self.bump_generation()
+        self.commit()
+
+    def move_item(self, identifier: int, path: str, title: str):
+        """
+        Move the item with the given id to a new path and title, such as when its file is renamed.
+        Only the title is re-embedded, the stored content embedding is reused as-is.
+        """
+        self.cursor.execute(
+            "SELECT content FROM knowledge_base WHERE id = ?", (identifier,)
+        )
+        content = self.decode_content(self.cursor.fetchone()[0])
 
-        # Delete the old entry in the VSS table
+        self.repoint_item(identifier, path, title, content)
+        self.bump_generation()
+        self.commit()
+
+    def repoint_item(self, identifier: int, path: str, title: str, content: str):
+        """
+        Write the new values of an item, pointing it at the vector for its title and content.
+        """
         self.cursor.execute(
-            """
-            DELETE FROM vss_knowledge_base
-            WHERE rowid = ?
-            """,
-            (identifier,),
+            "SELECT vector_id, type FROM knowledge_base WHERE id = ?", (identifier,)
+        )
+        old_vector_id, filetype = self.cursor.fetchone()
+
+        content_hash = Store.hash_content(content)
+        # The new chunks are prepared while the old ones are still stored, so any chunk the
+        # edit didn't touch keeps its vector rather than being embedded again
+        chunks = (
+            self.prepare_chunks(content, filetype)
+            if self.get_chunking() is not None
+            else None
         )
+        vector_id = self.get_or_create_vector(title, content_hash, content, chunks)
 
-        # Insert a new entry in the VSS table
         self.cursor.execute(
             """
-            INSERT INTO vss_knowledge_base (title_embedding, content_embedding, rowid)
-            VALUES (?, ?, ?)
+            UPDATE knowledge_base
+            SET path = ?, title = ?, content = ?, content_hash = ?, vector_id = ?
+            WHERE id = ?
             """,
-            (title_embedding_binary, content_embedding_binary, identifier),
+            (
+                path,
+                title,
+                self.encode_content(content),
+                content_hash,
+                vector_id,
+                identifier,
+            ),
         )
-
-        # Commit the transaction
-        self.conn.commit()
+        if chunks is not None:
+            self.replace_chunks(identifier, chunks)
+        if old_vector_id != vector_id:
+            self.release_vector(old_vector_id)
 
     def delete_item(self, identifier: int):
         """
         Delete the item with the given id.
         """
         self.cursor.execute(
-            """
-            DELETE FROM knowledge_base
-            WHERE id = ?
-            """,
-            (identifier,),
+            "SELECT vector_id FROM knowledge_base WHERE id = ?", (identifier,)
         )
+        vector_id = self.cursor.fetchone()[0]
+
         self.cursor.execute(
             """
-            DELETE FROM vss_knowledge_base
-            WHERE rowid = ?
+            DELETE FROM knowledge_base
+            WHERE id = ?
             """,
             (identifier,),
         )
-        self.conn.commit()
+        self.replace_chunks(identifier, [])
+        self.release_vector(vector_id)
+        self.bump_generation()
+        self.commit()
 
     def get_id_from_title(self, title):
         """
@@ -290,8 +1429,53 @@ class Store:
             """,
             (path,),
         )
+        row = self.cursor.fetchone()
+        return self.decode_rows([row], 3)[0] if row is not None else None
+
+    def get_metadata_from_path(self, path):
+        """
+        Get the id, title, path, content hash and type of the item with the given path.
+        """
+        self.cursor.execute(
+            """
+            SELECT id, title, path, content_hash, type FROM knowledge_base
+            WHERE path = ?
+            """,
+            (path,),
+        )
         return self.cursor.fetchone()
 
+    @staticmethod
+    def hash_content(content: str) -> str:
+        """
+        Hashes the content of an item, so that duplicate content can be found.
+        """
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def collapse_duplicate_results(
+        results: list[tuple], content_index: int = 2
+    ) -> list[tuple]:
+        """
+        Keeps only the closest of the results which share the same content. Expects results
+        ordered by distance.
+        """
+        seen = set()
+        collapsed = []
+        for result in results:
+            content_hash = Store.hash_content(result[content_index])
+            if content_hash not in seen:
+                seen.add(content_hash)
+                collapsed.append(result)
+        return collapsed
+
+    @staticmethod
+    def embed_query(query: str) -> bytes:
+        """
+        Generates the binary embedding for a query, so that it can be reused across searches.
+        """
+        return array.array("f", get_client().generate_embedding(query)).tobytes()
+
     @staticmethod
     def get_content_summary(content: str, length: int) -> str:
         """Returns a summary of the content."""
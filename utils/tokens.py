@@ -0,0 +1,129 @@
+"""
+A module for counting tokens locally, and fitting embedding inputs within the model's token limit.
+"""
+import os
+from functools import lru_cache
+from typing import Optional
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+MAX_EMBEDDING_TOKENS = 8191
+# The most inputs to send in a single embeddings request
+EMBEDDING_BATCH_SIZE = 100
+# Without the tokenizer, assume a token is this many characters. Real text averages closer to
+# four, so this overestimates, keeping truncated and split inputs safely within the limit.
+CHARS_PER_TOKEN_ESTIMATE = 3
+TOKEN_POLICIES = ["truncate", "split"]
+
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    """
+    Gets the tokenizer for the embeddings model, or None if tiktoken or its encoding is unavailable.
+    """
+    try:
+        import tiktoken
+
+        return tiktoken.encoding_for_model(EMBEDDING_MODEL)
+    except Exception as e:
+        print(f"Tokenizer unavailable ({e}), estimating token counts instead.")
+        return None
+
+
+def get_token_policy() -> str:
+    """
+    Gets how inputs over the token limit are handled, either "truncate" or "split".
+    """
+    policy = os.environ.get("EMBEDDING_TOKEN_POLICY", "truncate")
+    if policy not in TOKEN_POLICIES:
+        raise ValueError(
+            f"Invalid EMBEDDING_TOKEN_POLICY '{policy}', must be one of {', '.join(TOKEN_POLICIES)}"
+        )
+    return policy
+
+
+def count_tokens(text: str, limit: Optional[int] = None) -> int:
+    """
+    Counts the tokens in a text. Given a limit, counting stops once the count is past it, so
+    only a prefix of a long text is ever encoded, rather than all of it.
+    """
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN_ESTIMATE)
+    if limit is None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # Every token is at least a character, so start with a prefix that should be just past the
+    # limit, and double it while it isn't
+    size = (limit + 1) * CHARS_PER_TOKEN_ESTIMATE
+    while True:
+        count = len(encoding.encode(text[:size], disallowed_special=()))
+        if count > limit or size >= len(text):
+            return count
+        size *= 2
+
+
+def truncate_tokens(text: str, max_tokens: int = MAX_EMBEDDING_TOKENS) -> str:
+    """
+    Truncates a text to its first max_tokens tokens, only encoding as much of it as needed.
+    """
+    encoding = get_encoding()
+    if encoding is None:
+        return text[: max_tokens * CHARS_PER_TOKEN_ESTIMATE]
+
+    size = (max_tokens + 1) * CHARS_PER_TOKEN_ESTIMATE
+    while True:
+        tokens = encoding.encode(text[:size], disallowed_special=())
+        if len(tokens) > max_tokens or size >= len(text):
+            return encoding.decode(tokens[:max_tokens])
+        size *= 2
+
+
+def split_tokens(text: str, max_tokens: int = MAX_EMBEDDING_TOKENS) -> list[str]:
+    """
+    Splits a text into consecutive pieces of at most max_tokens tokens.
+    """
+    encoding = get_encoding()
+    if encoding is None:
+        size = max_tokens * CHARS_PER_TOKEN_ESTIMATE
+        return [text[i : i + size] for i in range(0, len(text), size)] or [text]
+
+    tokens = encoding.encode(text, disallowed_special=())
+    return [
+        encoding.decode(tokens[i : i + max_tokens])
+        for i in range(0, len(tokens), max_tokens)
+    ] or [text]
+
+
+def plan_inputs(
+    text: str, policy: Optional[str] = None, max_tokens: int = MAX_EMBEDDING_TOKENS
+) -> list[str]:
+    """
+    Plans the inputs needed to embed a text within the token limit. Texts within the limit are
+    embedded as-is, and longer ones are either truncated to the limit, or split into pieces whose
+    embeddings are combined.
+    """
+    if count_tokens(text, max_tokens) <= max_tokens:
+        return [text]
+    if (policy or get_token_policy()) == "truncate":
+        return [truncate_tokens(text, max_tokens)]
+    return split_tokens(text, max_tokens)
+
+
+def estimate_cost(tokens: int) -> float:
+    """
+    Estimates the cost in dollars of embedding the given number of tokens.
+    """
+    return tokens / 1000 * float(os.environ.get("EMBEDDING_PRICE_PER_1K_TOKENS", 0.0001))
+
+
+def estimate_duration(requests: int, tokens: int, files: int, delay: float) -> float:
+    """
+    Estimates the number of seconds needed to make the given requests, whichever is slowest of
+    the delay between files and the requests per minute and tokens per minute rate limits.
+    """
+    requests_per_minute = float(os.environ.get("EMBEDDING_RPM", 3000))
+    tokens_per_minute = float(os.environ.get("EMBEDDING_TPM", 1000000))
+    return max(
+        files * delay,
+        requests / requests_per_minute * 60,
+        tokens / tokens_per_minute * 60,
+    )
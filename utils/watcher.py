@@ -0,0 +1,219 @@
+"""
+A module for watching a directory for changes, so that stores can be kept in sync continuously.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from typing import Iterator, Optional
+from utils.walker import Walker
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyEventSource:
+    """
+    Reports changed paths using Linux inotify, blocking in the kernel while nothing happens.
+    """
+
+    def __init__(self, directory: str) -> None:
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+
+        self.directory = directory
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not initialize inotify")
+        self.watches: dict[int, str] = {}
+        self.add_watches(directory)
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watches(self, directory: str) -> None:
+        """
+        Watches the given directory and every directory beneath it.
+        """
+        for dirpath, _, _ in os.walk(directory):
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dirpath), WATCH_MASK
+            )
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"Could not watch {dirpath}")
+            self.watches[wd] = dirpath
+
+    def wait(self, timeout: Optional[float]) -> list[str]:
+        """
+        Waits up to the timeout (forever if None) for events, returning the paths which changed.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset : offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, so report the whole tree as changed
+                paths.append(self.directory)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+
+            path = os.path.join(self.watches[wd], os.fsdecode(name))
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_watches(path)
+            paths.append(path)
+
+        return paths
+
+
+class PollingEventSource:
+    """
+    Reports changed paths by periodically comparing the modification times of every file.
+    Used wherever inotify isn't available.
+    """
+
+    def __init__(self, directory: str, interval: float = 2.0) -> None:
+        self.directory = directory
+        self.interval = interval
+        self.walker = Walker(directory)
+        self.snapshot = self.take_snapshot()
+
+    def close(self):
+        pass
+
+    def take_snapshot(self) -> dict[str, tuple[int, int]]:
+        snapshot = {}
+        for file in self.walker.walk_files():
+            try:
+                stat = os.stat(file)
+            except FileNotFoundError:
+                continue
+            snapshot[file] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def wait(self, timeout: Optional[float]) -> list[str]:
+        """
+        Waits up to the timeout (forever if None) for files to change, returning their paths.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = self.interval
+            if deadline is not None:
+                remaining = min(remaining, max(0.0, deadline - time.monotonic()))
+            time.sleep(remaining)
+
+            snapshot = self.take_snapshot()
+            changed = [
+                path
+                for path in snapshot.keys() | self.snapshot.keys()
+                if snapshot.get(path) != self.snapshot.get(path)
+            ]
+            self.snapshot = snapshot
+
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+
+class Watcher:
+    """
+    Watches a directory, debouncing bursts of filesystem events into batches of changed paths.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        debounce: float = 1.0,
+        max_delay: float = 10.0,
+        poll: bool = False,
+        poll_interval: float = 2.0,
+        retry_delay: float = 30.0,
+    ) -> None:
+        self.directory = directory
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        # Paths to yield again, such as ones whose changes failed to apply
+        self.requeued: set[str] = set()
+
+        self.source = None
+        if not poll:
+            try:
+                self.source = InotifyEventSource(directory)
+            except (OSError, AttributeError) as e:
+                print(f"inotify unavailable ({e}), falling back to polling.")
+        if self.source is None:
+            self.source = PollingEventSource(directory, poll_interval)
+
+    def close(self):
+        self.source.close()
+
+    def requeue(self, paths: set[str]) -> None:
+        """
+        Queues paths to be yielded again with the next batch, or after the retry delay if
+        nothing else changes before then.
+        """
+        self.requeued.update(paths)
+
+    def watch(self) -> Iterator[set[str]]:
+        """
+        Yields sets of changed paths. A batch is yielded once no new events have arrived for the
+        debounce period, or once the max delay has passed since the first event in the batch.
+        """
+        while True:
+            changed = set(self.source.wait(self.retry_delay if self.requeued else None))
+            changed.update(self.requeued)
+            self.requeued = set()
+            if not changed:
+                continue
+
+            first_event = time.monotonic()
+            while time.monotonic() - first_event < self.max_delay:
+                more = self.source.wait(self.debounce)
+                if not more:
+                    break
+                changed.update(more)
+
+            yield changed